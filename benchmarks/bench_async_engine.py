@@ -0,0 +1,65 @@
+'''
+Load benchmark of the database-backed endpoints.
+
+Runs every scenario with a few hundred concurrent clients against a running
+API (see run.sh) and prints p50/p95/p99 latencies.
+
+Usage:
+    python benchmarks/bench_async_engine.py [--concurrency 200] [--requests 5000]
+'''
+import argparse
+import asyncio
+from sqlalchemy import text
+
+from common import (ensure_admin, get_sync_engine, print_report, run_load,
+                    BENCH_EMAIL, BENCH_PASSWORD)
+
+
+def prepare_department(user_id: int) -> int:
+    '''
+    Create a department holding the benchmark user and return its id.
+    '''
+
+    engine = get_sync_engine()
+    with engine.begin() as connection:
+        department_id = connection.execute(
+            text("INSERT INTO departments (name) VALUES ('bench') "
+                 "RETURNING id")).scalar_one()
+        connection.execute(
+            text('INSERT INTO user_department (user_id, department_id) '
+                 'VALUES (:user_id, :department_id)'),
+            {'user_id': user_id, 'department_id': department_id})
+    engine.dispose()
+
+    return department_id
+
+
+async def main(concurrency: int, total: int):
+    admin = ensure_admin()
+    department_id = prepare_department(admin['id'])
+    headers = {'Authorization': f"Bearer {admin['jwt']}"}
+
+    scenarios = {
+        'POST /connect': lambda client: client.post(
+            '/connect', json={'email': BENCH_EMAIL,
+                              'password': BENCH_PASSWORD}),
+        'GET /user/{user_id}': lambda client: client.get(
+            f"/user/{admin['id']}", headers=headers),
+        'GET /departements/{department_id}/users': lambda client: client.get(
+            f'/departements/{department_id}/users', headers=headers),
+        'GET /rh/msg/': lambda client: client.get(
+            '/rh/msg/', headers=headers)
+    }
+
+    print(f'{concurrency} concurrent clients, {total} requests per scenario')
+    for name, make_request in scenarios.items():
+        print_report(name, await run_load(make_request, concurrency, total))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--concurrency', type=int, default=200)
+    parser.add_argument('--requests', type=int, default=5000)
+    args = parser.parse_args()
+
+    asyncio.run(main(args.concurrency, args.requests))
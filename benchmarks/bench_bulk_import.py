@@ -0,0 +1,98 @@
+'''
+Throughput of /user/bulk_create compared with one /user/create call per
+user, and latency of POST /connect while a bulk import hashes its
+passwords, against the latency of POST /connect alone.
+
+The bulk import is sent in batches of the size accepted by the endpoint
+(MAX_BULK_USERS). Run the API with the login rate limits off (see the
+README).
+
+Usage:
+    python benchmarks/bench_bulk_import.py [--users 2000] [--batch 1000]
+        [--single 200] [--logins 50]
+'''
+import argparse
+import asyncio
+import json
+import time
+import uuid
+import httpx
+
+from common import (BASE_URL, BENCH_EMAIL, BENCH_PASSWORD, ensure_admin,
+                    print_report, run_load)
+
+
+def make_users(count: int) -> list:
+    run = uuid.uuid4().hex[:8]
+    return [{'email': f'bulk-{run}-{index}@protorh.local',
+             'password': 'bulk-password',
+             'firstname': 'Bulk',
+             'lastname': f'User {index}',
+             'birthday_date': '1990-01-01',
+             'adress': '1 rue du Benchmark',
+             'postal_code': '75000'} for index in range(count)]
+
+
+async def bulk(users: list, batch: int, jwt: str) -> float:
+    start = time.perf_counter()
+    created = 0
+    errors = 0
+    async with httpx.AsyncClient(base_url=BASE_URL, timeout=600) as client:
+        for offset in range(0, len(users), batch):
+            body = '\n'.join(json.dumps(user)
+                             for user in users[offset:offset + batch])
+            response = await client.post(
+                '/user/bulk_create', content=body,
+                headers={'Authorization': f'Bearer {jwt}',
+                         'Content-Type': 'application/x-ndjson'})
+            response.raise_for_status()
+            created += response.json()['created']
+            errors += response.json()['errors']
+    elapsed = time.perf_counter() - start
+    print(f'bulk_create: {created} created, {errors} errors')
+    return elapsed
+
+
+async def logins(count: int) -> dict:
+    return await run_load(
+        lambda client: client.post('/connect', json={
+            'email': BENCH_EMAIL, 'password': BENCH_PASSWORD}),
+        concurrency=5, total=count)
+
+
+async def single(users: list) -> dict:
+    pending = iter(users)
+    return await run_load(lambda client: client.post('/user/create',
+                                                     json=next(pending)),
+                          concurrency=50, total=len(users))
+
+
+async def main(count: int, batch: int, single_count: int, login_count: int):
+    admin = ensure_admin()
+
+    print_report('POST /connect', await logins(login_count))
+
+    import_task = asyncio.create_task(bulk(make_users(count), batch,
+                                           admin['jwt']))
+    # Let the import start hashing
+    await asyncio.sleep(1)
+    print_report('POST /connect during bulk_create',
+                 await logins(login_count))
+    elapsed = await import_task
+    print(f'/user/bulk_create {count} users in batches of {batch} in '
+          f'{elapsed:.2f} s ({count / elapsed:.1f} users/s)')
+
+    report = await single(make_users(single_count))
+    print(f"/user/create      {single_count} users "
+          f"({report['rps']:.1f} users/s, 50 concurrent clients)")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--batch', type=int, default=1000)
+    parser.add_argument('--single', type=int, default=200)
+    parser.add_argument('--logins', type=int, default=50)
+    args = parser.parse_args()
+
+    asyncio.run(main(args.users, args.batch, args.single, args.logins))
@@ -0,0 +1,65 @@
+'''
+Cold-start time of an API worker: from process start to the first answer
+to /hello. It compares bootstrapping the schema on every start, as it was
+done at import time (DATABASE_AUTO_MIGRATE=true), with the lifespan that
+only checks the database is reachable.
+
+Usage:
+    python benchmarks/bench_cold_start.py [--starts 10] [--port 4299]
+'''
+import os
+import sys
+import argparse
+import subprocess
+import time
+import httpx
+
+from common import percentile, root_dir
+
+MODES = {
+    'schema bootstrap on start': {'DATABASE_AUTO_MIGRATE': 'true'},
+    'lifespan ping only': {'DATABASE_AUTO_MIGRATE': 'false'}
+}
+
+
+def cold_start(port: int, environment: dict) -> float:
+    '''
+    Start a worker and return the seconds until it answers /hello.
+    '''
+
+    start = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'uvicorn', 'src.main:app',
+         '--port', str(port), '--log-level', 'warning'],
+        cwd=root_dir, env={**os.environ, **environment},
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    try:
+        while True:
+            if process.poll() is not None:
+                raise RuntimeError('The worker exited during startup')
+            try:
+                httpx.get(f'http://localhost:{port}/hello', timeout=1)
+                return time.perf_counter() - start
+            except httpx.TransportError:
+                time.sleep(0.005)
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def main(starts: int, port: int):
+    for name, environment in MODES.items():
+        durations = [cold_start(port, environment) for _ in range(starts)]
+        print(f'{name:<28} '
+              f'p50 {percentile(durations, 50) * 1000:>8.1f} ms '
+              f'max {max(durations) * 1000:>8.1f} ms')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--starts', type=int, default=10)
+    parser.add_argument('--port', type=int, default=4299)
+    args = parser.parse_args()
+
+    main(args.starts, args.port)
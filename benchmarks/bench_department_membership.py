@@ -0,0 +1,109 @@
+'''
+Compare the former per-row department membership path with the set-based
+statements used by /departements/{department_id}/users/add and /remove,
+imported from main.
+
+Seeds synthetic users directly in the database, then times adding and
+removing all of them to a department with both strategies, and counts
+their statements with the query guard.
+
+Usage:
+    python benchmarks/bench_department_membership.py [--users 5000]
+'''
+import argparse
+import asyncio
+import time
+from sqlalchemy import text
+
+import common  # Loads protorh.env and adds src/ to the path
+from database_controller import get_engine
+from query_guard_controller import guard_queries
+# The statements and chunking of the endpoints
+from main import (ADD_DEPARTMENT_USERS, REMOVE_DEPARTMENT_USERS,
+                  change_department_users)
+
+ADD_ONE = text('''
+    INSERT INTO user_department (user_id, department_id)
+    VALUES (:user_id, :department_id)
+    ON CONFLICT (user_id, department_id) DO NOTHING
+    RETURNING user_id;
+''')
+
+REMOVE_ONE = text('''
+    DELETE FROM user_department
+    WHERE department_id = :department_id AND user_id = :user_id;
+''')
+
+SELECT_ONE = text('''
+    SELECT id, email, firstname, lastname FROM users WHERE id = :id;
+''')
+
+
+async def per_row(connection, statement, department_id, user_ids):
+    affected = []
+    for user_id in user_ids:
+        result = await connection.execute(
+            statement, {'user_id': user_id, 'department_id': department_id})
+        if result.rowcount > 0:
+            affected.append(user_id)
+    output = []
+    for user_id in affected:
+        row = (await connection.execute(
+            SELECT_ONE, {'id': user_id})).mappings().one_or_none()
+        if row:
+            output.append(row)
+    return output
+
+
+async def timed(engine, function, statement, department_id, user_ids):
+    start = time.perf_counter()
+    with guard_queries() as log:
+        async with engine.begin() as connection:
+            output = await function(connection, statement, department_id,
+                                    user_ids)
+    return time.perf_counter() - start, len(output), log
+
+
+async def main(users: int):
+    engine = get_engine()
+
+    async with engine.begin() as connection:
+        department_id = (await connection.execute(text(
+            "INSERT INTO departments (name) VALUES ('bench-membership') "
+            "RETURNING id"))).scalar_one()
+        user_ids = (await connection.execute(text('''
+            INSERT INTO users (email, firstname, lastname, role)
+            SELECT 'bench-membership-' || n || '-' || md5(random()::text)
+                || '@protorh.local', 'Bench', 'User ' || n, 'user'
+            FROM generate_series(1, CAST(:users AS integer)) AS n
+            RETURNING id
+        '''), {'users': users})).scalars().all()
+
+    print(f'{users} users')
+    for name, function, add, remove in [
+            ('per-row', per_row, ADD_ONE, REMOVE_ONE),
+            ('set-based', change_department_users, ADD_DEPARTMENT_USERS,
+             REMOVE_DEPARTMENT_USERS)]:
+        for action, statement in [('add', add), ('remove', remove)]:
+            elapsed, count, log = await timed(engine, function, statement,
+                                              department_id, user_ids)
+            print(f'{name:<10} {action:<6} {elapsed * 1000:>10.1f} ms '
+                  f'({count} rows, {log.count} statements, '
+                  f'{max(log.shapes.values())} of the same shape)')
+
+    async with engine.begin() as connection:
+        await connection.execute(
+            text('DELETE FROM users WHERE id = ANY(CAST(:ids AS integer[]))'),
+            {'ids': user_ids})
+        await connection.execute(
+            text('DELETE FROM departments WHERE id = :id'),
+            {'id': department_id})
+    await engine.dispose()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=5000)
+    args = parser.parse_args()
+
+    asyncio.run(main(args.users))
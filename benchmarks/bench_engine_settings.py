@@ -0,0 +1,93 @@
+'''
+Throughput of the get_user query under each engine setting read from
+protorh.env, in transactions (engine.begin) and in autocommit mode (the
+read engine used by the read-only endpoints).
+
+Each configuration gets its own engine, driven by many concurrent tasks
+running the same SELECT.
+
+Usage:
+    python benchmarks/bench_engine_settings.py [--concurrency 50] [--queries 5000]
+'''
+import os
+import argparse
+import asyncio
+import time
+from contextlib import redirect_stdout
+from sqlalchemy import text
+
+import common  # Loads protorh.env and adds src/ to the path
+from common import percentile
+from database_controller import create_engine_from_env
+
+CONFIGURATIONS = {
+    'defaults': {},
+    'DATABASE_POOL_SIZE=1 MAX_OVERFLOW=0': {'pool_size': 1,
+                                            'max_overflow': 0},
+    'DATABASE_POOL_SIZE=20 MAX_OVERFLOW=0': {'pool_size': 20,
+                                             'max_overflow': 0},
+    'DATABASE_POOL_PRE_PING=true': {'pool_pre_ping': True},
+    'DATABASE_POOL_RECYCLE=1': {'pool_recycle': 1},
+    'DATABASE_STATEMENT_TIMEOUT=5000': {'connect_args': {
+        'server_settings': {'statement_timeout': '5000'}}},
+    'DATABASE_ECHO=true': {'echo': True}
+}
+
+QUERY = text('SELECT * FROM users WHERE id = :user_id')
+
+
+async def run(engine, concurrency: int, total: int, user_id: int) -> tuple:
+    latencies = []
+    remaining = total
+
+    async def worker():
+        nonlocal remaining
+        while remaining > 0:
+            remaining -= 1
+            start = time.perf_counter()
+            async with engine.connect() as connection:
+                (await connection.execute(
+                    QUERY, {'user_id': user_id})).mappings().one_or_none()
+                await connection.commit()
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+
+    return total / (time.perf_counter() - start), latencies
+
+
+async def main(concurrency: int, total: int):
+    # Echoed statements go to /dev/null, only their cost is measured
+    devnull = open(os.devnull, 'w')
+
+    for name, overrides in CONFIGURATIONS.items():
+        with redirect_stdout(devnull):
+            engine = create_engine_from_env(**overrides)
+
+        async with engine.connect() as connection:
+            user_id = (await connection.execute(
+                text('SELECT min(id) FROM users'))).scalar_one() or 0
+
+        read_engine = engine.execution_options(isolation_level='AUTOCOMMIT')
+
+        for mode, mode_engine in [('begin', engine),
+                                  ('autocommit', read_engine)]:
+            throughput, latencies = await run(mode_engine, concurrency,
+                                              total, user_id)
+            print(f'{name:<38} {mode:<10} {throughput:>8.0f} queries/s '
+                  f'p50 {percentile(latencies, 50) * 1000:>7.2f} ms '
+                  f'p99 {percentile(latencies, 99) * 1000:>7.2f} ms')
+
+        await engine.dispose()
+
+    devnull.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--queries', type=int, default=5000)
+    args = parser.parse_args()
+
+    asyncio.run(main(args.concurrency, args.queries))
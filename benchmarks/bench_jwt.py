@@ -0,0 +1,61 @@
+'''
+Microbenchmark of JWT verification: per-request jwt.decode with an
+environment lookup, as endpoints used to do, against the shared
+TokenVerifier cache.
+
+Usage:
+    python benchmarks/bench_jwt.py [--iterations 100000] [--tokens 100]
+'''
+import os
+import argparse
+import time
+from datetime import datetime, timedelta
+import jwt
+
+import common  # Loads protorh.env and adds src/ to the path
+from auth_controller import TokenVerifier
+
+
+def make_tokens(count: int) -> list:
+    secret_key = os.getenv('SECRET_KEY')
+    return [jwt.encode({'id': index, 'email': f'user{index}@protorh.local',
+                        'role': 'user',
+                        'exp': datetime.utcnow() + timedelta(minutes=10)},
+                       secret_key, algorithm='HS256')
+            for index in range(count)]
+
+
+def decode_every_time(tokens: list, iterations: int) -> float:
+    start = time.perf_counter()
+    for index in range(iterations):
+        jwt.decode(tokens[index % len(tokens)], os.getenv('SECRET_KEY'),
+                   algorithms=['HS256'])
+    return time.perf_counter() - start
+
+
+def verify_cached(tokens: list, iterations: int) -> tuple:
+    verifier = TokenVerifier(os.getenv('SECRET_KEY'))
+    start = time.perf_counter()
+    for index in range(iterations):
+        verifier.verify(tokens[index % len(tokens)])
+    return time.perf_counter() - start, verifier.stats()
+
+
+def main(iterations: int, token_count: int):
+    tokens = make_tokens(token_count)
+
+    elapsed = decode_every_time(tokens, iterations)
+    print(f'jwt.decode per request {elapsed / iterations * 1e6:>8.2f} us/op')
+
+    elapsed, stats = verify_cached(tokens, iterations)
+    print(f'TokenVerifier          {elapsed / iterations * 1e6:>8.2f} us/op '
+          f"({stats['hits']} hits, {stats['misses']} misses)")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--iterations', type=int, default=100000)
+    parser.add_argument('--tokens', type=int, default=100)
+    args = parser.parse_args()
+
+    main(args.iterations, args.tokens)
@@ -0,0 +1,111 @@
+'''
+Password verification throughput, to size PASSWORD_WORKERS.
+
+Verifies scrypt hashes with many concurrent logins in thread pools of
+each size, reporting verifications per second, p50/p95 latencies (waiting
+for a thread included) and the longest event loop stall, against the
+legacy MD5 hash and scrypt run on the event loop. Then drives POST /connect
+on a running API (see run.sh), whose pool is sized by its own
+PASSWORD_WORKERS.
+
+Usage:
+    python benchmarks/bench_login.py [--workers 1 2 4 8] [--logins 200]
+        [--concurrency 50]
+'''
+import os
+import argparse
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import common  # Loads protorh.env and adds src/ to the path
+from common import (BENCH_EMAIL, BENCH_PASSWORD, ensure_admin, percentile,
+                    print_report, run_load)
+from password_controller import check_hash, legacy_hash, make_hash
+
+PASSWORD = 'bench-password'
+
+
+async def watch_loop(stalls: list, stop: asyncio.Event):
+    '''
+    Record how late the event loop wakes up a 1 ms sleep.
+    '''
+
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(0.001)
+        stalls.append(time.perf_counter() - start - 0.001)
+
+
+async def measure(verify, logins: int, concurrency: int) -> tuple:
+    latencies = []
+    stalls = []
+    stop = asyncio.Event()
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def login():
+        async with semaphore:
+            start = time.perf_counter()
+            await verify()
+            latencies.append(time.perf_counter() - start)
+
+    watcher = asyncio.create_task(watch_loop(stalls, stop))
+    start = time.perf_counter()
+    await asyncio.gather(*(login() for _ in range(logins)))
+    elapsed = time.perf_counter() - start
+    stop.set()
+    await watcher
+
+    return logins / elapsed, latencies, max(stalls, default=0.0)
+
+
+def print_line(name: str, rate: float, latencies: list, stall: float):
+    print(f'{name:<24} {rate:>9.1f} logins/s '
+          f'p50 {percentile(latencies, 50) * 1000:>8.2f} ms '
+          f'p95 {percentile(latencies, 95) * 1000:>8.2f} ms '
+          f'loop stall {stall * 1000:>8.2f} ms')
+
+
+async def main(workers: list, logins: int, concurrency: int):
+    stored = make_hash(PASSWORD)
+    legacy = legacy_hash(PASSWORD)
+    print(f'{os.cpu_count()} CPUs, {logins} logins, {concurrency} at a time')
+
+    async def verify_legacy():
+        check_hash(PASSWORD, legacy)
+
+    print_line('legacy md5', *await measure(verify_legacy, logins,
+                                            concurrency))
+
+    async def verify_inline():
+        check_hash(PASSWORD, stored)
+
+    print_line('scrypt on the loop', *await measure(verify_inline, logins,
+                                                    concurrency))
+
+    loop = asyncio.get_running_loop()
+    for size in workers:
+        with ThreadPoolExecutor(max_workers=size) as executor:
+            async def verify_pooled():
+                await loop.run_in_executor(executor, check_hash, PASSWORD,
+                                           stored)
+
+            print_line(f'scrypt, {size} threads',
+                       *await measure(verify_pooled, logins, concurrency))
+
+    # The first login of a legacy hash also rehashes it
+    ensure_admin()
+    print_report('POST /connect', await run_load(
+        lambda client: client.post('/connect', json={
+            'email': BENCH_EMAIL, 'password': BENCH_PASSWORD}),
+        concurrency, logins))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--logins', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=50)
+    args = parser.parse_args()
+
+    asyncio.run(main(args.workers, args.logins, args.concurrency))
@@ -0,0 +1,73 @@
+'''
+Profile picture upload throughput and bytes served, comparing the former
+path (decode the header on the event loop, store the original) with the
+rendition pipeline running in the process pool.
+
+Usage:
+    python benchmarks/bench_pictures.py [--uploads 200]
+'''
+import io
+import argparse
+import asyncio
+import time
+from PIL import Image
+
+import common  # Loads protorh.env and adds src/ to the path
+from image_controller import process_picture, get_executor
+
+
+def make_samples() -> dict:
+    photo = Image.effect_noise((1600, 1200), 64).convert('RGB')
+    photo_bytes = io.BytesIO()
+    photo.save(photo_bytes, 'JPEG', quality=90)
+
+    square = Image.effect_noise((800, 800), 32).convert('RGBA')
+    square_bytes = io.BytesIO()
+    square.save(square_bytes, 'PNG')
+
+    frames = [Image.effect_noise((400, 400), 16 + index).convert('P')
+              for index in range(30)]
+    gif_bytes = io.BytesIO()
+    frames[0].save(gif_bytes, 'GIF', save_all=True, append_images=frames[1:])
+
+    return {'jpeg 1600x1200': photo_bytes.getvalue(),
+            'png 800x800': square_bytes.getvalue(),
+            'gif 400x400x30': gif_bytes.getvalue()}
+
+
+def former_path(content: bytes) -> bytes:
+    with io.BytesIO(content) as stream:
+        Image.open(stream).size
+    return content
+
+
+async def main(uploads: int):
+    samples = make_samples()
+    get_executor()
+
+    for name, content in samples.items():
+        start = time.perf_counter()
+        for _ in range(uploads):
+            served = former_path(content)
+        former = time.perf_counter() - start
+
+        start = time.perf_counter()
+        results = await asyncio.gather(
+            *(process_picture(content) for _ in range(uploads)))
+        pipeline = time.perf_counter() - start
+        renditions = results[0]
+
+        print(f'{name}')
+        print(f'    former   {uploads / former:>9.1f} uploads/s, '
+              f'serves {len(served):>9} bytes')
+        print(f'    pipeline {uploads / pipeline:>9.1f} uploads/s, serves '
+              + ', '.join(f'{size}px {len(data)} bytes'
+                          for size, data in renditions.items()))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--uploads', type=int, default=200)
+    args = parser.parse_args()
+
+    asyncio.run(main(args.uploads))
@@ -0,0 +1,175 @@
+'''
+Payload size and latency of the user reads, comparing the former SELECT *
+followed by hand-written dict projections and jsonable_encoder with the
+projected columns serialized through the response models.
+
+Seeds synthetic users (with a password and a meta document) in a
+department, then builds the /departements/{department_id}/users and the
+public /user/{user_id} responses both ways. They are dropped at the end.
+
+Usage:
+    python benchmarks/bench_projections.py [--users 5000] [--meta-size 1000]
+'''
+import json
+import argparse
+import asyncio
+import time
+from fastapi.encoders import jsonable_encoder
+from pydantic import TypeAdapter
+from sqlalchemy import text
+
+import common  # Loads protorh.env and adds src/ to the path
+from common import percentile
+from base_controller import select_columns
+from database_controller import get_engine
+from classes.user import AdminUser, PublicUser
+
+DEPARTMENT_USERS = '''
+    SELECT {columns} FROM users
+    JOIN user_department ON users.id = user_department.user_id
+    WHERE user_department.department_id = :department_id
+'''
+
+USER = 'SELECT {columns} FROM users WHERE id = :user_id'
+
+
+def former_admin(row) -> dict:
+    return {
+        'email': row['email'],
+        'firstname': row['firstname'],
+        'lastname': row['lastname'],
+        'birthday_date': row['birthday_date'],
+        'adress': row['adress'],
+        'postal_code': row['postal_code'],
+        'age': row['age'],
+        'meta': row['meta'],
+        'registration_date': row['registration_date'],
+        'token': row['token'],
+        'role': row['role']
+    }
+
+
+def former_public(row) -> dict:
+    return {
+        'email': row['email'],
+        'firstname': row['firstname'],
+        'lastname': row['lastname'],
+        'age': row['age'],
+        'registration_date': row['registration_date'],
+        'role': row['role']
+    }
+
+
+async def database_bytes(connection, query: str, values: dict) -> int:
+    return (await connection.execute(text(
+        f'SELECT coalesce(sum(pg_column_size(t.*)), 0) FROM ({query}) AS t'),
+        values)).scalar_one()
+
+
+async def measure(engine, build, repeat: int) -> tuple:
+    latencies = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        async with engine.connect() as connection:
+            payload = await build(connection)
+        latencies.append(time.perf_counter() - start)
+    return latencies, len(payload)
+
+
+async def main(users: int, meta_size: int, repeat: int):
+    engine = get_engine()
+
+    async with engine.begin() as connection:
+        department_id = (await connection.execute(text(
+            "INSERT INTO departments (name) VALUES ('bench-projections') "
+            "RETURNING id"))).scalar_one()
+        user_ids = (await connection.execute(text('''
+            INSERT INTO users (email, password, firstname, lastname,
+                birthday_date, adress, postal_code, age, meta,
+                registration_date, token, role)
+            SELECT 'bench-projections-' || n || '-' || md5(random()::text)
+                || '@protorh.local', md5(random()::text), 'Bench',
+                'User ' || n, '1990-01-01', n || ' rue du Benchmark',
+                '75000', 36, CAST(:meta AS json), current_date,
+                CAST(n AS varchar), 'user'
+            FROM generate_series(1, CAST(:users AS integer)) AS n
+            RETURNING id
+        '''), {'users': users,
+               'meta': json.dumps({'notes': 'x' * meta_size})})).scalars().all()
+        await connection.execute(text('''
+            INSERT INTO user_department (user_id, department_id)
+            SELECT user_id, :department_id
+            FROM unnest(CAST(:user_ids AS integer[])) AS user_id
+        '''), {'user_ids': user_ids, 'department_id': department_id})
+
+    admin_users = TypeAdapter(list[AdminUser])
+    public_user = TypeAdapter(PublicUser)
+    department = {'department_id': department_id}
+    user = {'user_id': user_ids[0]}
+
+    async def former_department(connection):
+        result = await connection.execute(
+            text(DEPARTMENT_USERS.format(columns='*')), department)
+        output = [former_admin(row) for row in result.mappings()]
+        return json.dumps(jsonable_encoder(output),
+                          separators=(',', ':')).encode()
+
+    async def projected_department(connection):
+        result = await connection.execute(text(DEPARTMENT_USERS.format(
+            columns=select_columns(AdminUser, 'users'))), department)
+        return admin_users.dump_json(
+            admin_users.validate_python(result.mappings().all()))
+
+    async def former_user(connection):
+        row = (await connection.execute(
+            text(USER.format(columns='*')), user)).mappings().one()
+        return json.dumps(jsonable_encoder(former_public(row)),
+                          separators=(',', ':')).encode()
+
+    async def projected_user(connection):
+        row = (await connection.execute(text(USER.format(
+            columns=select_columns(PublicUser))), user)).mappings().one()
+        return public_user.dump_json(public_user.validate_python(dict(row)))
+
+    try:
+        print(f'{users} users, meta of {meta_size} bytes')
+        for name, query, values, build, count in [
+                ('department SELECT *', DEPARTMENT_USERS.format(
+                    columns='*'), department, former_department, 10),
+                ('department projected', DEPARTMENT_USERS.format(
+                    columns=select_columns(AdminUser, 'users')), department,
+                 projected_department, 10),
+                ('public user SELECT *', USER.format(columns='*'), user,
+                 former_user, repeat),
+                ('public user projected', USER.format(
+                    columns=select_columns(PublicUser)), user,
+                 projected_user, repeat)]:
+            async with engine.connect() as connection:
+                fetched = await database_bytes(connection, query, values)
+            latencies, size = await measure(engine, build, count)
+            print(f'{name:<22} fetched {fetched:>10} B '
+                  f'response {size:>10} B '
+                  f'p50 {percentile(latencies, 50) * 1000:>8.2f} ms')
+    finally:
+        async with engine.begin() as connection:
+            await connection.execute(
+                text('DELETE FROM user_department '
+                     'WHERE department_id = :id'), {'id': department_id})
+            await connection.execute(
+                text('DELETE FROM users '
+                     'WHERE id = ANY(CAST(:ids AS integer[]))'),
+                {'ids': user_ids})
+            await connection.execute(
+                text('DELETE FROM departments WHERE id = :id'),
+                {'id': department_id})
+        await engine.dispose()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=5000)
+    parser.add_argument('--meta-size', type=int, default=1000)
+    parser.add_argument('--repeat', type=int, default=500)
+    args = parser.parse_args()
+
+    asyncio.run(main(args.users, args.meta_size, args.repeat))
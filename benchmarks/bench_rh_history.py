@@ -0,0 +1,133 @@
+'''
+Latency of 1000 successive edits of a single request rh and size of the
+tables afterwards, comparing the former content_history JSON rewrite with
+the append-only requests_rh_history table.
+
+Both strategies run on scratch tables, dropped at the end. Autovacuum is
+disabled on them so the dead tuples left by the edits are counted.
+
+Usage:
+    python benchmarks/bench_rh_history.py [--edits 1000] [--content-size 200]
+'''
+import json
+import argparse
+import asyncio
+import time
+from datetime import date
+from sqlalchemy import text
+
+import common  # Loads protorh.env and adds src/ to the path
+from common import percentile
+from database_controller import get_engine
+
+TABLES = {
+    'bench_rh_json':
+        'CREATE TABLE bench_rh_json (id serial PRIMARY KEY, content varchar, '
+        'last_action date, content_history json) '
+        'WITH (autovacuum_enabled = false)',
+    'bench_rh_append':
+        'CREATE TABLE bench_rh_append (id serial PRIMARY KEY, '
+        'content varchar, last_action date) '
+        'WITH (autovacuum_enabled = false)',
+    'bench_rh_append_history':
+        'CREATE TABLE bench_rh_append_history (id serial PRIMARY KEY, '
+        'request_id integer, author integer, content varchar, date date) '
+        'WITH (autovacuum_enabled = false)'
+}
+
+
+async def json_rewrite(connection, content: str):
+    request_rh = (await connection.execute(text(
+        'SELECT id, content_history FROM bench_rh_json WHERE id = 1'
+    ))).mappings().one()
+    request_rh['content_history'].append(
+        {'author': 1, 'content': content, 'date': date.today().isoformat()})
+    await connection.execute(text('''
+        UPDATE bench_rh_json
+        SET content = :content, last_action = :last_action,
+            content_history = :content_history
+        WHERE id = 1
+    '''), {'content': content, 'last_action': date.today(),
+           'content_history': json.dumps(request_rh['content_history'])})
+
+
+async def append(connection, content: str):
+    await connection.execute(text('''
+        WITH request_rh AS (
+            UPDATE bench_rh_append
+            SET content = :content, last_action = :last_action
+            WHERE id = 1
+            RETURNING id
+        )
+        INSERT INTO bench_rh_append_history (request_id, author, content, date)
+        SELECT id, 1, :content, :last_action FROM request_rh
+    '''), {'content': content, 'last_action': date.today()})
+
+
+async def table_stats(connection, tables: list) -> tuple:
+    size = 0
+    dead = 0
+    for table in tables:
+        size += (await connection.execute(text(
+            f"SELECT pg_total_relation_size('{table}')"))).scalar_one()
+        dead += (await connection.execute(text(
+            'SELECT n_dead_tup FROM pg_stat_user_tables '
+            'WHERE relname = :table'), {'table': table})).scalar_one()
+    return size, dead
+
+
+async def main(edits: int, content_size: int):
+    engine = get_engine()
+    content = 'x' * content_size
+
+    async with engine.begin() as connection:
+        for table, create in TABLES.items():
+            await connection.execute(text(f'DROP TABLE IF EXISTS {table}'))
+            await connection.execute(text(create))
+        await connection.execute(text(
+            "INSERT INTO bench_rh_json (content, last_action, content_history) "
+            "VALUES ('', current_date, '[]')"))
+        await connection.execute(text(
+            "INSERT INTO bench_rh_append (content, last_action) "
+            "VALUES ('', current_date)"))
+        await connection.execute(text(
+            'CREATE INDEX ON bench_rh_append_history (request_id, date, id)'))
+
+    try:
+        for name, edit, tables in [
+                ('JSON rewrite', json_rewrite, ['bench_rh_json']),
+                ('append-only', append,
+                 ['bench_rh_append', 'bench_rh_append_history'])]:
+            latencies = []
+            for _ in range(edits):
+                start = time.perf_counter()
+                async with engine.begin() as connection:
+                    await edit(connection, content)
+                latencies.append(time.perf_counter() - start)
+
+            # Let the statistics collector catch up before reading n_dead_tup
+            await asyncio.sleep(1)
+            async with engine.begin() as connection:
+                size, dead = await table_stats(connection, tables)
+
+            first = latencies[:edits // 10]
+            last = latencies[-(edits // 10):]
+            print(f'{name:<14} '
+                  f'first p50 {percentile(first, 50) * 1000:>7.2f} ms '
+                  f'last p50 {percentile(last, 50) * 1000:>7.2f} ms '
+                  f'p99 {percentile(latencies, 99) * 1000:>7.2f} ms '
+                  f'size {size / 1024:>9.0f} KiB dead tuples {dead}')
+    finally:
+        async with engine.begin() as connection:
+            for table in TABLES:
+                await connection.execute(text(f'DROP TABLE IF EXISTS {table}'))
+        await engine.dispose()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--edits', type=int, default=1000)
+    parser.add_argument('--content-size', type=int, default=200)
+    args = parser.parse_args()
+
+    asyncio.run(main(args.edits, args.content_size))
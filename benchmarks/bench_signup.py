@@ -0,0 +1,106 @@
+'''
+Signup latency as the users table grows: the former user_exists SELECT
+followed by an INSERT on an unindexed email column, against a single
+INSERT ... ON CONFLICT on a unique email index.
+
+Both strategies run on scratch copies of the users table, grown to each
+size with generate_series, and are dropped at the end.
+
+Usage:
+    python benchmarks/bench_signup.py [--sizes 10000 100000 1000000]
+'''
+import argparse
+import asyncio
+import time
+import uuid
+from sqlalchemy import text
+
+import common  # Loads protorh.env and adds src/ to the path
+from common import percentile
+from database_controller import get_engine
+
+TABLES = {
+    'bench_signup_select_insert':
+        'CREATE TABLE bench_signup_select_insert '
+        '(id serial PRIMARY KEY, email varchar, password varchar)',
+    'bench_signup_on_conflict':
+        'CREATE TABLE bench_signup_on_conflict '
+        '(id serial PRIMARY KEY, email varchar UNIQUE, password varchar)'
+}
+
+
+async def select_insert(connection, email: str):
+    exists = (await connection.execute(text(
+        'SELECT id FROM bench_signup_select_insert WHERE email = :email'),
+        {'email': email})).fetchone()
+    if exists is None:
+        await connection.execute(text(
+            'INSERT INTO bench_signup_select_insert (email, password) '
+            'VALUES (:email, :password)'),
+            {'email': email, 'password': 'x'})
+
+
+async def on_conflict(connection, email: str):
+    await connection.execute(text(
+        'INSERT INTO bench_signup_on_conflict (email, password) '
+        'VALUES (:email, :password) ON CONFLICT (email) DO NOTHING '
+        'RETURNING id'), {'email': email, 'password': 'x'})
+
+
+async def grow(engine, size: int):
+    async with engine.begin() as connection:
+        for table in TABLES:
+            current = (await connection.execute(
+                text(f'SELECT count(*) FROM {table}'))).scalar_one()
+            await connection.execute(text(f'''
+                INSERT INTO {table} (email, password)
+                SELECT 'seed-' || n || '@protorh.local', 'x'
+                FROM generate_series(CAST(:start AS integer),
+                                     CAST(:stop AS integer)) AS n
+            '''), {'start': current + 1, 'stop': size})
+            await connection.execute(text(f'ANALYZE {table}'))
+
+
+async def measure(engine, signup, samples: int) -> list:
+    latencies = []
+    for _ in range(samples):
+        email = f'{uuid.uuid4().hex}@protorh.local'
+        start = time.perf_counter()
+        async with engine.begin() as connection:
+            await signup(connection, email)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+async def main(sizes: list, samples: int):
+    engine = get_engine()
+
+    async with engine.begin() as connection:
+        for table, create in TABLES.items():
+            await connection.execute(text(f'DROP TABLE IF EXISTS {table}'))
+            await connection.execute(text(create))
+
+    try:
+        for size in sorted(sizes):
+            await grow(engine, size)
+            for name, signup in [('SELECT + INSERT', select_insert),
+                                 ('INSERT ON CONFLICT', on_conflict)]:
+                latencies = await measure(engine, signup, samples)
+                print(f'{size:>9} rows {name:<20} '
+                      f'p50 {percentile(latencies, 50) * 1000:>8.2f} ms '
+                      f'p99 {percentile(latencies, 99) * 1000:>8.2f} ms')
+    finally:
+        async with engine.begin() as connection:
+            for table in TABLES:
+                await connection.execute(text(f'DROP TABLE IF EXISTS {table}'))
+        await engine.dispose()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[10000, 100000, 1000000])
+    parser.add_argument('--samples', type=int, default=200)
+    args = parser.parse_args()
+
+    asyncio.run(main(args.sizes, args.samples))
@@ -0,0 +1,587 @@
+'''
+Load test of every endpoint of the API, saved as JSON to compare runs.
+
+seed fills the database with synthetic users, departments and requests rh
+(idempotent: only the missing rows are added). run seeds, then drives each
+endpoint at each concurrency level against a running API (see run.sh) and
+reports the RPS, the p50/p95/p99 latencies and the SQL statements per
+request, read from the http_request_queries histogram of /metrics (exact
+with a single API worker). compare prints the changes between two saved
+runs and exits with status 1 when one regressed: RPS or p95 latency
+changed beyond the threshold, more errors, or at least one more SQL
+statement per request.
+
+Usage:
+    python benchmarks/bench_suite.py seed [--users 10000] [--departments 100]
+        [--requests-rh 10000]
+    python benchmarks/bench_suite.py run [--concurrency 1 10 50]
+        [--requests 200] [--scenario NAME] [--output FILE] [seed options]
+    python benchmarks/bench_suite.py compare BASE NEW [--threshold 10]
+'''
+import io
+import os
+import re
+import sys
+import json
+import random
+import argparse
+import asyncio
+import datetime
+import itertools
+import subprocess
+import uuid
+import httpx
+from PIL import Image
+from sqlalchemy import text
+
+from common import (BASE_URL, BENCH_EMAIL, BENCH_PASSWORD, ensure_admin,
+                    get_sync_engine, print_report, root_dir, run_load)
+
+RESULTS_DIR = os.path.join(root_dir, 'benchmarks', 'results')
+
+# Every seeded row is recognizable by these prefixes
+USER_PREFIX = 'suite-user-'
+DEPARTMENT_PREFIX = 'suite-department-'
+REQUEST_RH_PREFIX = 'suite request '
+
+FIRSTNAMES = ['Camille', 'Léa', 'Manon', 'Chloé', 'Emma', 'Inès', 'Jade',
+              'Louise', 'Lucas', 'Hugo', 'Louis', 'Nathan', 'Gabriel',
+              'Arthur', 'Jules', 'Raphaël', 'Adam', 'Paul', 'Zoé', 'Marius']
+
+LASTNAMES = ['Martin', 'Bernard', 'Thomas', 'Petit', 'Robert', 'Richard',
+             'Durand', 'Dubois', 'Moreau', 'Laurent', 'Simon', 'Michel',
+             'Lefebvre', 'Leroy', 'Roux', 'David', 'Bertrand', 'Morel',
+             'Fournier', 'Girard']
+
+# Users sent by each /user/bulk_create and membership request
+BATCH_SIZE = 50
+
+QUERIES_SAMPLE = re.compile(
+    r'^http_request_queries_(sum|count)\{(.*)\} (\S+)$', re.MULTILINE)
+LABEL = re.compile(r'(\w+)="((?:[^"\\]|\\.)*)"')
+
+
+def seed(users: int, departments: int, requests_rh: int, history: int):
+    '''
+    Add the seeded rows missing from the database: users, departments
+    holding every user once, and requests rh of random users with history
+    entries.
+    Args:
+        users (int): Number of seeded users.
+        departments (int): Number of seeded departments.
+        requests_rh (int): Number of seeded requests rh.
+        history (int): History entries of each new request rh.
+    '''
+
+    engine = get_sync_engine()
+    with engine.begin() as connection:
+        connection.execute(text('''
+            INSERT INTO users (email, password, firstname, lastname,
+                birthday_date, adress, postal_code, age, registration_date,
+                token, role)
+            SELECT :prefix || n || '@protorh.local', '',
+                   firstnames[1 + n % 20], lastnames[1 + n / 20 % 20],
+                   to_char(birthday, 'YYYY-MM-DD'), n || ' rue du Benchmark',
+                   lpad(CAST(n % 100000 * 7919 % 100000 AS varchar), 5, '0'),
+                   CAST(date_part('year', age(birthday)) AS integer),
+                   current_date, md5(:prefix || n), 'user'
+            FROM generate_series(1, CAST(:users AS integer)) AS n,
+                 LATERAL (SELECT DATE '1960-01-01' + n % 15000 AS birthday)
+                     AS birthdays,
+                 (SELECT CAST(:firstnames AS varchar[]) AS firstnames,
+                         CAST(:lastnames AS varchar[]) AS lastnames) AS names
+            ON CONFLICT (email) DO NOTHING
+        '''), {'users': users, 'prefix': USER_PREFIX,
+               'firstnames': FIRSTNAMES, 'lastnames': LASTNAMES})
+
+        connection.execute(text('''
+            INSERT INTO departments (name)
+            SELECT :prefix || n
+            FROM generate_series(1, CAST(:departments AS integer)) AS n
+            WHERE NOT EXISTS (SELECT FROM departments
+                              WHERE name = :prefix || n)
+        '''), {'departments': departments, 'prefix': DEPARTMENT_PREFIX})
+
+        connection.execute(text('''
+            WITH suite_users AS (
+                SELECT id, row_number() OVER (ORDER BY id) AS n
+                FROM users WHERE email LIKE :user_prefix || '%'
+            ), suite_departments AS (
+                SELECT id, row_number() OVER (ORDER BY id) AS n
+                FROM departments WHERE name LIKE :department_prefix || '%'
+            )
+            INSERT INTO user_department (user_id, department_id)
+            SELECT suite_users.id, suite_departments.id
+            FROM suite_users
+            JOIN suite_departments
+                ON suite_departments.n = 1 + suite_users.n % :departments
+            ON CONFLICT (user_id, department_id) DO NOTHING
+        '''), {'user_prefix': USER_PREFIX,
+               'department_prefix': DEPARTMENT_PREFIX,
+               'departments': departments})
+
+        connection.execute(text('''
+            UPDATE departments
+            SET member_count = (SELECT count(*) FROM user_department
+                                WHERE department_id = departments.id)
+            WHERE name LIKE :prefix || '%'
+        '''), {'prefix': DEPARTMENT_PREFIX})
+
+        existing = connection.execute(text('''
+            SELECT count(*) FROM requests_rh WHERE content LIKE :prefix || '%'
+        '''), {'prefix': REQUEST_RH_PREFIX}).scalar_one()
+
+        connection.execute(text('''
+            WITH suite_users AS (
+                SELECT array_agg(id ORDER BY id) AS ids
+                FROM users WHERE email LIKE :user_prefix || '%'
+            ), inserted AS (
+                INSERT INTO requests_rh (user_id, content, registration_date,
+                    visibility, close, last_action)
+                SELECT ids[1 + n % cardinality(ids)], :prefix || n,
+                       current_date - n % 300, TRUE, n % 4 = 0,
+                       current_date - n % 300
+                FROM generate_series(CAST(:first AS integer),
+                                     CAST(:requests_rh AS integer)) AS n,
+                     suite_users
+                RETURNING id, user_id, content, last_action
+            )
+            INSERT INTO requests_rh_history (request_id, author, content, date)
+            SELECT id, user_id, content || ' v' || version, last_action
+            FROM inserted, generate_series(1, CAST(:history AS integer))
+                AS version
+        '''), {'user_prefix': USER_PREFIX, 'prefix': REQUEST_RH_PREFIX,
+               'first': existing + 1, 'requests_rh': requests_rh,
+               'history': history})
+
+        connection.execute(text(
+            'ANALYZE users, departments, user_department, requests_rh, '
+            'requests_rh_history'))
+    engine.dispose()
+
+
+def seeded_ids() -> dict:
+    '''
+    Return the ids of the seeded users, departments and requests rh.
+    '''
+
+    engine = get_sync_engine()
+    with engine.connect() as connection:
+        ids = {
+            'users': connection.execute(text(
+                "SELECT id FROM users WHERE email LIKE :prefix || '%'"),
+                {'prefix': USER_PREFIX}).scalars().all(),
+            'departments': connection.execute(text(
+                "SELECT id FROM departments WHERE name LIKE :prefix || '%'"),
+                {'prefix': DEPARTMENT_PREFIX}).scalars().all(),
+            'requests_rh': connection.execute(text(
+                "SELECT id FROM requests_rh WHERE content LIKE :prefix || '%'"),
+                {'prefix': REQUEST_RH_PREFIX}).scalars().all()
+        }
+    engine.dispose()
+
+    return ids
+
+
+def create_departments(count: int) -> list:
+    '''
+    Create empty departments for /departements/{department_id}/remove and
+    return their ids.
+    '''
+
+    engine = get_sync_engine()
+    with engine.begin() as connection:
+        ids = connection.execute(text('''
+            INSERT INTO departments (name)
+            SELECT 'suite-removed-' || n FROM generate_series(1, CAST(:count AS integer)) AS n
+            RETURNING id
+        '''), {'count': count}).scalars().all()
+    engine.dispose()
+
+    return ids
+
+
+def make_picture() -> bytes:
+    picture = Image.effect_noise((800, 600), 64).convert('RGB')
+    picture_bytes = io.BytesIO()
+    picture.save(picture_bytes, 'JPEG', quality=90)
+    return picture_bytes.getvalue()
+
+
+class Scenario:
+    '''
+    Requests sent to one endpoint.
+    '''
+
+    def __init__(self, name: str, method: str, route: str, make_request,
+                 prepare=None):
+        '''
+        Args:
+            name (str): Name of the scenario in the reports.
+            method (str): HTTP method of the endpoint.
+            route (str): Route template of the endpoint, as labelled in
+                /metrics.
+            make_request (callable): Coroutine function taking the client
+                and the index of the request, or the item prepared for it,
+                and returning an httpx.Response.
+            prepare (callable): Function taking the number of requests and
+                returning one item per request, called before each run.
+        '''
+
+        self.name = name
+        self.method = method
+        self.route = route
+        self.make_request = make_request
+        self.prepare = prepare
+
+
+def build_scenarios(admin: dict, ids: dict) -> list:
+    '''
+    Build the scenarios of every endpoint, requests being sent as the
+    benchmark admin on the seeded rows.
+    '''
+
+    headers = {'Authorization': f"Bearer {admin['jwt']}"}
+    run = uuid.uuid4().hex[:8]
+    users = ids['users']
+    departments = ids['departments']
+    requests_rh = ids['requests_rh']
+    picture = make_picture()
+    # Request indexes start over at each run of a scenario
+    created = itertools.count()
+
+    def new_user() -> dict:
+        return {'email': f'suite-created-{run}-{next(created)}@protorh.local',
+                'password': 'suite-password',
+                'firstname': 'Suite',
+                'lastname': 'Created',
+                'birthday_date': '1990-01-01',
+                'adress': '1 rue du Benchmark',
+                'postal_code': '75000'}
+
+    def bulk_body() -> str:
+        return '\n'.join(json.dumps(new_user()) for _ in range(BATCH_SIZE))
+
+    def get(route: str, **params):
+        return lambda client, index: client.get(route, params=params,
+                                                headers=headers)
+
+    return [
+        Scenario('GET /hello', 'GET', '/hello',
+                 get('/hello')),
+        Scenario('GET /metrics', 'GET', '/metrics',
+                 get('/metrics')),
+        Scenario('POST /user/create', 'POST', '/user/create',
+                 lambda client, index: client.post(
+                     '/user/create', json=new_user())),
+        Scenario('POST /user/bulk_create', 'POST', '/user/bulk_create',
+                 lambda client, index: client.post(
+                     '/user/bulk_create', content=bulk_body(),
+                     headers={**headers,
+                              'Content-Type': 'application/x-ndjson'})),
+        Scenario('POST /connect', 'POST', '/connect',
+                 lambda client, index: client.post(
+                     '/connect', json={'email': BENCH_EMAIL,
+                                       'password': BENCH_PASSWORD})),
+        Scenario('GET /user/{user_id}', 'GET', '/user/{user_id}',
+                 lambda client, index: client.get(
+                     f'/user/{random.choice(users)}', headers=headers)),
+        Scenario('GET /users', 'GET', '/users',
+                 lambda client, index: client.get(
+                     '/users', headers=headers, params={'ids': ','.join(
+                         str(user_id) for user_id
+                         in random.sample(users, BATCH_SIZE))})),
+        Scenario('GET /users/search prefix', 'GET', '/users/search',
+                 get('/users/search', q='mar', mode='prefix')),
+        Scenario('GET /users/search fulltext', 'GET', '/users/search',
+                 get('/users/search', q='zoé mor', mode='fulltext')),
+        Scenario('POST /user/update', 'POST', '/user/update',
+                 lambda client, index: client.post(
+                     '/user/update', headers=headers,
+                     json={'id': random.choice(users),
+                           'firstname': f'Suite {index}'})),
+        Scenario('POST /user/password', 'POST', '/user/password',
+                 lambda client, index: client.post(
+                     '/user/password', json={
+                         'email': BENCH_EMAIL, 'password': BENCH_PASSWORD,
+                         'new_password': BENCH_PASSWORD,
+                         'repeat_new_password': BENCH_PASSWORD})),
+        Scenario('POST /upload/picture/user/{user_id}', 'POST',
+                 '/upload/picture/user/{user_id}',
+                 lambda client, index: client.post(
+                     f"/upload/picture/user/{admin['id']}",
+                     files={'file': ('suite.jpg', picture, 'image/jpeg')})),
+        Scenario('GET /picture/user/{user_id}', 'GET',
+                 '/picture/user/{user_id}',
+                 get(f"/picture/user/{admin['id']}")),
+        Scenario('POST /departements/create', 'POST', '/departements/create',
+                 lambda client, index: client.post(
+                     '/departements/create', headers=headers,
+                     json={'name': f'suite-created-{run}-{index}'})),
+        Scenario('GET /departements', 'GET', '/departements',
+                 get('/departements')),
+        Scenario('GET /departements/stats', 'GET', '/departements/stats',
+                 get('/departements/stats')),
+        Scenario('GET /departements/{department_id}', 'GET',
+                 '/departements/{department_id}',
+                 lambda client, index: client.get(
+                     f'/departements/{random.choice(departments)}',
+                     headers=headers)),
+        Scenario('POST /departements/{department_id}/update', 'POST',
+                 '/departements/{department_id}/update',
+                 lambda client, index: client.post(
+                     f'/departements/{random.choice(departments)}/update',
+                     headers=headers,
+                     json={'name': f'{DEPARTMENT_PREFIX}{index}'})),
+        Scenario('POST /departements/{department_id}/remove', 'POST',
+                 '/departements/{department_id}/remove',
+                 lambda client, department_id: client.post(
+                     f'/departements/{department_id}/remove',
+                     headers=headers),
+                 prepare=create_departments),
+        Scenario('POST /departements/{department_id}/users/add', 'POST',
+                 '/departements/{department_id}/users/add',
+                 lambda client, index: client.post(
+                     f'/departements/{random.choice(departments)}/users/add',
+                     headers=headers,
+                     json={'user_ids': random.sample(users, BATCH_SIZE)})),
+        Scenario('POST /departements/{department_id}/users/remove', 'POST',
+                 '/departements/{department_id}/users/remove',
+                 lambda client, index: client.post(
+                     f'/departements/{random.choice(departments)}'
+                     '/users/remove', headers=headers,
+                     json={'user_ids': random.sample(users, BATCH_SIZE)})),
+        Scenario('GET /departements/{department_id}/users', 'GET',
+                 '/departements/{department_id}/users',
+                 lambda client, index: client.get(
+                     f'/departements/{random.choice(departments)}/users',
+                     headers=headers)),
+        Scenario('GET /user/{user_id}/departements', 'GET',
+                 '/user/{user_id}/departements',
+                 lambda client, index: client.get(
+                     f'/user/{random.choice(users)}/departements',
+                     headers=headers)),
+        Scenario('POST /rh/msg/add', 'POST', '/rh/msg/add',
+                 lambda client, index: client.post(
+                     '/rh/msg/add', headers=headers,
+                     json={'user_id': random.choice(users),
+                           'content': f'suite added {index}'})),
+        Scenario('POST /rh/msg/update', 'POST', '/rh/msg/update',
+                 lambda client, index: client.post(
+                     '/rh/msg/update', headers=headers,
+                     json={'id': random.choice(requests_rh),
+                           'content': f'{REQUEST_RH_PREFIX}{index}'})),
+        Scenario('POST /rh/msg/remove', 'POST', '/rh/msg/remove',
+                 lambda client, index: client.post(
+                     '/rh/msg/remove', headers=headers,
+                     json={'id': random.choice(requests_rh)})),
+        Scenario('GET /rh/msg/{request_id}/history', 'GET',
+                 '/rh/msg/{request_id}/history',
+                 lambda client, index: client.get(
+                     f'/rh/msg/{random.choice(requests_rh)}/history',
+                     headers=headers)),
+        Scenario('GET /rh/msg/', 'GET', '/rh/msg/',
+                 get('/rh/msg/'))
+    ]
+
+
+def scrape_queries(client: httpx.Client) -> dict:
+    '''
+    Return the sum and count of the http_request_queries histogram of each
+    method and route.
+    '''
+
+    response = client.get('/metrics')
+    response.raise_for_status()
+
+    samples = {}
+    for suffix, labels, value in QUERIES_SAMPLE.findall(response.text):
+        labels = dict(LABEL.findall(labels))
+        key = (labels.get('method'), labels.get('route'))
+        samples.setdefault(key, {'sum': 0.0, 'count': 0.0})[suffix] = float(
+            value)
+
+    return samples
+
+
+async def run_scenario(scenario: Scenario, concurrency: int,
+                       total: int) -> dict:
+    '''
+    Run a scenario and return its report with the SQL statements per
+    request, None if no request of the scenario was recorded.
+    '''
+
+    items = scenario.prepare(total) if scenario.prepare else range(total)
+    pending = iter(items)
+
+    with httpx.Client(base_url=BASE_URL, timeout=60) as client:
+        before = scrape_queries(client)
+        report = await run_load(
+            lambda client: scenario.make_request(client, next(pending)),
+            concurrency, total)
+        after = scrape_queries(client)
+
+    key = (scenario.method, scenario.route)
+    empty = {'sum': 0.0, 'count': 0.0}
+    queries = after.get(key, empty)['sum'] - before.get(key, empty)['sum']
+    count = after.get(key, empty)['count'] - before.get(key, empty)['count']
+    # The /metrics scrape made after the run is recorded after it answers
+    if scenario.route == '/metrics':
+        count -= 1
+
+    report['queries_per_request'] = queries / count if count > 0 else None
+
+    return report
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                              cwd=root_dir, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def run(args) -> int:
+    # The same rows are requested by every run
+    random.seed(0)
+    seed(args.users, args.departments, args.requests_rh, args.history)
+    admin = ensure_admin()
+    ids = seeded_ids()
+
+    scenarios = build_scenarios(admin, ids)
+    if args.scenario:
+        scenarios = [scenario for scenario in scenarios
+                     if any(name in scenario.name for name in args.scenario)]
+
+    # Served by GET /picture/user/{user_id}
+    with httpx.Client(base_url=BASE_URL, timeout=60) as client:
+        client.post(f"/upload/picture/user/{admin['id']}",
+                    files={'file': ('suite.jpg', make_picture(),
+                                    'image/jpeg')}).raise_for_status()
+
+    results = []
+    for concurrency in args.concurrency:
+        print(f'{concurrency} concurrent clients, {args.requests} requests '
+              'per scenario')
+        for scenario in scenarios:
+            report = await run_scenario(scenario, concurrency, args.requests)
+            print_report(scenario.name, report)
+            results.append({'scenario': scenario.name,
+                            'concurrency': concurrency, **report})
+
+    output = args.output or os.path.join(
+        RESULTS_DIR,
+        f"suite-{datetime.datetime.now().strftime('%Y%m%d-%H%M%S')}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as file:
+        json.dump({'date': datetime.datetime.now().isoformat(),
+                   'commit': git_commit(),
+                   'base_url': BASE_URL,
+                   'scale': {'users': args.users,
+                             'departments': args.departments,
+                             'requests_rh': args.requests_rh,
+                             'history': args.history},
+                   'requests': args.requests,
+                   'results': results}, file, indent=2)
+    print(f'Results saved to {output}')
+
+    return 0
+
+
+def change(base: float, new: float) -> float:
+    '''
+    Return the relative change from base to new in percent.
+    '''
+
+    if not base:
+        return 0.0
+
+    return (new - base) / base * 100
+
+
+async def compare(args) -> int:
+    with open(args.base) as file:
+        base = json.load(file)
+    with open(args.new) as file:
+        new = json.load(file)
+
+    print(f"base {base.get('commit')} {base['date']}, "
+          f"new {new.get('commit')} {new['date']}")
+    if base.get('scale') != new.get('scale'):
+        print('Warning: the runs were seeded at different scales')
+
+    base_results = {(result['scenario'], result['concurrency']): result
+                    for result in base['results']}
+    regressions = 0
+
+    for result in new['results']:
+        previous = base_results.get((result['scenario'],
+                                     result['concurrency']))
+        if previous is None:
+            continue
+
+        rps = change(previous['rps'], result['rps'])
+        p95 = change(previous['p95_ms'], result['p95_ms'])
+        queries = previous['queries_per_request'], result['queries_per_request']
+        regressed = (rps < -args.threshold or p95 > args.threshold
+                     # Cache hits make fractions vary from run to run
+                     or (None not in queries and queries[1] >= queries[0] + 1)
+                     or result['errors'] > previous['errors'])
+        regressions += regressed
+
+        queries = ' -> '.join('-' if value is None else f'{value:.1f}'
+                              for value in queries)
+        print(f"{result['scenario']:<48} c{result['concurrency']:<4} "
+              f"rps {result['rps']:>8.1f} ({rps:+6.1f}%) "
+              f"p95 {result['p95_ms']:>8.2f} ms ({p95:+6.1f}%) "
+              f"queries {queries:<12}"
+              + (' REGRESSION' if regressed else ''))
+
+    print(f'{regressions} regressions beyond {args.threshold}%')
+
+    return 1 if regressions else 0
+
+
+def add_seed_arguments(parser):
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--departments', type=int, default=100)
+    parser.add_argument('--requests-rh', type=int, default=10000)
+    parser.add_argument('--history', type=int, default=3)
+
+
+async def seed_command(args) -> int:
+    seed(args.users, args.departments, args.requests_rh, args.history)
+    print('Database seeded')
+    return 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(required=True)
+
+    seed_parser = subparsers.add_parser('seed')
+    add_seed_arguments(seed_parser)
+    seed_parser.set_defaults(func=seed_command)
+
+    run_parser = subparsers.add_parser('run')
+    add_seed_arguments(run_parser)
+    run_parser.add_argument('--concurrency', type=int, nargs='+',
+                            default=[1, 10, 50])
+    run_parser.add_argument('--requests', type=int, default=200)
+    run_parser.add_argument('--scenario', action='append',
+                            help='Only run the scenarios containing this '
+                                 'text, can be repeated')
+    run_parser.add_argument('--output')
+    run_parser.set_defaults(func=run)
+
+    compare_parser = subparsers.add_parser('compare')
+    compare_parser.add_argument('base')
+    compare_parser.add_argument('new')
+    compare_parser.add_argument('--threshold', type=float, default=10,
+                                help='Tolerated change of RPS and p95 in %%')
+    compare_parser.set_defaults(func=compare)
+
+    args = parser.parse_args()
+    sys.exit(asyncio.run(args.func(args)))
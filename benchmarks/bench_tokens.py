@@ -0,0 +1,56 @@
+'''
+Compare the per-character djb2 loop of gen_token with the batched
+gen_tokens on synthetic user records, and check both agree bit for bit.
+
+Usage:
+    python benchmarks/bench_tokens.py [--users 100000]
+'''
+import os
+import argparse
+import random
+import string
+import time
+
+import common  # Loads protorh.env and adds src/ to the path
+from token_controller import gen_tokens
+
+
+def gen_token(email: str, firstname: str, lastname: str, salt: str) -> int:
+    hash_code = 5381
+    for char in email + firstname + lastname + salt:
+        hash_code = (hash_code * 33) ^ ord(char)
+    return hash_code & 0xFFFFFFFF
+
+
+def random_word(low: int, high: int) -> str:
+    return ''.join(random.choices(string.ascii_letters + 'éèàç',
+                                  k=random.randint(low, high)))
+
+
+def main(users: int):
+    salt = os.getenv('salt')
+    records = [(f'{random_word(5, 20)}@{random_word(3, 10)}.fr',
+                random_word(3, 12), random_word(3, 15))
+               for _ in range(users)]
+
+    start = time.perf_counter()
+    expected = [gen_token(*record, salt) for record in records]
+    loop = time.perf_counter() - start
+
+    start = time.perf_counter()
+    tokens = gen_tokens(records, salt)
+    batch = time.perf_counter() - start
+
+    assert tokens == expected, 'gen_tokens differs from gen_token'
+
+    print(f'{users} users')
+    print(f'gen_token loop {loop * 1000:>10.1f} ms')
+    print(f'gen_tokens     {batch * 1000:>10.1f} ms ({loop / batch:.1f}x)')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=100000)
+    args = parser.parse_args()
+
+    main(args.users)
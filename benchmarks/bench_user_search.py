@@ -0,0 +1,202 @@
+'''
+Latency of the user search on a synthetic table of a million users: the
+unindexed substring scan a client-side filter amounts to, against the
+prefix, full-text and fuzzy (when pg_trgm is installed) modes of
+/users/search, backed by the indexes declared on the User model.
+
+Each query is run with its matches materialized through the search
+indexes then sorted by id (the plan of the fulltext and fuzzy modes) and
+with the ORDER BY id LIMIT plan Postgres picks on its own (the plan of
+the prefix mode), which walks the primary key when it overestimates the
+matches. The scratch table is dropped at the end.
+
+Before timing, checks that the full-text and fuzzy searches of non-admins
+don't match postal codes.
+
+Usage:
+    python benchmarks/bench_user_search.py [--users 1000000] [--repeat 20]
+'''
+import argparse
+import asyncio
+import time
+from sqlalchemy import MetaData, text
+from sqlalchemy.schema import CreateIndex
+
+import common  # Loads protorh.env and adds src/ to the path
+from common import percentile
+from database_controller import get_engine
+from search_controller import SEARCH_COLUMNS, user_search_condition
+from classes.user import User
+
+TABLE = 'bench_search_users'
+
+FIRSTNAMES = ['Camille', 'Léa', 'Manon', 'Chloé', 'Emma', 'Inès', 'Jade',
+              'Louise', 'Lucas', 'Hugo', 'Louis', 'Nathan', 'Gabriel',
+              'Arthur', 'Jules', 'Raphaël', 'Adam', 'Paul', 'Zoé', 'Marius']
+
+LASTNAMES = ['Martin', 'Bernard', 'Thomas', 'Petit', 'Robert', 'Richard',
+             'Durand', 'Dubois', 'Moreau', 'Laurent', 'Simon', 'Michel',
+             'Lefebvre', 'Leroy', 'Roux', 'David', 'Bertrand', 'Morel',
+             'Fournier', 'Girard']
+
+# Searched text of each scenario, by mode
+SEARCHES = [
+    ('prefix', 'common prefix', 'ma'),
+    ('prefix', 'rare prefix', 'lucas.lefebvre.4248'),
+    ('prefix', 'no match', 'xyz'),
+    ('fulltext', 'first and last name', 'zoé mor'),
+    ('fulltext', 'postal code', '39912'),
+    ('fulltext', 'no match', 'xyz'),
+    ('fuzzy', 'typo', 'lefebre'),
+    ('fuzzy', 'no match', 'xyzw')
+]
+
+
+def scan_condition(query: str) -> tuple:
+    '''
+    Condition of a substring search, which no btree index can serve.
+    '''
+
+    condition = ' OR '.join(f'lower({column}) LIKE :pattern'
+                            for column in SEARCH_COLUMNS)
+    return f'({condition})', {'pattern': f'%{query}%'}
+
+
+async def create_table(engine, users: int, trigram: bool):
+    table = User.__table__.to_metadata(MetaData(), name=TABLE)
+    # to_metadata doesn't copy the info of the indexes
+    needs_extension = {index.name for index in User.__table__.indexes
+                       if index.info.get('extension')}
+
+    async with engine.begin() as connection:
+        await connection.execute(text(f'DROP TABLE IF EXISTS {TABLE}'))
+        await connection.execute(text(f'''
+            CREATE TABLE {TABLE} (
+                id integer PRIMARY KEY, email varchar, firstname varchar,
+                lastname varchar, postal_code varchar)
+        '''))
+        await connection.execute(text(f'''
+            INSERT INTO {TABLE} (id, email, firstname, lastname, postal_code)
+            SELECT n, lower(firstnames[1 + n % 20] || '.' || lastnames[1 + n / 20 % 20]
+                            || '.' || n) || '@protorh.local',
+                   firstnames[1 + n % 20], lastnames[1 + n / 20 % 20],
+                   lpad(CAST(n % 100000 * 7919 % 100000 AS varchar), 5, '0')
+            FROM generate_series(1, CAST(:users AS integer)) AS n,
+                 (SELECT CAST(:firstnames AS varchar[]) AS firstnames,
+                         CAST(:lastnames AS varchar[]) AS lastnames) AS names
+        '''), {'users': users, 'firstnames': FIRSTNAMES,
+               'lastnames': LASTNAMES})
+
+        for index in table.indexes:
+            if 'prefix' not in index.name and 'search' not in index.name:
+                continue
+            if index.name in needs_extension and not trigram:
+                continue
+            index.name = index.name.replace('ix_users', f'ix_{TABLE}')
+            await connection.run_sync(
+                lambda sync, index=index: sync.execute(CreateIndex(index)))
+
+        await connection.execute(text(f'ANALYZE {TABLE}'))
+
+
+async def check_postal_codes_hidden(engine, trigram: bool):
+    '''
+    Search the postal code of users whose email doesn't contain it, which
+    only admins should find.
+    Raises:
+        AssertionError: If a non-admin search finds them, or an admin search
+            doesn't.
+    '''
+
+    async with engine.connect() as connection:
+        postal_code = (await connection.execute(text(
+            f'SELECT postal_code FROM {TABLE} ORDER BY id LIMIT 1')
+        )).scalar_one()
+
+        for mode in ('fulltext', 'fuzzy') if trigram else ('fulltext',):
+            for admin in (False, True):
+                condition, values = user_search_condition(mode, postal_code,
+                                                          admin)
+                values['postal_code'] = postal_code
+                found = (await connection.execute(text(f'''
+                    SELECT count(*) FROM {TABLE}
+                    WHERE {condition} AND postal_code = :postal_code
+                    AND position(:postal_code IN email) = 0
+                '''), values)).scalar_one()
+                assert (found > 0) == admin, (
+                    f'{mode} search of postal code {postal_code} by '
+                    f'{"an admin" if admin else "a non-admin"} found '
+                    f'{found} users')
+
+    print(f'Postal code {postal_code} found by admins only')
+
+
+async def measure(engine, query, values: dict, repeat: int) -> tuple:
+    latencies = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        async with engine.connect() as connection:
+            rows = (await connection.execute(query, values)).all()
+        latencies.append(time.perf_counter() - start)
+    return latencies, len(rows)
+
+
+async def main(users: int, repeat: int, limit: int):
+    engine = get_engine()
+
+    async with engine.connect() as connection:
+        trigram = (await connection.execute(text(
+            "SELECT count(*) FROM pg_extension WHERE extname = 'pg_trgm'")
+        )).scalar_one() > 0
+
+    start = time.perf_counter()
+    await create_table(engine, users, trigram)
+    print(f'{users} users seeded and indexed in '
+          f'{time.perf_counter() - start:.1f} s')
+
+    plans = {
+        'materialized': f'''
+            WITH matches AS MATERIALIZED (
+                SELECT id FROM {TABLE} WHERE {{condition}})
+            SELECT id FROM matches ORDER BY id LIMIT :limit''',
+        'order by id': f'''
+            SELECT id FROM {TABLE} WHERE {{condition}}
+            ORDER BY id LIMIT :limit'''
+    }
+
+    try:
+        await check_postal_codes_hidden(engine, trigram)
+
+        searches = [('scan', 'substring', 'ma'),
+                    ('scan', 'no match', 'xyz')] + SEARCHES
+        for mode, scenario, search in searches:
+            if mode == 'fuzzy' and not trigram:
+                print(f'{mode:<9} {scenario:<20} skipped, pg_trgm is not '
+                      'installed')
+                continue
+            if mode == 'scan':
+                condition, values = scan_condition(search)
+            else:
+                condition, values = user_search_condition(mode, search, True)
+            values['limit'] = limit
+            for plan, query in plans.items():
+                latencies, rows = await measure(
+                    engine, text(query.format(condition=condition)),
+                    values, repeat)
+                print(f'{mode:<9} {scenario:<20} {plan:<12} {rows:>4} rows '
+                      f'p50 {percentile(latencies, 50) * 1000:>9.2f} ms '
+                      f'p95 {percentile(latencies, 95) * 1000:>9.2f} ms')
+    finally:
+        async with engine.begin() as connection:
+            await connection.execute(text(f'DROP TABLE IF EXISTS {TABLE}'))
+        await engine.dispose()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=1000000)
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--limit', type=int, default=21)
+    args = parser.parse_args()
+
+    asyncio.run(main(args.users, args.repeat, args.limit))
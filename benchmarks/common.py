@@ -0,0 +1,146 @@
+'''
+Shared helpers for the ProtoRH benchmarks.
+'''
+import os
+import sys
+import math
+import time
+import asyncio
+import httpx
+from dotenv import load_dotenv
+from sqlalchemy import text
+
+root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.join(root_dir, 'src'))
+
+from database_controller import get_sync_engine
+
+load_dotenv(os.path.join(root_dir, 'protorh.env'))
+
+BASE_URL = os.getenv('PROTORH_URL', 'http://localhost:4242')
+
+BENCH_EMAIL = 'bench.admin@protorh.local'
+BENCH_PASSWORD = 'bench-password'
+
+
+def percentile(samples: list, q: float) -> float:
+    '''
+    Return the q-th percentile of samples (nearest rank).
+    Args:
+        samples (list): Measured values.
+        q (float): Percentile between 0 and 100.
+    Returns:
+        float: Percentile value, 0 if there is no sample.
+    '''
+
+    if not samples:
+        return 0.0
+
+    ordered = sorted(samples)
+    rank = max(0, min(len(ordered) - 1,
+                      math.ceil(q / 100 * len(ordered)) - 1))
+
+    return ordered[rank]
+
+
+def summarize(latencies: list, errors: int, elapsed: float) -> dict:
+    '''
+    Build a latency report from raw samples.
+    Args:
+        latencies (list): Request latencies in seconds.
+        errors (int): Number of failed requests.
+        elapsed (float): Wall time of the run in seconds.
+    Returns:
+        dict: Report with request count, RPS and percentiles in ms.
+    '''
+
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'rps': len(latencies) / elapsed if elapsed else 0.0,
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p95_ms': percentile(latencies, 95) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000
+    }
+
+
+async def run_load(make_request, concurrency: int, total: int) -> dict:
+    '''
+    Fire total requests with at most concurrency in flight.
+    Args:
+        make_request (callable): Coroutine function taking the client and
+            returning an httpx.Response.
+        concurrency (int): Number of concurrent clients.
+        total (int): Number of requests to send.
+    Returns:
+        dict: Report built by summarize().
+    '''
+
+    latencies = []
+    errors = 0
+    remaining = iter(range(total))
+    limits = httpx.Limits(max_connections=concurrency,
+                          max_keepalive_connections=concurrency)
+
+    async with httpx.AsyncClient(base_url=BASE_URL, limits=limits,
+                                 timeout=60) as client:
+        async def worker():
+            nonlocal errors
+            for _ in remaining:
+                start = time.perf_counter()
+                try:
+                    response = await make_request(client)
+                    if response.status_code >= 400:
+                        errors += 1
+                except httpx.HTTPError:
+                    errors += 1
+                latencies.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - start
+
+    return summarize(latencies, errors, elapsed)
+
+
+def print_report(name: str, report: dict):
+    '''
+    Print one report line.
+    '''
+
+    print(f"{name:<48} {report['requests']:>7} req "
+          f"{report['errors']:>5} err {report['rps']:>9.1f} rps "
+          f"p50 {report['p50_ms']:>8.2f} ms "
+          f"p95 {report['p95_ms']:>8.2f} ms "
+          f"p99 {report['p99_ms']:>8.2f} ms")
+
+
+def ensure_admin() -> dict:
+    '''
+    Create the benchmark admin user through the API if needed, promote it
+    to admin directly in the database and return its id and JWT.
+    '''
+
+    with httpx.Client(base_url=BASE_URL, timeout=60) as client:
+        client.post('/user/create', json={
+            'email': BENCH_EMAIL,
+            'password': BENCH_PASSWORD,
+            'firstname': 'Bench',
+            'lastname': 'Admin',
+            'birthday_date': '1990-01-01',
+            'adress': '1 rue du Benchmark',
+            'postal_code': '75000'
+        })
+
+        engine = get_sync_engine()
+        with engine.begin() as connection:
+            user_id = connection.execute(
+                text("UPDATE users SET role = 'admin' WHERE email = :email "
+                     "RETURNING id"), {'email': BENCH_EMAIL}).scalar_one()
+        engine.dispose()
+
+        response = client.post('/connect', json={'email': BENCH_EMAIL,
+                                                  'password': BENCH_PASSWORD})
+        response.raise_for_status()
+
+    return {'id': user_id, 'jwt': response.json()[0]}
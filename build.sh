@@ -27,4 +27,10 @@ sudo apt-get install curl python3 python3-pip uvicorn postgresql postgresql-clie
 
 # Installation des packages python
 echo -e '\e[34mInstallation des packages python\e[0m'
-pip3 install --break-system-packages -r requirements.txt
\ No newline at end of file
+pip3 install --break-system-packages -r requirements.txt
+
+# Installation des packages python destinés au développeur
+if [ "$developer_mode" -eq 1 ]; then
+    echo -e '\e[34mInstallation des packages python destinés au développeur\e[0m'
+    pip3 install --break-system-packages -r benchmarks/requirements.txt
+fi
\ No newline at end of file
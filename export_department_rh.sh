@@ -0,0 +1,6 @@
+#!/bin/bash
+
+read -p 'Your JWT: ' jwt
+read -p 'Department ID: ' department_id
+
+curl -s -H "Authorization: Bearer $jwt" "http://localhost:4242/rh/msg/?format=csv&department_id=$department_id" > requests_rh_department_$department_id.csv
@@ -2,4 +2,6 @@
 
 sudo service postgresql start
 
+python3 src/manage.py migrate || exit 1
+
 uvicorn src.main:app --port 4242 --reload
\ No newline at end of file
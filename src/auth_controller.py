@@ -0,0 +1,68 @@
+'''
+Allows for verifying JWTs with an in-process cache of verified tokens.
+'''
+import time
+from collections import OrderedDict
+import jwt
+
+from metrics_controller import jwt_decode
+
+
+class TokenVerifier:
+    '''
+    Verify HS256 JWTs and remember the claims of verified tokens until they
+    expire, so a token sent many times is only decoded once.
+    '''
+
+    def __init__(self, secret_key: str, max_size: int = 10000):
+        '''
+        Args:
+            secret_key (str): Key used to sign the tokens.
+            max_size (int): Maximum number of tokens kept in the cache.
+        '''
+
+        self.secret_key = secret_key
+        self.max_size = max_size
+        self.cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def verify(self, token: str) -> dict:
+        '''
+        Return the claims of a token, decoding it only on cache miss.
+        Args:
+            token (str): Encoded JWT.
+        Returns:
+            dict: Claims of the token.
+        Raises:
+            jwt.ExpiredSignatureError: If the token expired.
+            jwt.InvalidTokenError: If the token is invalid.
+        '''
+
+        cached = self.cache.get(token)
+
+        if cached is not None:
+            claims, expiration = cached
+            if expiration is None or time.time() < expiration:
+                self.cache.move_to_end(token)
+                self.hits += 1
+                return dict(claims)
+            del self.cache[token]
+
+        self.misses += 1
+        with jwt_decode.time():
+            claims = jwt.decode(token, self.secret_key, algorithms=['HS256'])
+
+        self.cache[token] = (claims, claims.get('exp'))
+        if len(self.cache) > self.max_size:
+            self.cache.popitem(last=False)
+
+        return dict(claims)
+
+    def stats(self) -> dict:
+        '''
+        Return the cache counters.
+        '''
+
+        return {'hits': self.hits, 'misses': self.misses,
+                'size': len(self.cache)}
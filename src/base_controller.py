@@ -1,11 +1,20 @@
 '''
 Allows for creating and obtaining a synchronized Base instance.
 '''
+from typing import Annotated
+from annotated_types import Interval
 from sqlalchemy.ext.declarative import declarative_base
 
 # Create the Base instance
 Base = declarative_base()
 
+# Range of the integer id columns. asyncpg refuses a value outside of it
+# (DataError) where Postgres would just find no row.
+MIN_ID = -2 ** 31
+MAX_ID = 2 ** 31 - 1
+# Id of a row, received in a path, a query or a body
+Id = Annotated[int, Interval(ge=MIN_ID, le=MAX_ID)]
+
 
 def get_base():
     '''
@@ -13,3 +22,19 @@ def get_base():
     '''
 
     return Base
+
+
+def select_columns(model, table: str = None) -> str:
+    '''
+    Return the columns matching the fields of a response model, as a SQL
+    select list, so a query reads exactly what the response exposes.
+    Args:
+        model (type): Pydantic model whose fields are column names.
+        table (str): Table prefixed to each column, if any.
+    Returns:
+        str: Comma-separated columns.
+    '''
+
+    prefix = f'{table}.' if table else ''
+
+    return ', '.join(prefix + field for field in model.model_fields)
@@ -0,0 +1,301 @@
+'''
+Allows for caching read results, in process or in a shared memcached
+server, and for running a memcached stand-in for development.
+'''
+import os
+import json
+import time
+import asyncio
+from collections import OrderedDict
+from fastapi.encoders import jsonable_encoder
+
+from metrics_controller import cache_lookups, cache_invalidations
+
+# Cache shared by every request, created on first use
+cache = None
+
+
+class MemoryCache:
+    '''
+    In-process cache evicting the least recently used entries beyond
+    max_size, and entries older than their TTL.
+    '''
+
+    def __init__(self, ttl: float = 60, max_size: int = 10000):
+        '''
+        Args:
+            ttl (float): Seconds an entry is kept.
+            max_size (int): Maximum number of entries.
+        '''
+
+        self.ttl = ttl
+        self.max_size = max_size
+        self.entries = OrderedDict()
+
+    async def get(self, key: str):
+        '''
+        Return the value of a key, None if it is missing or expired.
+        '''
+
+        entry = self.entries.get(key)
+
+        if entry is None:
+            return None
+
+        value, expiration = entry
+        if time.monotonic() >= expiration:
+            del self.entries[key]
+            return None
+
+        self.entries.move_to_end(key)
+
+        return value
+
+    async def set(self, key: str, value):
+        '''
+        Store the value of a key.
+        '''
+
+        self.entries[key] = (value, time.monotonic() + self.ttl)
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    async def delete(self, *keys: str):
+        '''
+        Remove keys.
+        '''
+
+        for key in keys:
+            self.entries.pop(key, None)
+
+
+class MemcachedCache:
+    '''
+    Cache shared between workers, stored in a memcached server (or the
+    stand-in of serve_memcached) through the text protocol. Values are
+    stored as JSON. A server that can't be reached behaves as an empty
+    cache.
+    '''
+
+    def __init__(self, host: str, port: int, ttl: float = 60,
+                 pool_size: int = 4):
+        '''
+        Args:
+            host (str): Host of the server.
+            port (int): Port of the server.
+            ttl (float): Seconds an entry is kept.
+            pool_size (int): Maximum number of open connections.
+        '''
+
+        self.host = host
+        self.port = port
+        self.ttl = ttl
+        self.connections = asyncio.LifoQueue()
+        self.slots = asyncio.Semaphore(pool_size)
+
+    async def command(self, request: bytes, read_response) -> object:
+        '''
+        Send a request on a pooled connection and read its response.
+        Args:
+            request (bytes): Request, terminators included.
+            read_response (callable): Coroutine function reading the
+                response from a StreamReader.
+        Returns:
+            Result of read_response, None if the server can't be reached.
+        '''
+
+        async with self.slots:
+            if self.connections.empty():
+                try:
+                    connection = await asyncio.open_connection(self.host,
+                                                               self.port)
+                except OSError:
+                    return None
+            else:
+                connection = self.connections.get_nowait()
+
+            reader, writer = connection
+            try:
+                writer.write(request)
+                result = await read_response(reader)
+            except (OSError, asyncio.IncompleteReadError, ValueError):
+                writer.close()
+                return None
+
+            self.connections.put_nowait(connection)
+
+            return result
+
+    async def get(self, key: str):
+        '''
+        Return the value of a key, None if it is missing.
+        '''
+
+        async def read_response(reader):
+            header = await reader.readuntil(b'\r\n')
+            if header == b'END\r\n':
+                return None
+            _, _, _, length = header.split()
+            data = await reader.readexactly(int(length) + 2)
+            await reader.readuntil(b'END\r\n')
+            return json.loads(data[:-2])
+
+        return await self.command(f'get {key}\r\n'.encode(), read_response)
+
+    async def set(self, key: str, value):
+        '''
+        Store the value of a key.
+        '''
+
+        data = json.dumps(jsonable_encoder(value)).encode()
+        request = (f'set {key} 0 {int(self.ttl)} {len(data)}\r\n'.encode()
+                   + data + b'\r\n')
+
+        async def read_response(reader):
+            return await reader.readuntil(b'\r\n')
+
+        await self.command(request, read_response)
+
+    async def delete(self, *keys: str):
+        '''
+        Remove keys.
+        '''
+
+        async def read_response(reader):
+            for _ in keys:
+                await reader.readuntil(b'\r\n')
+
+        await self.command(
+            b''.join(f'delete {key}\r\n'.encode() for key in keys),
+            read_response)
+
+
+def get_cache():
+    '''
+    Return the cache, creating it on first call from the environment:
+    CACHE_BACKEND (memory or memcached), CACHE_URL (host:port of the
+    memcached server), CACHE_TTL (seconds) and CACHE_MAX_SIZE.
+    '''
+
+    global cache
+
+    if cache is None:
+        ttl = float(os.getenv('CACHE_TTL', '60'))
+        if os.getenv('CACHE_BACKEND', 'memory') == 'memcached':
+            host, port = os.getenv('CACHE_URL', 'localhost:11211').split(':')
+            cache = MemcachedCache(host, int(port), ttl)
+        else:
+            cache = MemoryCache(ttl, int(os.getenv('CACHE_MAX_SIZE',
+                                                   '10000')))
+
+    return cache
+
+
+async def cached(name: str, key: str, load):
+    '''
+    Return a cached value, loading and storing it on miss. None results
+    are not cached.
+    Args:
+        name (str): Name of the cached data, used in the metrics.
+        key (str): Key of the value.
+        load (callable): Coroutine function returning the value.
+    Returns:
+        Cached or loaded value.
+    '''
+
+    value = await get_cache().get(key)
+
+    if value is not None:
+        cache_lookups.inc(cache=name, result='hit')
+        return value
+
+    cache_lookups.inc(cache=name, result='miss')
+    value = await load()
+
+    if value is not None:
+        await get_cache().set(key, value)
+
+    return value
+
+
+async def invalidate(name: str, *keys: str):
+    '''
+    Remove values from the cache after a write.
+    Args:
+        name (str): Name of the cached data, used in the metrics.
+        keys (str): Keys of the values.
+    '''
+
+    await get_cache().delete(*keys)
+    cache_invalidations.inc(cache=name)
+
+
+async def serve_memcached(host: str, port: int):
+    '''
+    Serve the get, gets, set, add, cas and delete commands of the memcached
+    text protocol from memory, as a stand-in for a memcached server.
+    Args:
+        host (str): Host to listen on.
+        port (int): Port to listen on.
+    '''
+
+    # Data, expiration and cas unique of each key
+    entries = {}
+    versions = 0
+
+    def lookup(key):
+        entry = entries.get(key)
+        if entry and (not entry[1] or time.monotonic() < entry[1]):
+            return entry
+        return None
+
+    async def handle(reader, writer):
+        nonlocal versions
+        try:
+            while True:
+                command = (await reader.readuntil(b'\r\n')).split()
+                if not command:
+                    continue
+
+                if command[0] in (b'get', b'gets'):
+                    for key in command[1:]:
+                        entry = lookup(key)
+                        if not entry:
+                            continue
+                        writer.write(b'VALUE %s 0 %d' % (key, len(entry[0])))
+                        if command[0] == b'gets':
+                            writer.write(b' %d' % entry[2])
+                        writer.write(b'\r\n%s\r\n' % entry[0])
+                    writer.write(b'END\r\n')
+                elif command[0] in (b'set', b'add', b'cas'):
+                    key, _, expiration, length = command[1:5]
+                    data = (await reader.readexactly(int(length) + 2))[:-2]
+                    entry = lookup(key)
+                    if command[0] == b'add' and entry:
+                        writer.write(b'NOT_STORED\r\n')
+                    elif command[0] == b'cas' and not entry:
+                        writer.write(b'NOT_FOUND\r\n')
+                    elif command[0] == b'cas' and entry[2] != int(command[5]):
+                        writer.write(b'EXISTS\r\n')
+                    else:
+                        versions += 1
+                        entries[key] = (data, int(expiration) and (
+                            time.monotonic() + int(expiration)), versions)
+                        writer.write(b'STORED\r\n')
+                elif command[0] == b'delete':
+                    found = entries.pop(command[1], None) is not None
+                    writer.write(b'DELETED\r\n' if found
+                                 else b'NOT_FOUND\r\n')
+                else:
+                    writer.write(b'ERROR\r\n')
+
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            writer.close()
+
+    server = await asyncio.start_server(handle, host, port)
+    print(f'memcached stand-in listening on {host}:{port}')
+
+    async with server:
+        await server.serve_forever()
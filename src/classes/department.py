@@ -1,6 +1,6 @@
-from sqlalchemy import Column, Integer, String, UniqueConstraint
+from sqlalchemy import Column, Integer, String, UniqueConstraint, Index, text
 from pydantic import BaseModel
-from base_controller import get_base
+from base_controller import get_base, Id
 
 # Get the Base instance from base_controller
 Base = get_base()
@@ -11,6 +11,9 @@ class Departement(Base):
 
     id = Column(Integer, primary_key=True, index=True, autoincrement=True)
     name = Column(String)
+    # Kept up to date by the membership endpoints, see manage.py
+    # check-department-counts
+    member_count = Column(Integer, nullable=False, server_default=text('0'))
 
 
 class UserDepartment(Base):
@@ -19,13 +22,53 @@ class UserDepartment(Base):
     id = Column(Integer, primary_key=True, autoincrement=True)
     user_id = Column(Integer)
     department_id = Column(Integer)
+    # The unique constraint serves the departments of a user, the index
+    # the users of a department
     __table_args__ = (UniqueConstraint('user_id', 'department_id',
-                                       name='Unique'),)
+                                       name='Unique'),
+                      Index('ix_user_department_department_id_user_id',
+                            'department_id', 'user_id'))
+
+
+class CreateDepartment(BaseModel):
+    name: str
+
+
+class UpdateDepartment(BaseModel):
+    name: str
+
+
+class DepartmentItem(BaseModel):
+    '''
+    Department returned by the department endpoints.
+    '''
+
+    id: int
+    name: str | None
+
+
+class DepartmentStats(BaseModel):
+    '''
+    Headcount of a department returned by /departements/stats.
+    '''
+
+    id: int
+    name: str | None
+    member_count: int
+
+
+class DepartmentPage(BaseModel):
+    '''
+    Page of /departements, next_cursor being None on the last page.
+    '''
+
+    items: list[DepartmentItem]
+    next_cursor: int | None
 
 
 class AddUserToDepartment(BaseModel):
-    user_ids: list[int]
+    user_ids: list[Id]
 
 
 class RemoveUserFromDepartment(BaseModel):
-    user_ids: list[int]
+    user_ids: list[Id]
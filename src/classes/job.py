@@ -0,0 +1,14 @@
+from sqlalchemy import Column, String, DateTime
+from base_controller import get_base
+
+# Get the Base instance from base_controller
+Base = get_base()
+
+
+# Last successful run of each background job, read by every API process
+# so that a restart doesn't run the jobs again before their interval
+class JobRun(Base):
+    __tablename__ = 'job_runs'
+
+    name = Column(String, primary_key=True)
+    last_success = Column(DateTime(timezone=True), nullable=False)
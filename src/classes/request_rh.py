@@ -1,7 +1,8 @@
-from sqlalchemy import Column, Integer, String, Date, JSON, Boolean
+from datetime import date as _date
+from sqlalchemy import Column, Integer, String, Date, JSON, Boolean, Index, text
 from pydantic import BaseModel
 
-from base_controller import get_base
+from base_controller import get_base, Id
 
 # Get the Base instance from base_controller
 Base = get_base()
@@ -17,19 +18,89 @@ class RequestRH(Base):
     visibility = Column(Boolean)
     close = Column(Boolean)
     last_action = Column(Date)
+    # Former history, moved to requests_rh_history by backfill-rh-history
     content_history = Column(JSON)
     delete_date = Column(Date)
+    __table_args__ = (
+        Index('ix_requests_rh_last_action_id', 'last_action', 'id'),
+        Index('ix_requests_rh_user_id_last_action_id',
+              'user_id', 'last_action', 'id'),
+        Index('ix_requests_rh_open_last_action_id', 'last_action', 'id',
+              postgresql_where=text('close IS NOT TRUE')),
+        # Removed requests in id order, scanned by the rh-retention job
+        Index('ix_requests_rh_removed_id_delete_date', 'id', 'delete_date',
+              postgresql_where=text('delete_date IS NOT NULL')),
+    )
+
+
+# Removed requests rh moved out of requests_rh by the rh-retention job,
+# with their original id. Their history stays in requests_rh_history.
+class RequestRHArchive(Base):
+    __tablename__ = 'requests_rh_archive'
+
+    id = Column(Integer, primary_key=True, autoincrement=False)
+    user_id = Column(Integer)
+    content = Column(String)
+    registration_date = Column(Date)
+    visibility = Column(Boolean)
+    close = Column(Boolean)
+    last_action = Column(Date)
+    content_history = Column(JSON)
+    delete_date = Column(Date)
+    archive_date = Column(Date)
+
+
+class RequestRHHistory(Base):
+    __tablename__ = 'requests_rh_history'
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    request_id = Column(Integer)
+    author = Column(Integer)
+    content = Column(String)
+    date = Column(Date)
+    __table_args__ = (
+        Index('ix_requests_rh_history_request_id_date_id',
+              'request_id', 'date', 'id'),
+    )
 
 
 class CreateRequestRH(BaseModel):
-    user_id: int
+    user_id: Id
     content: str
 
 
 class RemoveRequestRH(BaseModel):
-    id: int
+    id: Id
 
 
 class UpdateRequestRH(BaseModel):
-    id: int
+    id: Id
     content: str
+
+
+class RequestRHItem(BaseModel):
+    id: int
+    user_id: int | None
+    content: str | None
+    registration_date: _date | None
+    visibility: bool | None
+    close: bool | None
+    last_action: _date | None
+    delete_date: _date | None
+
+
+class RequestRHPage(BaseModel):
+    items: list[RequestRHItem]
+    next_cursor: str | None
+
+
+class RequestRHHistoryItem(BaseModel):
+    id: int
+    author: int | None
+    content: str | None
+    date: _date | None
+
+
+class RequestRHHistoryPage(BaseModel):
+    items: list[RequestRHHistoryItem]
+    next_cursor: str | None
@@ -1,18 +1,54 @@
 from datetime import date as _date
-from sqlalchemy import Column, Integer, String, Date, JSON
-from pydantic import BaseModel
+from sqlalchemy import Column, Integer, String, Date, JSON, Index, text
+from pydantic import BaseModel, field_validator
 
-from base_controller import get_base
+from base_controller import get_base, Id
+from database_controller import MigrationError
+from search_controller import (SEARCH_COLUMNS, SEARCH_VECTOR, SEARCH_TEXT,
+                               PUBLIC_SEARCH_VECTOR, PUBLIC_SEARCH_TEXT)
 
 # Get the Base instance from base_controller
 Base = get_base()
 
 
+def lower_case_emails(connection):
+    '''
+    Data migration of users: trim and lower-case the emails stored before
+    they were normalized, as logins and the unique index on email expect.
+    Args:
+        connection (Connection): Connection of the migration.
+    Raises:
+        MigrationError: Listing the users sharing an email once
+            normalized, which have to be merged or renamed first.
+    '''
+
+    duplicates = connection.execute(text('''
+        SELECT lower(trim(email)) AS email, array_agg(id ORDER BY id) AS ids
+        FROM users
+        WHERE email IS NOT NULL
+        GROUP BY lower(trim(email))
+        HAVING count(*) > 1;
+    ''')).mappings().all()
+
+    if duplicates:
+        raise MigrationError('Users sharing an email once lower-cased:\n'
+                             + '\n'.join(f"{duplicate['email']}: users "
+                                         f"{duplicate['ids']}"
+                                         for duplicate in duplicates))
+
+    updated = connection.execute(text('''
+        UPDATE users SET email = lower(trim(email))
+        WHERE email <> lower(trim(email));
+    ''')).rowcount
+    if updated:
+        print(f'{updated} emails lower-cased')
+
+
 class User(Base):
     __tablename__ = 'users'
 
     id = Column(Integer, primary_key=True, index=True, autoincrement=True)
-    email = Column(String)
+    email = Column(String, unique=True, index=True)
     password = Column(String)
     firstname = Column(String)
     lastname = Column(String)
@@ -24,6 +60,35 @@ class User(Base):
     registration_date = Column(Date)
     token = Column(String)
     role = Column(String)
+    picture = Column(String)
+
+    __table_args__ = (
+        # Prefix search, usable by LIKE 'abc%' whatever the collation
+        *(Index(f'ix_users_{column}_prefix',
+                text(f'lower({column}) text_pattern_ops'))
+          for column in SEARCH_COLUMNS),
+        # Full-text and fuzzy searches of admins, and of the other users
+        # (without the postal codes)
+        Index('ix_users_search_vector', text(SEARCH_VECTOR),
+              postgresql_using='gin'),
+        Index('ix_users_public_search_vector', text(PUBLIC_SEARCH_VECTOR),
+              postgresql_using='gin'),
+        # Created only where the pg_trgm extension is available
+        Index('ix_users_search_trigram', text(f'({SEARCH_TEXT}) gin_trgm_ops'),
+              postgresql_using='gin', info={'extension': 'pg_trgm'}),
+        Index('ix_users_public_search_trigram',
+              text(f'({PUBLIC_SEARCH_TEXT}) gin_trgm_ops'),
+              postgresql_using='gin', info={'extension': 'pg_trgm'}),
+        {'info': {'migrations': [lower_case_emails]}},
+    )
+
+
+def normalize_email(email: str) -> str:
+    '''
+    Emails are stored and compared trimmed and lower-cased.
+    '''
+
+    return email.strip().lower() if email else email
 
 
 class CreateUser(BaseModel):
@@ -35,14 +100,18 @@ class CreateUser(BaseModel):
     adress: str
     postal_code: str
 
+    email_validator = field_validator('email')(normalize_email)
+
 
 class Connect(BaseModel):
     email: str
     password: str
 
+    email_validator = field_validator('email')(normalize_email)
+
 
 class UpdateUser(BaseModel):
-    id: int = None
+    id: Id = None
     email: str = None
     firstname: str = None
     lastname: str = None
@@ -51,9 +120,77 @@ class UpdateUser(BaseModel):
     postal_code: str = None
     role: str = None
 
+    email_validator = field_validator('email')(normalize_email)
+
 
 class UpdatePassword(BaseModel):
     email: str
     password: str
     new_password: str
     repeat_new_password: str
+
+    email_validator = field_validator('email')(normalize_email)
+
+
+class PublicUser(BaseModel):
+    '''
+    Fields of a user returned to every authenticated user.
+    '''
+
+    email: str | None
+    firstname: str | None
+    lastname: str | None
+    age: int | None
+    registration_date: _date | None
+    role: str | None
+
+
+class AdminUser(BaseModel):
+    '''
+    Fields of a user returned to admins: every column but the password.
+    '''
+
+    email: str | None
+    firstname: str | None
+    lastname: str | None
+    birthday_date: str | None
+    adress: str | None
+    postal_code: str | None
+    age: int | None
+    meta: dict | None
+    registration_date: _date | None
+    token: str | None
+    role: str | None
+
+
+class UserLookup(BaseModel):
+    '''
+    Result of the lookup of one id by /users, user being None when no user
+    has this id.
+    '''
+
+    id: int
+    found: bool
+    user: AdminUser | PublicUser | None
+
+
+class UserSearchItem(BaseModel):
+    '''
+    User found by /users/search.
+    '''
+
+    id: int
+    user: AdminUser | PublicUser
+
+
+class UserSearchPage(BaseModel):
+    '''
+    Page of /users/search, next_cursor being None on the last page.
+    '''
+
+    items: list[UserSearchItem]
+    next_cursor: int | None
+
+
+# Response model of each projection of a user
+USER_PROJECTIONS = {'public': PublicUser, 'admin': AdminUser}
@@ -0,0 +1,274 @@
+'''
+Allows for creating and obtaining the database engines.
+'''
+import os
+import asyncio
+from sqlalchemy import create_engine, event, inspect, text
+from sqlalchemy.exc import IntegrityError, DBAPIError
+from sqlalchemy_utils import database_exists, create_database
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from metrics_controller import TimedQueuePool, count_query
+from query_guard_controller import before_query, after_query
+
+# Asynchronous engine shared by every endpoint
+engine = None
+# Autocommit view of engine, used by read-only endpoints
+read_engine = None
+
+
+def get_database_url(driver: str = 'asyncpg') -> str:
+    '''
+    Build the database URL from the environment.
+    Args:
+        driver (str): SQLAlchemy driver name (asyncpg or psycopg2).
+    Returns:
+        str: Database URL.
+    '''
+
+    return ''.join([
+        f'postgresql+{driver}://',
+        f"{os.getenv('DATABASE_USER')}:",
+        f"{os.getenv('DATABASE_PASSWORD')}@",
+        f"{os.getenv('DATABASE_HOST')}:",
+        f"{os.getenv('DATABASE_PORT')}/",
+        f"{os.getenv('DATABASE_NAME')}"
+    ])
+
+
+def get_bool_env(name: str, default: bool = False) -> bool:
+    '''
+    Read a boolean setting from the environment.
+    Args:
+        name (str): Name of the variable.
+        default (bool): Value used when the variable is not set.
+    Returns:
+        bool: True for 1, true or yes.
+    '''
+
+    value = os.getenv(name)
+    if value is None:
+        return default
+
+    return value.strip().lower() in ('1', 'true', 'yes')
+
+
+def get_engine_options() -> dict:
+    '''
+    Build the options of the asynchronous engine from the environment:
+    DATABASE_POOL_SIZE, DATABASE_MAX_OVERFLOW, DATABASE_POOL_TIMEOUT,
+    DATABASE_POOL_PRE_PING, DATABASE_POOL_RECYCLE (seconds),
+    DATABASE_STATEMENT_TIMEOUT (milliseconds) and DATABASE_ECHO.
+    Returns:
+        dict: Keyword arguments of create_async_engine.
+    '''
+
+    options = {
+        'poolclass': TimedQueuePool,
+        'pool_size': int(os.getenv('DATABASE_POOL_SIZE', '5')),
+        'max_overflow': int(os.getenv('DATABASE_MAX_OVERFLOW', '10')),
+        'pool_timeout': float(os.getenv('DATABASE_POOL_TIMEOUT', '30')),
+        'pool_pre_ping': get_bool_env('DATABASE_POOL_PRE_PING'),
+        'pool_recycle': int(os.getenv('DATABASE_POOL_RECYCLE', '-1')),
+        'echo': get_bool_env('DATABASE_ECHO')
+    }
+
+    statement_timeout = os.getenv('DATABASE_STATEMENT_TIMEOUT')
+    if statement_timeout:
+        options['connect_args'] = {
+            'server_settings': {'statement_timeout': statement_timeout}}
+
+    return options
+
+
+def create_engine_from_env(**overrides):
+    '''
+    Create an asynchronous engine configured from the environment.
+    Args:
+        overrides: Options replacing those of get_engine_options.
+    Returns:
+        AsyncEngine: New engine.
+    '''
+
+    new_engine = create_async_engine(get_database_url(),
+                                     **{**get_engine_options(), **overrides})
+    event.listen(new_engine.sync_engine, 'before_cursor_execute', count_query)
+    event.listen(new_engine.sync_engine, 'before_cursor_execute', before_query)
+    event.listen(new_engine.sync_engine, 'after_cursor_execute', after_query)
+
+    return new_engine
+
+
+def get_engine():
+    '''
+    Return the asynchronous engine, creating it on first call.
+    The engine keeps a pool of asyncpg connections so that database
+    round-trips never block the event loop. Its settings are read from
+    the environment (see get_engine_options).
+    '''
+
+    global engine
+
+    if engine is None:
+        engine = create_engine_from_env()
+
+    return engine
+
+
+def get_read_engine():
+    '''
+    Return a view of the asynchronous engine running statements in
+    autocommit mode, for read-only endpoints. It shares the pool of
+    get_engine, and saves the BEGIN and COMMIT round-trips of a
+    transaction.
+    '''
+
+    global read_engine
+
+    if read_engine is None:
+        read_engine = get_engine().execution_options(
+            isolation_level='AUTOCOMMIT')
+
+    return read_engine
+
+
+def get_sync_engine():
+    '''
+    Return a new synchronous engine, used for schema bootstrap only.
+    '''
+
+    return create_engine(get_database_url('psycopg2'))
+
+
+async def retry_with_backoff(function, attempts: int = None,
+                             delay: float = 0.5, max_delay: float = 10.0):
+    '''
+    Await function until it succeeds, waiting longer after each failure to
+    reach the database.
+    Args:
+        function (callable): Coroutine function to call.
+        attempts (int): Maximum number of calls, DATABASE_CONNECT_ATTEMPTS
+            (10 by default) if None.
+        delay (float): Seconds waited after the first failure, doubled
+            after each one.
+        max_delay (float): Longest wait between two calls.
+    Returns:
+        Result of function.
+    Raises:
+        DBAPIError, OSError: The last error, once every attempt failed.
+    '''
+
+    if attempts is None:
+        attempts = int(os.getenv('DATABASE_CONNECT_ATTEMPTS', '10'))
+
+    for attempt in range(1, attempts + 1):
+        try:
+            return await function()
+        except (DBAPIError, OSError) as exception:
+            if attempt == attempts:
+                raise
+            print(f'Database unavailable ({exception.__class__.__name__}), '
+                  f'attempt {attempt}/{attempts}, retrying in {delay:.1f}s')
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, max_delay)
+
+
+async def ping(async_engine):
+    '''
+    Run a trivial statement, checking that the database is reachable.
+    Args:
+        async_engine (AsyncEngine): Engine to check.
+    '''
+
+    async with async_engine.connect() as connection:
+        await connection.execute(text('SELECT 1'))
+
+
+class MigrationError(Exception):
+    '''
+    Raised by a data migration when existing rows can't be migrated, for
+    an operator to fix them by hand.
+    '''
+
+
+def migrate_schema(metadata):
+    '''
+    Create the database and the missing tables, then add the columns and
+    indexes declared since the tables were created, which create_all
+    leaves out on existing tables. Between the two, the data migrations
+    of each table (functions of a connection, named by its
+    info['migrations']) update the existing rows. A unique index that
+    existing rows violate is reported and skipped, as are the indexes
+    needing an extension (named by their info['extension']) that can't be
+    installed. Tables that got new indexes are analyzed.
+    Args:
+        metadata (MetaData): Metadata of the declared tables.
+    Raises:
+        MigrationError: From a data migration, its rows being unchanged.
+    '''
+
+    sync_engine = get_sync_engine()
+
+    if not database_exists(sync_engine.url):
+        create_database(sync_engine.url, template="template0")
+
+    unavailable = set()
+    with sync_engine.begin() as connection:
+        for extension in sorted({index.info['extension']
+                                 for table in metadata.sorted_tables
+                                 for index in table.indexes
+                                 if 'extension' in index.info}):
+            try:
+                with connection.begin_nested():
+                    connection.execute(text(
+                        f'CREATE EXTENSION IF NOT EXISTS {extension}'))
+            except DBAPIError as exception:
+                print(f'{extension} not installed: {exception.orig}')
+                unavailable.add(extension)
+
+    # create_all would fail on these indexes
+    for table in metadata.sorted_tables:
+        for index in list(table.indexes):
+            if index.info.get('extension') in unavailable:
+                print(f'{index.name} not created: {index.info["extension"]} '
+                      'is not installed')
+                table.indexes.discard(index)
+
+    metadata.create_all(bind=sync_engine)
+
+    with sync_engine.begin() as connection:
+        inspector = inspect(connection)
+        for table in metadata.sorted_tables:
+            columns = {column['name']
+                       for column in inspector.get_columns(table.name)}
+            compiler = connection.dialect.ddl_compiler(connection.dialect,
+                                                       None)
+            for column in table.columns:
+                if column.name not in columns:
+                    # Type, server default and NOT NULL of the column
+                    specification = compiler.get_column_specification(column)
+                    connection.execute(text(
+                        f'ALTER TABLE {table.name} ADD COLUMN {specification}'))
+
+        for table in metadata.sorted_tables:
+            for migration in table.info.get('migrations', []):
+                migration(connection)
+
+        for table in metadata.sorted_tables:
+            indexes = {index['name']
+                       for index in inspector.get_indexes(table.name)}
+            created = False
+            for index in table.indexes:
+                if index.name in indexes:
+                    continue
+                try:
+                    with connection.begin_nested():
+                        index.create(connection)
+                    created = True
+                except IntegrityError as exception:
+                    print(f'{index.name} not created: {exception.orig}')
+            # Expression indexes have no statistics until analyzed
+            if created:
+                connection.execute(text(f'ANALYZE {table.name}'))
+
+    sync_engine.dispose()
@@ -0,0 +1,93 @@
+'''
+Allows for streaming query results as NDJSON or CSV exports.
+'''
+import io
+import csv
+import json
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import StreamingResponse
+
+# Media type of each supported export format
+EXPORT_FORMATS = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv'
+}
+
+# Number of rows fetched from the server-side cursor at once
+EXPORT_BATCH_SIZE = 1000
+
+
+def to_csv_value(value):
+    '''
+    Convert a JSON-encoded value to a CSV cell.
+    Args:
+        value: Value returned by jsonable_encoder.
+    Returns:
+        Value written as is, or JSON for lists and dicts.
+    '''
+
+    if isinstance(value, (dict, list)):
+        return json.dumps(value)
+
+    return value
+
+
+async def generate_rows(engine, query, values: dict, export_format: str):
+    '''
+    Yield the encoded rows of a query read through a server-side cursor, so
+    only one batch of rows is held in memory at a time.
+    Args:
+        engine: Asynchronous engine.
+        query: SQL query to stream.
+        values (dict): Values bound to the query.
+        export_format (str): ndjson or csv.
+    Returns:
+        async generator: Encoded chunks of the export.
+    '''
+
+    async with engine.connect() as connection:
+        result = await connection.stream(query, values)
+
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+
+        if export_format == 'csv':
+            writer.writerow(result.keys())
+
+        async for partition in result.mappings().partitions(EXPORT_BATCH_SIZE):
+            for row in partition:
+                row = jsonable_encoder(dict(row))
+                if export_format == 'csv':
+                    writer.writerow(to_csv_value(value)
+                                    for value in row.values())
+                else:
+                    buffer.write(json.dumps(row))
+                    buffer.write('\n')
+
+            yield buffer.getvalue().encode('utf-8')
+            buffer.seek(0)
+            buffer.truncate()
+
+        if buffer.tell():
+            yield buffer.getvalue().encode('utf-8')
+
+
+def stream_export(engine, query, values: dict, export_format: str,
+                  filename: str) -> StreamingResponse:
+    '''
+    Build a streaming response exporting the rows of a query.
+    Args:
+        engine: Asynchronous engine.
+        query: SQL query to stream.
+        values (dict): Values bound to the query.
+        export_format (str): ndjson or csv.
+        filename (str): File name suggested to the client, without extension.
+    Returns:
+        StreamingResponse: Export response.
+    '''
+
+    return StreamingResponse(
+        generate_rows(engine, query, values, export_format),
+        media_type=EXPORT_FORMATS[export_format],
+        headers={'Content-Disposition':
+                 f'attachment; filename="{filename}.{export_format}"'})
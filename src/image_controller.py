@@ -0,0 +1,240 @@
+'''
+Allows for processing profile pictures in a process pool and storing their
+resized renditions.
+'''
+import os
+import io
+import hashlib
+import time
+import asyncio
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from PIL import Image, ImageOps
+
+from metrics_controller import picture_decode, picture_process
+
+PICTURES_DIR = 'assets/picture/profiles'
+DEFAULT_PICTURE = os.path.join(PICTURES_DIR, 'pdp_base.png')
+
+# Width and height bounds of the stored renditions
+RENDITION_SIZES = (64, 256, 800)
+RENDITION_EXTENSION = 'webp'
+
+# Largest accepted upload, in bytes and in decoded pixels
+MAX_PICTURE_BYTES = 10 * 1024 * 1024
+MAX_PICTURE_PIXELS = 40_000_000
+
+# Process pool shared by every request, created on first use
+executor = None
+# Path and ETag of DEFAULT_PICTURE, computed on first use
+default_picture = None
+
+
+def get_executor() -> ProcessPoolExecutor:
+    '''
+    Return the process pool used to decode pictures.
+    '''
+
+    global executor
+
+    if executor is None:
+        workers = os.getenv('PICTURE_WORKERS')
+        executor = ProcessPoolExecutor(
+            max_workers=int(workers) if workers else None)
+
+    return executor
+
+
+def shutdown_executor():
+    '''
+    Stop the process pool, if it was created, without waiting for pending
+    pictures.
+    '''
+
+    global executor
+
+    if executor is not None:
+        executor.shutdown(wait=False, cancel_futures=True)
+        executor = None
+
+
+def make_renditions(content: bytes) -> dict:
+    '''
+    Decode a picture and encode its renditions, without any metadata.
+    Only the first frame of animated pictures is kept.
+    Args:
+        content (bytes): Uploaded file content.
+    Returns:
+        dict: Encoded rendition for each size of RENDITION_SIZES.
+    Raises:
+        ValueError: If the picture is too large once decoded.
+        OSError: If the picture can't be decoded.
+    '''
+
+    Image.MAX_IMAGE_PIXELS = MAX_PICTURE_PIXELS
+
+    with Image.open(io.BytesIO(content)) as image:
+        if image.width * image.height > MAX_PICTURE_PIXELS:
+            raise ValueError('Too large picture')
+
+        # Let JPEG decode directly at a reduced scale when possible
+        largest = max(RENDITION_SIZES)
+        image.draft('RGB', (largest, largest))
+
+        image = ImageOps.exif_transpose(image)
+        has_alpha = image.mode in ('RGBA', 'LA', 'PA') or (
+            image.mode == 'P' and 'transparency' in image.info)
+        image = image.convert('RGBA' if has_alpha else 'RGB')
+        image.info = {}
+
+        # Each rendition is resized from the next larger one
+        renditions = {}
+        for size in sorted(RENDITION_SIZES, reverse=True):
+            image.thumbnail((size, size), Image.LANCZOS, reducing_gap=3.0)
+            output = io.BytesIO()
+            image.save(output, 'WEBP', quality=80, method=2)
+            renditions[size] = output.getvalue()
+
+    return renditions
+
+
+def timed_make_renditions(content: bytes) -> tuple:
+    '''
+    Run make_renditions and measure it, in the worker process.
+    Args:
+        content (bytes): Uploaded file content.
+    Returns:
+        tuple: Renditions and seconds spent making them.
+    '''
+
+    start = time.perf_counter()
+    renditions = make_renditions(content)
+
+    return renditions, time.perf_counter() - start
+
+
+async def process_picture(content: bytes) -> dict:
+    '''
+    Run make_renditions in the process pool.
+    Args:
+        content (bytes): Uploaded file content.
+    Returns:
+        dict: Encoded rendition for each size of RENDITION_SIZES.
+    '''
+
+    loop = asyncio.get_running_loop()
+
+    with picture_process.time():
+        renditions, elapsed = await loop.run_in_executor(
+            get_executor(), timed_make_renditions, content)
+    picture_decode.observe(elapsed)
+
+    return renditions
+
+
+def picture_version(renditions: dict) -> str:
+    '''
+    Return the version of a picture, a digest of its renditions. It is
+    stored in users.picture, names the rendition files and makes their
+    ETags, so a new upload never reuses the name of a previous one.
+    Args:
+        renditions (dict): Encoded rendition for each size.
+    Returns:
+        str: Version of the picture.
+    '''
+
+    digest = hashlib.sha256()
+    for size in sorted(renditions):
+        digest.update(renditions[size])
+
+    return digest.hexdigest()[:16]
+
+
+def rendition_path(token: str, version: str, size: int) -> str:
+    '''
+    Return the path of a user's rendition.
+    Args:
+        token (str): Token of the user.
+        version (str): Version of the picture.
+        size (int): Size of the rendition.
+    Returns:
+        str: Path of the rendition.
+    '''
+
+    return os.path.join(PICTURES_DIR,
+                        f'{token}_{version}_{size}.{RENDITION_EXTENSION}')
+
+
+def store_renditions(token: str, version: str, renditions: dict) -> dict:
+    '''
+    Write the renditions of a user's picture. Each file is written to a
+    temporary file first and moved in place, so readers never see a
+    partially written picture.
+    Args:
+        token (str): Token of the user.
+        version (str): Version of the picture.
+        renditions (dict): Encoded rendition for each size.
+    Returns:
+        dict: Path of each rendition.
+    '''
+
+    os.makedirs(PICTURES_DIR, exist_ok=True)
+
+    paths = {}
+    for size, content in renditions.items():
+        descriptor, temporary_path = tempfile.mkstemp(dir=PICTURES_DIR,
+                                                      prefix='.upload-')
+        try:
+            with os.fdopen(descriptor, 'wb') as file:
+                file.write(content)
+            paths[size] = rendition_path(token, version, size)
+            os.replace(temporary_path, paths[size])
+        except OSError:
+            os.remove(temporary_path)
+            raise
+
+    return paths
+
+
+def remove_renditions(token: str, version: str = None):
+    '''
+    Remove the renditions of a previous version of a user's picture, or
+    when version is None the files stored before pictures were versioned.
+    Args:
+        token (str): Token of the user.
+        version (str): Version of the picture.
+    '''
+
+    if version is None:
+        paths = [os.path.join(PICTURES_DIR, f'{token}.{extension}')
+                 for extension in ['gif', 'png', 'jpg', 'jpeg']]
+        paths += [os.path.join(PICTURES_DIR,
+                               f'{token}_{size}.{RENDITION_EXTENSION}')
+                  for size in RENDITION_SIZES]
+    else:
+        paths = [rendition_path(token, version, size)
+                 for size in RENDITION_SIZES]
+
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def get_default_picture() -> tuple:
+    '''
+    Return the path and the ETag of the picture served to users without
+    one. The ETag is computed from the file content on first call.
+    Returns:
+        tuple: Path and ETag of the default picture.
+    '''
+
+    global default_picture
+
+    if default_picture is None:
+        with open(DEFAULT_PICTURE, 'rb') as file:
+            digest = hashlib.sha256(file.read()).hexdigest()[:16]
+        default_picture = (DEFAULT_PICTURE, f'"{digest}"')
+
+    return default_picture
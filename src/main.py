@@ -4,66 +4,173 @@ Main module for ProtoRH.
 
 import os
 import json
-import hashlib
+import math
+import base64
+import io
+import csv
 from datetime import date, datetime, timedelta
+from contextlib import asynccontextmanager
 import jwt
-from typing import Annotated
-from fastapi import FastAPI, HTTPException, Depends, UploadFile, File
+from typing import Annotated, Literal
+from fastapi import FastAPI, HTTPException, Depends, UploadFile, File, Query, Request
+from fastapi.responses import (FileResponse, Response, PlainTextResponse,
+                               JSONResponse)
+from fastapi.exceptions import RequestValidationError
+from fastapi.exception_handlers import request_validation_exception_handler
 from fastapi.security import OAuth2PasswordBearer
 from dotenv import load_dotenv
-from sqlalchemy import create_engine, text
-from sqlalchemy_utils import database_exists, create_database
+from sqlalchemy import text
+from sqlalchemy.exc import IntegrityError, ProgrammingError
 import sys
-from io import BytesIO
+import asyncio
 from PIL import Image
+from pydantic import ValidationError
 
 src_dir = os.path.dirname(os.path.abspath(__file__))
 sys.path.append(src_dir)
 
-from base_controller import get_base
+from base_controller import get_base, select_columns, Id, MIN_ID, MAX_ID
+from database_controller import (get_engine, get_read_engine, get_bool_env,
+                                 migrate_schema, retry_with_backoff, ping)
+from export_controller import stream_export
+from auth_controller import TokenVerifier
+from cache_controller import cached, invalidate
+from scheduler_controller import Job, Scheduler, run_in_chunks
+from search_controller import user_search_condition
+from metrics_controller import (MetricsMiddleware, Counter, Gauge,
+                                render_metrics)
+from query_guard_controller import get_query_guard, allow_queries
+from password_controller import (hash_password, hash_passwords,
+                                 verify_password, shutdown_password_executor)
+from rate_limit_controller import TokenBucket, ConcurrencyLimiter, parse_rate
+from token_controller import gen_tokens
+from image_controller import (process_picture, picture_version,
+                              store_renditions, remove_renditions,
+                              rendition_path, get_default_picture,
+                              shutdown_executor, RENDITION_SIZES,
+                              MAX_PICTURE_BYTES)
 from classes.user import *
 from classes.department import *
 from classes.request_rh import *
+from classes.job import *
 
 load_dotenv('protorh.env')
 
-DATABASE_URL = [
-    'postgresql://',
-    f"{os.getenv('DATABASE_USER')}:",
-    f"{os.getenv('DATABASE_PASSWORD')}@",
-    f"{os.getenv('DATABASE_HOST')}:",
-    f"{os.getenv('DATABASE_PORT')}/",
-    f"{os.getenv('DATABASE_NAME')}"
-]
+SECRET_KEY = os.getenv('SECRET_KEY')
 
-engine = create_engine(''.join(DATABASE_URL), echo=True)
-if not database_exists(engine.url):
-    create_database(engine.url, template="template0")
+Base = get_base()
 
+engine = get_engine()
+read_engine = get_read_engine()
 
-Base = get_base()
-Base.metadata.create_all(bind=engine)
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    '''
+    Wait for the database before serving, creating the schema first when
+    DATABASE_AUTO_MIGRATE is true (see manage.py migrate), and release the
+    connections and the picture workers on shutdown. The background jobs
+    run while serving, unless SCHEDULER_ENABLED is false.
+    '''
+
+    if get_bool_env('DATABASE_AUTO_MIGRATE'):
+        await retry_with_backoff(
+            lambda: asyncio.to_thread(migrate_schema, Base.metadata))
+
+    await retry_with_backoff(lambda: ping(engine))
+
+    if get_bool_env('SCHEDULER_ENABLED', True):
+        scheduler.start()
+
+    yield
+
+    await scheduler.stop()
+    await engine.dispose()
+    shutdown_executor()
+    shutdown_password_executor()
+
+
+app = FastAPI(lifespan=lifespan)
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl='token')
 
+token_verifier = TokenVerifier(SECRET_KEY)
+
+app.add_middleware(MetricsMiddleware, guard=get_query_guard())
+
 
-async def user_exists(email: str) -> bool:
+@app.exception_handler(RequestValidationError)
+async def validation_error(http_request: Request,
+                           exception: RequestValidationError):
     '''
-    Check if user exists by checking if his email is already taken.
+    Answer 404 when a path parameter is invalid, e.g. an id outside of the
+    range of the id columns, as no resource has this path. Other invalid
+    parameters get the default 422.
+    '''
+
+    if any(error['loc'][0] == 'path' for error in exception.errors()):
+        return JSONResponse(status_code=404, content={'detail': 'Not Found'})
+
+    return await request_validation_exception_handler(http_request,
+                                                      exception)
+
+Counter('jwt_cache_hits_total', 'JWTs verified from the cache.',
+        function=lambda: token_verifier.hits)
+Counter('jwt_cache_misses_total', 'JWTs decoded.',
+        function=lambda: token_verifier.misses)
+Gauge('db_pool_checked_out', 'Connections checked out from the pool.',
+      function=lambda: engine.pool.checkedout())
+
+# Maximum number of user ids accepted by the department add/remove endpoints
+MAX_DEPARTMENT_USERS = 50000
+# Number of user ids sent to the database in a single statement
+DEPARTMENT_USERS_CHUNK_SIZE = 5000
+# Maximum number of user ids accepted by /users
+MAX_BATCH_USERS = 2000
+# Columns of users loaded by /user/bulk_create
+BULK_USER_COLUMNS = ['email', 'password', 'firstname', 'lastname',
+                     'birthday_date', 'adress', 'postal_code', 'age', 'meta',
+                     'registration_date', 'token', 'role']
+# Maximum number of users accepted by /user/bulk_create, whose passwords
+# are hashed by PASSWORD_BULK_WORKERS threads (see manage.py import-users
+# for larger files)
+MAX_BULK_USERS = 1000
+# Size of the chunks read from uploaded files
+UPLOAD_CHUNK_SIZE = 64 * 1024
+# Profile pictures are revalidated with their ETag once this is expired
+PICTURE_CACHE_CONTROL = 'public, max-age=300'
+# Rows scanned per chunk, and seconds between chunks, by the background jobs
+JOB_CHUNK_SIZE = int(os.getenv('JOB_CHUNK_SIZE', '5000'))
+JOB_CHUNK_DELAY = float(os.getenv('JOB_CHUNK_DELAY', '0.1'))
+# Days removed requests rh stay in requests_rh, and what happens to them then
+RH_RETENTION_DAYS = int(os.getenv('RH_RETENTION_DAYS', '365'))
+RH_RETENTION_MODE = os.getenv('RH_RETENTION_MODE', 'archive')
+
+# Login attempts (/connect and /user/password) allowed per client IP and per
+# email, as capacity/seconds
+login_ip_bucket = TokenBucket(
+    'login_ip', parse_rate(os.getenv('LOGIN_RATE_LIMIT_IP', '30/60')))
+login_email_bucket = TokenBucket(
+    'login_email', parse_rate(os.getenv('LOGIN_RATE_LIMIT_EMAIL', '10/60')))
+# Requests of each route group handled at once, the others get a 503
+login_slots = ConcurrencyLimiter(
+    'login', int(os.getenv('LOGIN_MAX_CONCURRENCY', '32')))
+picture_slots = ConcurrencyLimiter(
+    'picture', int(os.getenv('PICTURE_MAX_CONCURRENCY', '16')))
+
+
+def chunks(items: list, size: int):
+    '''
+    Split a list into consecutive slices.
     Args:
-        email (str): Email to check.
+        items (list): List to split.
+        size (int): Maximum length of each slice.
     Returns:
-        bool: True if exists, False if not.
+        generator: Slices of items.
     '''
 
-    query = text('SELECT id FROM users WHERE email = :email;')
-
-    with engine.begin() as connection:
-        result = connection.execute(query, {"email": email}).fetchone()
-
-    return result is not None
+    for index in range(0, len(items), size):
+        yield items[index:index + size]
 
 
 def calculate_age(birthday_date: date) -> int:
@@ -102,24 +209,6 @@ def gen_token(email: str, firstname: str, lastname: str) -> str:
     return result
 
 
-def gen_password(password: str) -> str:
-    '''
-    Gen md5 hash by taken string in parameter.
-    Args:
-        password (str): String to hash.
-    Returns:
-        str: Hashed string.
-    '''
-
-    string = password + os.getenv('salt')
-
-    hash_md5 = hashlib.md5()
-    hash_md5.update(string.encode('utf-8'))
-    result = hash_md5.hexdigest()
-
-    return result
-
-
 def gen_jwt(id: int, email: str, role: str) -> str:
     '''
     Gen a JWT with an id, an email and a role in his payload.
@@ -138,37 +227,620 @@ def gen_jwt(id: int, email: str, role: str) -> str:
         'exp': datetime.utcnow() + timedelta(minutes=10)
     }
 
-    token = jwt.encode(payload, os.getenv('SECRET_KEY'), algorithm='HS256')
+    token = jwt.encode(payload, SECRET_KEY, algorithm='HS256')
 
     return token
 
 
-def get_image_dimensions(image_content: bytes):
-    """
-    Get the dimensions (width and height) of an image from its binary content.
+def encode_cursor(last_action: date, id: int) -> str:
+    '''
+    Gen an opaque pagination cursor from the last returned row of a list
+    ordered by date and id (requests rh or their history).
+    Args:
+        last_action (date): Date of the row.
+        id (int): Id of the row.
+    Returns:
+        str: Cursor.
+    '''
+
+    cursor = f'{last_action.isoformat()},{id}'
+
+    return base64.urlsafe_b64encode(cursor.encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor: str) -> tuple:
+    '''
+    Read a cursor generated by encode_cursor.
+    Args:
+        cursor (str): Cursor.
+    Returns:
+        tuple: Date and id.
+    Raises:
+        ValueError: If the cursor is malformed.
+    '''
+
+    decoded = base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8')
+    last_action, id = decoded.split(',')
+    id = int(id)
+    if not MIN_ID <= id <= MAX_ID:
+        raise ValueError('Id out of range')
+
+    return date.fromisoformat(last_action), id
+
+
+def request_rh_filters(token: dict, close: bool = None, user_id: int = None,
+                       date_from: date = None, date_to: date = None,
+                       department_id: int = None) -> tuple:
+    '''
+    Build the SQL conditions selecting the requests rh visible to a user.
+    Admins see every request, managers every open request and other users
+    their own open requests.
+    Args:
+        token (dict): Decoded JWT of the caller.
+        close (bool): Only keep requests with this close state.
+        user_id (int): Only keep requests of this user.
+        date_from (date): Only keep requests last updated on or after.
+        date_to (date): Only keep requests last updated on or before.
+        department_id (int): Only keep requests of members of this department.
+    Returns:
+        tuple: List of SQL conditions and their bound values.
+    '''
+
+    conditions = []
+    values = {}
+
+    if token.get('role') != 'admin':
+        conditions.append('close IS NOT TRUE')
+        if token.get('role') != 'manager':
+            conditions.append('user_id = :token_user_id')
+            values['token_user_id'] = token.get('id')
+
+    if close is not None:
+        conditions.append('close = :close')
+        values['close'] = close
+    if user_id is not None:
+        conditions.append('user_id = :user_id')
+        values['user_id'] = user_id
+    if date_from is not None:
+        conditions.append('last_action >= :date_from')
+        values['date_from'] = date_from
+    if date_to is not None:
+        conditions.append('last_action <= :date_to')
+        values['date_to'] = date_to
+    if department_id is not None:
+        conditions.append('''user_id IN (
+            SELECT user_id FROM user_department
+            WHERE department_id = :department_id)''')
+        values['department_id'] = department_id
+
+    return conditions, values
+
+
+async def get_token(token: Annotated[str, Depends(oauth2_scheme)]) -> dict:
+    '''
+    Dependency returning the claims of the JWT sent by the client.
+    Args:
+        token (str): Bearer token.
+    Returns:
+        dict: Claims of the token.
+    '''
+
+    try:
+        return token_verifier.verify(token)
+    except jwt.ExpiredSignatureError as exception:
+        raise HTTPException(status_code=401,
+                            detail='Expired token') from exception
+    except jwt.InvalidTokenError as exception:
+        raise HTTPException(status_code=401,
+                            detail='Invalid token') from exception
+
+
+def parse_bulk_users(content: str, content_format: str) -> list:
+    '''
+    Read CreateUser records from JSON lines or CSV.
+    Args:
+        content (str): Raw records.
+        content_format (str): jsonl or csv.
+    Returns:
+        list: Tuples of (line number, record dict or error message).
+    '''
+
+    rows = []
+
+    if content_format == 'csv':
+        reader = csv.DictReader(io.StringIO(content))
+        for row in reader:
+            rows.append((reader.line_num, row))
+        return rows
+
+    for line_number, line in enumerate(content.splitlines(), start=1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except json.JSONDecodeError:
+            rows.append((line_number, 'Invalid JSON'))
+            continue
+        if not isinstance(row, dict):
+            rows.append((line_number, 'Invalid JSON'))
+            continue
+        rows.append((line_number, row))
+
+    return rows
+
+
+async def bulk_create_users(rows: list) -> dict:
+    '''
+    Validate and insert many users at once. Duplicate emails are found with a
+    single query and valid users are loaded with COPY into a staging table,
+    then inserted into users, skipping the emails taken meanwhile.
+    Args:
+        rows (list): Tuples returned by parse_bulk_users.
+    Returns:
+        dict: Number of created users and errors, and the per-row report.
+    '''
+
+    report = []
+    users = []
+    emails = set()
+
+    for line_number, row in rows:
+        if isinstance(row, str):
+            report.append({'line': line_number, 'email': None,
+                           'detail': row})
+            continue
+
+        try:
+            user = CreateUser.model_validate(row)
+        except ValidationError as exception:
+            error = exception.errors()[0]
+            field = '.'.join(str(location) for location in error['loc'])
+            report.append({'line': line_number, 'email': row.get('email'),
+                           'detail': f"{field}: {error['msg']}"})
+            continue
+
+        if len(user.email) > 320:
+            detail = 'Too long email adress'
+        elif len(user.password) < 8:
+            detail = 'Too short password'
+        elif user.email in emails:
+            detail = 'Duplicate email in batch'
+        else:
+            detail = None
+            emails.add(user.email)
+            users.append((line_number, user))
+
+        report.append({'line': line_number, 'email': user.email,
+                       'detail': detail})
+
+    taken_query = text(
+        'SELECT lower(email) FROM users WHERE lower(email) = ANY(:emails);')
+
+    async with read_engine.connect() as connection:
+        taken = set((await connection.execute(
+            taken_query, {"emails": list(emails)})).scalars().all())
+
+    # Hashed outside of the transaction, which would otherwise hold its
+    # connection while the bulk password pool works
+    users = [(line_number, user) for line_number, user in users
+             if user.email not in taken]
+    passwords = await hash_passwords([user.password for _, user in users])
+
+    tokens = gen_tokens([(user.email, user.firstname, user.lastname)
+                         for _, user in users], os.getenv('salt'))
+    today = date.today()
 
+    records = [(user.email, password, user.firstname,
+                user.lastname, user.birthday_date.isoformat(), user.adress,
+                user.postal_code, calculate_age(user.birthday_date),
+                json.dumps({}), today, str(token), 'user')
+               for (_, user), password, token in zip(users, passwords, tokens)]
+
+    if records:
+        columns = ', '.join(BULK_USER_COLUMNS)
+        async with engine.begin() as connection:
+            # Loaded into a staging table first: an email taken while the
+            # passwords were hashed would make a COPY into users fail the
+            # whole batch
+            await connection.execute(text(f'''
+                CREATE TEMPORARY TABLE bulk_users ON COMMIT DROP AS
+                SELECT {columns} FROM users WITH NO DATA;
+            '''))
+            raw_connection = await connection.get_raw_connection()
+            await raw_connection.driver_connection.copy_records_to_table(
+                'bulk_users', records=records, columns=BULK_USER_COLUMNS)
+
+            inserted = set((await connection.execute(text(f'''
+                INSERT INTO users ({columns})
+                SELECT {columns} FROM bulk_users
+                ON CONFLICT (email) DO NOTHING
+                RETURNING email;
+            '''))).scalars().all())
+
+        taken.update(user.email for _, user in users
+                     if user.email not in inserted)
+
+    for row in report:
+        if row['detail'] is None and row['email'] in taken:
+            row['detail'] = 'Email already taken'
+
+    created = sum(1 for row in report if row['detail'] is None)
+
+    return {'created': created, 'errors': len(report) - created,
+            'rows': report}
+
+
+async def read_upload(file: UploadFile, max_size: int) -> bytes:
+    '''
+    Read an uploaded file in chunks, refusing files larger than max_size.
     Args:
-        image_content (bytes): The binary content of the image.
+        file (UploadFile): Uploaded file.
+        max_size (int): Maximum size in bytes.
+    Returns:
+        bytes: File content.
+    '''
+
+    chunks = []
+    size = 0
+
+    while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+        size += len(chunk)
+        if size > max_size:
+            raise HTTPException(status_code=413, detail='Too large picture')
+        chunks.append(chunk)
+
+    return b''.join(chunks)
 
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    '''
+    Tell whether an If-None-Match header matches an ETag, using the weak
+    comparison required for this header.
+    Args:
+        if_none_match (str): Value of the If-None-Match header.
+        etag (str): Current ETag of the resource.
     Returns:
-        tuple: A tuple containing the width and height of the image.
-    """
-    with BytesIO(image_content) as image_stream:
-        image = Image.open(image_stream)
-        width, height = image.size
-        return width, height
+        bool: True if the client copy is up to date.
+    '''
 
+    if not if_none_match:
+        return False
 
-def save_image(file_name: str, file_content: str):
-    if not os.path.exists('assets/picture/profiles'):
-        os.makedirs('assets/picture/profiles')
+    if if_none_match.strip() == '*':
+        return True
 
-    file_path = os.path.join('assets/picture/profiles', file_name)
+    return etag in [tag.strip().removeprefix('W/')
+                    for tag in if_none_match.split(',')]
 
-    with open(file_path, 'wb') as file:
-        file.write(file_content)
 
-    return file_path
+def user_cache_key(user_id: int, projection: str) -> str:
+    '''
+    Return the cache key of a projection of a user.
+    Args:
+        user_id (int): Id of the user.
+        projection (str): admin or public.
+    Returns:
+        str: Cache key.
+    '''
+
+    return f'user:{user_id}:{projection}'
+
+
+async def load_user(user_id: int, projection: str) -> dict:
+    '''
+    Read the columns of a projection of a user (see USER_PROJECTIONS).
+    Args:
+        user_id (int): Id of the user.
+        projection (str): admin or public.
+    Returns:
+        dict: Projected user, None if the user doesn't exist.
+    '''
+
+    columns = select_columns(USER_PROJECTIONS[projection])
+    query = text(f'SELECT {columns} FROM users WHERE id = :user_id')
+
+    async with read_engine.connect() as connection:
+        result = (await connection.execute(
+            query, {"user_id": user_id})).mappings().one_or_none()
+
+    return dict(result) if result else None
+
+
+async def invalidate_user(user_id: int):
+    '''
+    Remove every cached projection of a user, after it was updated.
+    Args:
+        user_id (int): Id of the user.
+    '''
+
+    await invalidate('user', user_cache_key(user_id, 'admin'),
+                     user_cache_key(user_id, 'public'))
+
+
+async def limit_login(http_request: Request, email: str):
+    '''
+    Take a login attempt from the buckets of the client IP and of the
+    email, before hashing or querying anything.
+    Args:
+        http_request (Request): Request of the attempt.
+        email (str): Email of the attempt.
+    Raises:
+        HTTPException: 429 with Retry-After if a bucket is empty.
+    '''
+
+    client = http_request.client.host if http_request.client else 'unknown'
+
+    for bucket, key in ((login_ip_bucket, client), (login_email_bucket, email)):
+        retry_after = await bucket.take(key)
+        if retry_after:
+            raise HTTPException(
+                status_code=429, detail='Too many attempts',
+                headers={'Retry-After': str(math.ceil(retry_after))})
+
+
+async def rehash_password(user_id: int, stored: str, password: str):
+    '''
+    Replace the legacy or outdated hash of a user's password, unless the
+    password was changed since it was read.
+    Args:
+        user_id (int): Id of the user.
+        stored (str): Hash read from the database.
+        password (str): Password verified against stored.
+    '''
+
+    query = text('''
+        UPDATE users SET password = :new_password
+        WHERE id = :id AND password = :password;
+    ''')
+
+    values = {
+        'id': user_id,
+        'password': stored,
+        'new_password': await hash_password(password)
+    }
+
+    async with engine.begin() as connection:
+        await connection.execute(query, values)
+
+
+def department_cache_key(department_id: int) -> str:
+    '''
+    Return the cache key of a department.
+    Args:
+        department_id (int): Id of the department.
+    Returns:
+        str: Cache key.
+    '''
+
+    return f'department:{department_id}'
+
+
+async def load_department(department_id: int) -> dict:
+    '''
+    Read a department.
+    Args:
+        department_id (int): Id of the department.
+    Returns:
+        dict: Department, None if it doesn't exist.
+    '''
+
+    query = text(f'''
+        SELECT {select_columns(DepartmentItem)}
+        FROM departments
+        WHERE id = :department_id;
+    ''')
+
+    async with read_engine.connect() as connection:
+        result = (await connection.execute(
+            query, {"department_id": department_id})).mappings().one_or_none()
+
+    return dict(result) if result else None
+
+
+async def get_department_or_404(department_id: int) -> dict:
+    '''
+    Return a department through the cache, which spares the membership
+    endpoints a query checking it exists.
+    Args:
+        department_id (int): Id of the department.
+    Returns:
+        dict: Department.
+    Raises:
+        HTTPException: 404 if the department doesn't exist.
+    '''
+
+    department = await cached('department',
+                               department_cache_key(department_id),
+                               lambda: load_department(department_id))
+
+    if not department:
+        raise HTTPException(status_code=404, detail='Department not found')
+
+    return department
+
+
+# Adds the users of a chunk of ids to a department, returning those added
+ADD_DEPARTMENT_USERS = text('''
+    WITH inserted AS (
+        INSERT INTO user_department (user_id, department_id)
+        SELECT users.id, :department_id
+        FROM unnest(CAST(:user_ids AS integer[])) AS user_id
+        -- Unknown ids would be counted as members
+        JOIN users ON users.id = user_id
+        -- Locked before any membership: the changes of a
+        -- department (and of its count) are serialized, and the
+        -- department may have been removed since it was cached
+        WHERE EXISTS (SELECT FROM departments
+                      WHERE id = :department_id FOR NO KEY UPDATE)
+        ON CONFLICT (user_id, department_id) DO NOTHING
+        RETURNING user_id
+    ), counted AS (
+        UPDATE departments
+        SET member_count = member_count
+            + (SELECT count(*) FROM inserted)
+        WHERE id = :department_id
+    )
+    SELECT users.id, users.email, users.firstname, users.lastname
+    FROM inserted
+    JOIN users ON users.id = inserted.user_id;
+''')
+
+# Removes the users of a chunk of ids from a department, returning those
+# removed
+REMOVE_DEPARTMENT_USERS = text('''
+    WITH deleted AS (
+        DELETE FROM user_department
+        WHERE department_id = :department_id
+            AND user_id = ANY(CAST(:user_ids AS integer[]))
+            -- Locked before any membership, as for the additions
+            AND EXISTS (SELECT FROM departments
+                        WHERE id = :department_id FOR NO KEY UPDATE)
+        RETURNING user_id
+    ), counted AS (
+        UPDATE departments
+        SET member_count = member_count
+            - (SELECT count(*) FROM deleted)
+        WHERE id = :department_id
+    )
+    SELECT users.id, users.email, users.firstname, users.lastname
+    FROM deleted
+    JOIN users ON users.id = deleted.user_id;
+''')
+
+
+async def change_department_users(connection, query, department_id: int,
+                                  user_ids: list) -> list:
+    '''
+    Add or remove users of a department, one statement per chunk of
+    DEPARTMENT_USERS_CHUNK_SIZE ids.
+    Args:
+        connection (AsyncConnection): Connection of the transaction.
+        query (TextClause): ADD_DEPARTMENT_USERS or REMOVE_DEPARTMENT_USERS.
+        department_id (int): Id of the department.
+        user_ids (list): Distinct user ids.
+    Returns:
+        list: Id, email, firstname and lastname of each user added or
+            removed.
+    '''
+
+    output = []
+    batches = list(chunks(user_ids, DEPARTMENT_USERS_CHUNK_SIZE))
+    # One statement per chunk of ids
+    allow_queries(len(batches))
+
+    for chunk in batches:
+        result = await connection.execute(
+            query, {"user_ids": chunk, "department_id": department_id})
+        output.extend(result.mappings().all())
+
+    return output
+
+
+async def recompute_ages() -> int:
+    '''
+    Background job updating the age of the users who had a birthday since
+    it was computed, chunk by chunk, and removing them from the cache.
+    Birthday dates that aren't ISO dates are left out.
+    Returns:
+        int: Number of users updated.
+    '''
+
+    query = text('''
+        WITH chunk AS (
+            SELECT id, CASE
+                WHEN birthday_date ~ '^[0-9]{4}-[0-9]{2}-[0-9]{2}$'
+                THEN CAST(date_part('year', age(current_date,
+                    CAST(birthday_date AS date))) AS integer)
+            END AS age
+            FROM users
+            WHERE id > :last_id
+            ORDER BY id
+            LIMIT :chunk_size
+        ), updated AS (
+            UPDATE users
+            SET age = chunk.age
+            FROM chunk
+            WHERE users.id = chunk.id
+                AND chunk.age IS NOT NULL
+                AND users.age IS DISTINCT FROM chunk.age
+            RETURNING users.id
+        )
+        SELECT max(id) AS last_id, count(*) AS scanned,
+            ARRAY(SELECT id FROM updated) AS changed
+        FROM chunk;
+    ''')
+
+    async def invalidate_users(user_ids: list):
+        await invalidate('user', *(user_cache_key(user_id, projection)
+                                   for user_id in user_ids
+                                   for projection in USER_PROJECTIONS))
+
+    return await run_in_chunks(engine, query, {}, JOB_CHUNK_SIZE,
+                               JOB_CHUNK_DELAY, invalidate_users)
+
+
+async def apply_rh_retention() -> int:
+    '''
+    Background job taking the requests rh removed more than
+    RH_RETENTION_DAYS ago out of requests_rh, chunk by chunk. They are
+    moved to requests_rh_archive when RH_RETENTION_MODE is archive, and
+    deleted with their history when it is purge.
+    Returns:
+        int: Number of requests rh taken out.
+    Raises:
+        ValueError: If RH_RETENTION_MODE is neither archive nor purge.
+    '''
+
+    if RH_RETENTION_MODE == 'archive':
+        kept = '''
+            INSERT INTO requests_rh_archive (id, user_id, content,
+                registration_date, visibility, close, last_action,
+                content_history, delete_date, archive_date)
+            SELECT id, user_id, content, registration_date, visibility,
+                close, last_action, content_history, delete_date,
+                current_date
+            FROM removed
+        '''
+    elif RH_RETENTION_MODE == 'purge':
+        kept = '''
+            DELETE FROM requests_rh_history
+            USING removed
+            WHERE requests_rh_history.request_id = removed.id
+        '''
+    else:
+        raise ValueError(f'Invalid RH_RETENTION_MODE {RH_RETENTION_MODE}')
+
+    # Requests being edited are left for the next run
+    query = text(f'''
+        WITH chunk AS (
+            SELECT id
+            FROM requests_rh
+            WHERE delete_date IS NOT NULL AND delete_date < :cutoff
+                AND id > :last_id
+            ORDER BY id
+            LIMIT :chunk_size
+            FOR UPDATE SKIP LOCKED
+        ), removed AS (
+            DELETE FROM requests_rh
+            USING chunk
+            WHERE requests_rh.id = chunk.id
+            RETURNING requests_rh.*
+        ), kept AS ({kept})
+        SELECT max(id) AS last_id, count(*) AS scanned,
+            ARRAY(SELECT id FROM removed) AS changed
+        FROM chunk;
+    ''')
+
+    return await run_in_chunks(
+        engine, query,
+        {'cutoff': date.today() - timedelta(days=RH_RETENTION_DAYS)},
+        JOB_CHUNK_SIZE, JOB_CHUNK_DELAY)
+
+
+# Background jobs, see manage.py run-job to run them by hand or from cron
+jobs = [Job('recompute-ages', recompute_ages, 24 * 3600),
+        Job('rh-retention', apply_rh_retention, 24 * 3600)]
+scheduler = Scheduler(engine, jobs)
 
 
 # Endpoint : /hello
@@ -179,6 +851,15 @@ async def hello():
     return {'Hello World !'}
 
 
+# Endpoint : /metrics
+# Type : GET
+# This endpoint returns the metrics in the Prometheus text format
+@app.get('/metrics', response_class=PlainTextResponse)
+async def metrics():
+    return PlainTextResponse(render_metrics(),
+                             media_type='text/plain; version=0.0.4')
+
+
 # Endpoint : /user/create
 # Type : POST
 # This endpoint creates an user in the database
@@ -190,6 +871,8 @@ async def create_user(request: CreateUser):
         VALUES (:email, :password, :firstname, :lastname, :birthday_date,
             :adress, :postal_code, :age, :meta, :registration_date, :token,
             :role)
+        ON CONFLICT (email) DO NOTHING
+        RETURNING id
     ''')
 
     if len(request.email) > 320:
@@ -198,105 +881,208 @@ async def create_user(request: CreateUser):
     if len(request.password) < 8:
         raise HTTPException(status_code=400, detail='Too short password')
 
-    if await user_exists(request.email):
-        raise HTTPException(status_code=400, detail='Email already taken')
-
     values = {
         'email': request.email,
-        'password': gen_password(request.password),
+        'password': await hash_password(request.password),
         'firstname': request.firstname,
         'lastname': request.lastname,
-        'birthday_date': request.birthday_date,
+        'birthday_date': request.birthday_date.isoformat(),
         'adress': request.adress,
         'postal_code': request.postal_code,
         'age': calculate_age(request.birthday_date),
         'meta': json.dumps({}),
         'registration_date': date.today(),
-        'token': gen_token(request.email, request.firstname, request.lastname),
+        'token': str(gen_token(request.email, request.firstname,
+                               request.lastname)),
         'role': 'user'
     }
 
-    with engine.begin() as connection:
-        connection.execute(query, values)
-        return {'User created with success'}
+    async with engine.begin() as connection:
+        result = (await connection.execute(query, values)).one_or_none()
+
+    if not result:
+        raise HTTPException(status_code=400, detail='Email already taken')
+
+    return {'User created with success'}
+
+
+# Endpoint : /user/bulk_create
+# Type : POST
+# This endpoint creates many users from JSON lines or CSV records
+@app.post('/user/bulk_create')
+async def bulk_create_user(http_request: Request,
+                           token: Annotated[dict, Depends(get_token)]):
+    if token.get('role') != 'admin':
+        raise HTTPException(status_code=400,
+                            detail='You are not allowed to create users')
+
+    content_type = http_request.headers.get('content-type', '')
+    content_format = 'csv' if content_type.startswith('text/csv') else 'jsonl'
+
+    try:
+        content = (await http_request.body()).decode('utf-8')
+    except UnicodeDecodeError as exception:
+        raise HTTPException(status_code=400,
+                            detail='Body should be UTF-8') from exception
+
+    rows = parse_bulk_users(content, content_format)
+    if len(rows) > MAX_BULK_USERS:
+        raise HTTPException(status_code=400, detail='Too many users')
+
+    return await bulk_create_users(rows)
 
 
 # Endpoint : /connect
 # Type : POST
 # This endpoint returns a JSON Web Token which guarantee that you are allowed
 # to use the API
-@app.post('/connect')
-async def connect(request: Connect):
-    password = gen_password(request.password)
+@app.post('/connect', dependencies=[Depends(login_slots)])
+async def connect(request: Connect, http_request: Request):
+    await limit_login(http_request, request.email)
 
     query = text('''
-        SELECT id, role FROM users
-        WHERE email = :email AND password = :password;
+        SELECT id, role, password FROM users WHERE lower(email) = :email;
     ''')
 
-    with engine.begin() as connection:
-        result = connection.execute(
-            query, {"email": request.email,
-                    "password": password}).mappings().one_or_none()
+    async with read_engine.connect() as connection:
+        result = (await connection.execute(
+            query, {"email": request.email})).mappings().one_or_none()
+
+    matches, rehash = await verify_password(
+        request.password, result['password'] if result else None)
 
-    if result:
-        jwt = gen_jwt(result['id'], request.email, result['role'])
-        return {jwt}
+    if not matches:
+        raise HTTPException(status_code=401)
 
-    raise HTTPException(status_code=401)
+    if rehash:
+        await rehash_password(result['id'], result['password'],
+                              request.password)
+
+    jwt = gen_jwt(result['id'], request.email, result['role'])
+    return {jwt}
 
 
 # Endpoint : /user/{user_id}
 # Type : GET
 # This endpoint returns informations about specified user
-@app.get('/user/{user_id}')
-async def get_user(user_id: int,
-                   token: Annotated[str, Depends(oauth2_scheme)]):
+@app.get('/user/{user_id}', response_model=AdminUser | PublicUser)
+async def get_user(user_id: Id,
+                   token: Annotated[dict, Depends(get_token)]):
+    projection = 'admin' if token.get('role') == 'admin' else 'public'
+
+    values = await cached('user', user_cache_key(user_id, projection),
+                          lambda: load_user(user_id, projection))
+
+    if not values:
+        raise HTTPException(status_code=404, detail='User not found')
+
+    return values
+
+
+# Endpoint : /users
+# Type : GET
+# This endpoint returns informations about several users at once
+@app.get('/users', response_model=list[UserLookup])
+async def get_users(ids: str, token: Annotated[dict, Depends(get_token)]):
     try:
-        token = jwt.decode(token, os.getenv('SECRET_KEY'),
-                           algorithms=["HS256"])
-
-        query = text('SELECT * FROM users WHERE id = :user_id')
-
-        with engine.begin() as connection:
-            result = connection.execute(
-                query, {"user_id": user_id}).mappings().one_or_none()
-
-        if not result:
-            raise HTTPException(status_code=404, detail='User not found')
-
-        if token.get('role') == 'admin':
-            values = {
-                'email': result['email'],
-                'firstname': result['firstname'],
-                'lastname': result['lastname'],
-                'birthday_date': result['birthday_date'],
-                'adress': result['adress'],
-                'postal_code': result['postal_code'],
-                'age': result['age'],
-                'meta': result['meta'],
-                'registration_date': result['registration_date'],
-                'token': result['token'],
-                'role': result['role']
-            }
-        else:
-            values = {
-                'email': result['email'],
-                'firstname': result['firstname'],
-                'lastname': result['lastname'],
-                'age': result['age'],
-                'registration_date': result['registration_date'],
-                'role': result['role']
-            }
+        user_ids = [int(user_id) for user_id in ids.split(',')
+                    if user_id.strip()]
+    except ValueError as exception:
+        raise HTTPException(status_code=400,
+                            detail='Invalid user ids') from exception
 
-        return values
+    if any(not MIN_ID <= user_id <= MAX_ID for user_id in user_ids):
+        raise HTTPException(status_code=400, detail='Invalid user ids')
 
-    except jwt.ExpiredSignatureError as exception:
-        raise HTTPException(status_code=401,
-                            detail='Expired token') from exception
-    except jwt.DecodeError as exception:
-        raise HTTPException(status_code=401,
-                            detail='Invalid token') from exception
+    if len(user_ids) > MAX_BATCH_USERS:
+        raise HTTPException(status_code=400,
+                            detail=f'Too many user ids (max {MAX_BATCH_USERS})')
+
+    projection = 'admin' if token.get('role') == 'admin' else 'public'
+    columns = select_columns(USER_PROJECTIONS[projection])
+
+    query = text(f'''
+        SELECT id, {columns}
+        FROM users
+        WHERE id = ANY(CAST(:user_ids AS integer[]));
+    ''')
+
+    async with read_engine.connect() as connection:
+        result = await connection.execute(
+            query, {'user_ids': list(dict.fromkeys(user_ids))})
+        users = {row.pop('id'): row
+                 for row in map(dict, result.mappings())}
+
+    return [{'id': user_id, 'found': user_id in users,
+             'user': users.get(user_id)} for user_id in user_ids]
+
+
+# Endpoint : /users/search
+# Type : GET
+# This endpoint returns the users matching a search, page by page
+@app.get('/users/search', response_model=UserSearchPage)
+async def search_users(q: Annotated[str, Query(min_length=1, max_length=200)],
+                       token: Annotated[dict, Depends(get_token)],
+                       mode: Literal['prefix', 'fulltext', 'fuzzy'] = 'prefix',
+                       cursor: Id = None,
+                       limit: Annotated[int, Query(ge=1, le=100)] = 20):
+    projection = 'admin' if token.get('role') == 'admin' else 'public'
+
+    try:
+        condition, values = user_search_condition(mode, q,
+                                                  projection == 'admin')
+    except ValueError as exception:
+        raise HTTPException(status_code=400,
+                            detail='Invalid search') from exception
+
+    if cursor is not None:
+        condition += ' AND id > :cursor'
+        values['cursor'] = cursor
+
+    columns = select_columns(USER_PROJECTIONS[projection])
+
+    if mode == 'prefix':
+        query = text(f'''
+            SELECT id, {columns}
+            FROM users
+            WHERE {condition}
+            ORDER BY id
+            LIMIT :limit;
+        ''')
+    else:
+        # Postgres overestimates the matches of a text search and would
+        # walk the whole primary key for ORDER BY id LIMIT, the matches
+        # are fetched through the search index first
+        query = text(f'''
+            WITH matches AS MATERIALIZED (
+                SELECT id FROM users WHERE {condition}
+            )
+            SELECT id, {columns}
+            FROM users
+            WHERE id IN (SELECT id FROM matches)
+            ORDER BY id
+            LIMIT :limit;
+        ''')
+    values['limit'] = limit + 1
+
+    try:
+        async with read_engine.connect() as connection:
+            users = [dict(row) for row in
+                     (await connection.execute(query, values)).mappings()]
+    except ProgrammingError as exception:
+        if mode != 'fuzzy':
+            raise
+        # The pg_trgm extension isn't installed
+        raise HTTPException(status_code=501,
+                            detail='Fuzzy search is not available') from exception
+
+    next_cursor = None
+    if len(users) > limit:
+        users = users[:limit]
+        next_cursor = users[-1]['id']
+
+    return {'items': [{'id': user.pop('id'), 'user': user} for user in users],
+            'next_cursor': next_cursor}
 
 
 # Endpoint : /user/update/
@@ -304,352 +1090,462 @@ async def get_user(user_id: int,
 # This endpoint updates values of an user
 @app.post('/user/update')
 async def update_user(request: UpdateUser,
-                      token: Annotated[str, Depends(oauth2_scheme)]):
-    try:
-        token = jwt.decode(token, os.getenv('SECRET_KEY'),
-                           algorithms=["HS256"])
-
-        values = {}
-
-        if token.get('role') == 'admin':
-            if request.id:
-                values['id'] = request.id
-            else:
-                values['id'] = token.get('id')
-            if request.firstname:
-                values['firstname'] = request.firstname
-            if request.lastname:
-                values['lastname'] = request.lastname
-            if request.role:
-                values['role'] = request.role
+                      token: Annotated[dict, Depends(get_token)]):
+    values = {}
+
+    if token.get('role') == 'admin':
+        if request.id:
+            values['id'] = request.id
         else:
-            if request.id:
-                raise HTTPException(status_code=401,
-                                    detail='You can only update yourself')
-            if request.firstname or request.lastname:
-                raise HTTPException(status_code=401,
-                                    detail='Not allowed to update your name')
-            if request.role:
-                raise HTTPException(status_code=401,
-                                    detail='Not allowed to update your role')
-
-        if request.email:
-            if request.email and len(request.email) > 320:
-                raise HTTPException(status_code=400,
-                                    detail='Too long email adress')
-            if request.email and await user_exists(request.email):
-                raise HTTPException(status_code=400,
-                                    detail='Email already taken')
-            values['email'] = request.email
-        if request.birthday_date:
-            values['birthday_date'] = request.birthday_date
-            values['age'] = calculate_age(request.birthday_date)
-        if request.adress:
-            values['adress'] = request.adress
-        if request.postal_code:
-            values['postal_code'] = request.postal_code
-
-        updates = ', '.join(f'{key} = :{key}' for key in values.keys())
-        query = text(f'UPDATE users SET {updates} WHERE id = :id')
-
-        with engine.begin() as connection:
-            connection.execute(query, values)
-            return {'User updated with success'}
+            values['id'] = token.get('id')
+        if request.firstname:
+            values['firstname'] = request.firstname
+        if request.lastname:
+            values['lastname'] = request.lastname
+        if request.role:
+            values['role'] = request.role
+    else:
+        if request.id:
+            raise HTTPException(status_code=401,
+                                detail='You can only update yourself')
+        values['id'] = token.get('id')
+        if request.firstname or request.lastname:
+            raise HTTPException(status_code=401,
+                                detail='Not allowed to update your name')
+        if request.role:
+            raise HTTPException(status_code=401,
+                                detail='Not allowed to update your role')
+
+    if request.email:
+        if request.email and len(request.email) > 320:
+            raise HTTPException(status_code=400,
+                                detail='Too long email adress')
+        values['email'] = request.email
+    if request.birthday_date:
+        values['birthday_date'] = request.birthday_date.isoformat()
+        values['age'] = calculate_age(request.birthday_date)
+    if request.adress:
+        values['adress'] = request.adress
+    if request.postal_code:
+        values['postal_code'] = request.postal_code
+
+    updates = ', '.join(f'{key} = :{key}' for key in values.keys())
+    query = text(f'UPDATE users SET {updates} WHERE id = :id')
 
-    except jwt.ExpiredSignatureError as exception:
-        raise HTTPException(status_code=401,
-                            detail='Expired token') from exception
-    except jwt.DecodeError as exception:
-        raise HTTPException(status_code=401,
-                            detail='Invalid token') from exception
+    try:
+        async with engine.begin() as connection:
+            await connection.execute(query, values)
+    except IntegrityError as exception:
+        raise HTTPException(status_code=400,
+                            detail='Email already taken') from exception
+
+    await invalidate_user(values['id'])
+
+    return {'User updated with success'}
 
 
 # Endpoint : /user/password
 # Type : POST
 # This endpoint updates password of an user
-@app.post('/user/password')
-async def update_password(request: UpdatePassword):
-    password = gen_password(request.password)
-    new_password = gen_password(request.new_password)
-    repeat_new_password = gen_password(request.repeat_new_password)
+@app.post('/user/password', dependencies=[Depends(login_slots)])
+async def update_password(request: UpdatePassword, http_request: Request):
+    await limit_login(http_request, request.email)
 
     query = text('''
-        SELECT id FROM users WHERE email = :email AND password = :password;
+        SELECT id, password FROM users WHERE lower(email) = :email;
     ''')
 
-    with engine.begin() as connection:
-        result = connection.execute(
-            query, {"email": request.email,
-                    "password": password}).mappings().one_or_none()
-
-        if not result:
-            raise HTTPException(status_code=401)
+    async with read_engine.connect() as connection:
+        result = (await connection.execute(
+            query, {"email": request.email})).mappings().one_or_none()
 
-        if new_password == repeat_new_password:
-            query = text('''
-                UPDATE users
-                SET password = :password
-                WHERE email = :email;
-            ''')
+    matches, _ = await verify_password(
+        request.password, result['password'] if result else None)
 
-            connection.execute(
-                query, {"email": request.email, "password": new_password})
-            return {'Password updated'}
+    if not matches:
+        raise HTTPException(status_code=401)
 
+    if request.new_password != request.repeat_new_password:
         raise HTTPException(status_code=400,
                             detail='New passwords should be same')
 
+    query = text('''
+        UPDATE users
+        SET password = :new_password
+        WHERE id = :id AND password = :password;
+    ''')
+
+    values = {
+        'id': result['id'],
+        'password': result['password'],
+        'new_password': await hash_password(request.new_password)
+    }
+
+    async with engine.begin() as connection:
+        updated = (await connection.execute(query, values)).rowcount
+
+    # The password was changed since it was verified
+    if not updated:
+        raise HTTPException(status_code=401)
+
+    await invalidate_user(result['id'])
+
+    return {'Password updated'}
+
 
 # Endpoint : /upload/picture/user/{user_id}
 # Type : POST
 # This endpoint download profile picture of an user
-@app.post('/upload/picture/user/{user_id}')
-async def upload_profile_picture(user_id: int, file: UploadFile = File(...)):
-    with engine.begin() as connection:
-        user = connection.execute(text('SELECT token FROM users WHERE id = :user_id'), {"user_id": user_id}).mappings().one_or_none()
+@app.post('/upload/picture/user/{user_id}',
+          dependencies=[Depends(picture_slots)])
+async def upload_profile_picture(user_id: Id, file: UploadFile = File(...)):
+    async with read_engine.connect() as connection:
+        user = (await connection.execute(
+            text('SELECT token FROM users WHERE id = :user_id'),
+            {"user_id": user_id})).mappings().one_or_none()
 
-        if not user:
-            raise HTTPException(status_code=404, detail='User not found')
+    if not user:
+        raise HTTPException(status_code=404, detail='User not found')
 
-        allowed_extensions = ['gif', 'png', 'jpg', 'jpeg']
-        file_extension = file.filename.split('.')[-1]
-        if file_extension not in allowed_extensions:
-            raise HTTPException(status_code=400)
+    allowed_extensions = ['gif', 'png', 'jpg', 'jpeg']
+    file_extension = file.filename.split('.')[-1].lower()
+    if file_extension not in allowed_extensions:
+        raise HTTPException(status_code=400)
 
-        if not file.file.readable():
-            raise HTTPException(status_code=400)
+    picture = await read_upload(file, MAX_PICTURE_BYTES)
 
-        picture = file.file.read()
+    try:
+        renditions = await process_picture(picture)
+    except (OSError, ValueError, Image.DecompressionBombError) as exception:
+        raise HTTPException(status_code=400,
+                            detail='Invalid picture') from exception
 
-        width, height = get_image_dimensions(picture)
-        if width > 800 and height > 800:
-            raise HTTPException(status_code=400)
+    version = picture_version(renditions)
+    paths = await asyncio.to_thread(store_renditions, user['token'], version,
+                                    renditions)
 
-        for file_name in os.listdir('assets/picture/profiles'):
-            if file_name.startswith(user['token'] + '.'):
-                os.remove('assets/picture/profiles/' + file_name)
+    query = text('''
+        UPDATE users
+        SET picture = :picture
+        FROM (SELECT id, picture FROM users WHERE id = :user_id FOR UPDATE)
+            AS previous
+        WHERE users.id = previous.id
+        RETURNING previous.picture;
+    ''')
 
-        saved_picture_path = save_image((user['token'] + '.' + file_extension), picture)
+    async with engine.begin() as connection:
+        previous = (await connection.execute(
+            query, {'user_id': user_id, 'picture': version})).one_or_none()
 
-        return {saved_picture_path}
+    # The user was removed while the picture was processed
+    if previous is None:
+        await asyncio.to_thread(remove_renditions, user['token'], version)
+        raise HTTPException(status_code=404, detail='User not found')
+
+    # Files of the replaced version, or the files stored before pictures
+    # were versioned, are no longer referenced
+    if previous.picture != version:
+        await asyncio.to_thread(remove_renditions, user['token'],
+                                previous.picture)
+
+    await invalidate_user(user_id)
+
+    return paths
 
 
 # Endpoint : /picture/user/{user_id}
 # Type : GET
 # This endpoint return the profile picture of an user
 @app.get('/picture/user/{user_id}')
-async def get_profile_picture(user_id: int):
-    with engine.begin() as connection:
-        user = connection.execute(text('SELECT token FROM users WHERE id = :user_id'),
-                                  {"user_id": user_id}).mappings().one_or_none()
+async def get_profile_picture(user_id: Id, http_request: Request,
+                              size: int = 256):
+    if size not in RENDITION_SIZES:
+        raise HTTPException(status_code=400, detail='Invalid picture size')
+
+    async with read_engine.connect() as connection:
+        user = (await connection.execute(
+            text('SELECT token, picture FROM users WHERE id = :user_id'),
+            {"user_id": user_id})).mappings().one_or_none()
+
+    if not user:
+        raise HTTPException(status_code=404, detail='User not found')
+
+    path, etag = get_default_picture()
+    media_type = 'image/png'
+    if user['picture']:
+        path = rendition_path(user['token'], user['picture'], size)
+        etag = f'"{user["picture"]}-{size}"'
+        media_type = 'image/webp'
+
+    headers = {'ETag': etag, 'Cache-Control': PICTURE_CACHE_CONTROL}
+
+    if etag_matches(http_request.headers.get('if-none-match'), etag):
+        return Response(status_code=304, headers=headers)
+
+    # The files of the previous version are removed by a new upload once
+    # committed, possibly since the user was read
+    try:
+        stat_result = os.stat(path)
+    except FileNotFoundError as exception:
+        raise HTTPException(status_code=404,
+                            detail='Picture not found') from exception
+
+    # The file is sent by the server with pathsend when it supports it
+    return FileResponse(path, media_type=media_type, headers=headers,
+                        stat_result=stat_result)
+
+
+# Endpoint : /departements/create
+# Type : POST
+# This endpoint creates a department
+@app.post('/departements/create', response_model=DepartmentItem)
+async def create_department(request: CreateDepartment,
+                            token: Annotated[dict, Depends(get_token)]):
+    if token.get('role') != 'admin':
+        raise HTTPException(status_code=400,
+                            detail='You are not allowed to create department')
+
+    query = text(f'''
+        INSERT INTO departments (name)
+        VALUES (:name)
+        RETURNING {select_columns(DepartmentItem)};
+    ''')
+
+    async with engine.begin() as connection:
+        department = (await connection.execute(
+            query, {"name": request.name})).mappings().one()
+
+    return department
+
+
+# Endpoint : /departements
+# Type : GET
+# This endpoint returns the departments, page by page
+@app.get('/departements', response_model=DepartmentPage)
+async def get_departments(token: Annotated[dict, Depends(get_token)],
+                          cursor: Id = None,
+                          limit: Annotated[int, Query(ge=1, le=1000)] = 100):
+    condition = 'TRUE'
+    values = {'limit': limit + 1}
+
+    if cursor is not None:
+        condition = 'id > :cursor'
+        values['cursor'] = cursor
+
+    query = text(f'''
+        SELECT {select_columns(DepartmentItem)}
+        FROM departments
+        WHERE {condition}
+        ORDER BY id
+        LIMIT :limit;
+    ''')
+
+    async with read_engine.connect() as connection:
+        departments = (await connection.execute(query, values)).mappings().all()
+
+    next_cursor = None
+    if len(departments) > limit:
+        departments = departments[:limit]
+        next_cursor = departments[-1]['id']
+
+    return {'items': departments, 'next_cursor': next_cursor}
+
+
+# Endpoint : /departements/stats
+# Type : GET
+# This endpoint returns the headcount of every department
+# (declared before /departements/{department_id} which would match it)
+@app.get('/departements/stats', response_model=list[DepartmentStats])
+async def get_departments_stats(token: Annotated[dict, Depends(get_token)]):
+    query = text(f'''
+        SELECT {select_columns(DepartmentStats)}
+        FROM departments
+        ORDER BY id;
+    ''')
+
+    async with read_engine.connect() as connection:
+        result = await connection.execute(query)
+
+        return result.mappings().all()
+
+
+# Endpoint : /departements/{department_id}
+# Type : GET
+# This endpoint returns a department
+@app.get('/departements/{department_id}', response_model=DepartmentItem)
+async def get_department(department_id: Id,
+                         token: Annotated[dict, Depends(get_token)]):
+    return await get_department_or_404(department_id)
+
+
+# Endpoint : /departements/{department_id}/update
+# Type : POST
+# This endpoint renames a department
+@app.post('/departements/{department_id}/update',
+          response_model=DepartmentItem)
+async def update_department(department_id: Id, request: UpdateDepartment,
+                            token: Annotated[dict, Depends(get_token)]):
+    if token.get('role') != 'admin':
+        raise HTTPException(status_code=400,
+                            detail='You are not allowed to update department')
+
+    query = text(f'''
+        UPDATE departments
+        SET name = :name
+        WHERE id = :department_id
+        RETURNING {select_columns(DepartmentItem)};
+    ''')
+
+    async with engine.begin() as connection:
+        department = (await connection.execute(
+            query, {"name": request.name,
+                    "department_id": department_id})).mappings().one_or_none()
+
+    if not department:
+        raise HTTPException(status_code=404, detail='Department not found')
+
+    await invalidate('department', department_cache_key(department_id))
 
-        if not user:
-            raise HTTPException(status_code=404, detail='User not found')
+    return department
 
-        for file_name in os.listdir('assets/picture/profiles'):
-            if file_name.startswith(user['token'] + '.'):
-                return {'assets/picture/profiles' + file_name}
 
-        return {'assets/picture/profiles/pdp_base.png'}
+# Endpoint : /departements/{department_id}/remove
+# Type : POST
+# This endpoint removes a department and its memberships
+@app.post('/departements/{department_id}/remove')
+async def remove_department(department_id: Id,
+                            token: Annotated[dict, Depends(get_token)]):
+    if token.get('role') != 'admin':
+        raise HTTPException(status_code=400,
+                            detail='You are not allowed to remove department')
+
+    async with engine.begin() as connection:
+        # Deleted first, so that concurrent additions of members are
+        # either waited for or find no department
+        department = (await connection.execute(
+            text('DELETE FROM departments WHERE id = :department_id '
+                 'RETURNING id;'),
+            {"department_id": department_id})).one_or_none()
+
+        if not department:
+            raise HTTPException(status_code=404,
+                                detail='Department not found')
+
+        await connection.execute(
+            text('DELETE FROM user_department '
+                 'WHERE department_id = :department_id;'),
+            {"department_id": department_id})
+
+    await invalidate('department', department_cache_key(department_id))
+
+    return {'Department removed with success'}
 
 
 # Endpoint : /departements/{department_id}/users/add
 # Type : POST
 # This endpoint add a list of users into a department
 @app.post('/departements/{department_id}/users/add')
-async def add_users_to_department(department_id: int,
+async def add_users_to_department(department_id: Id,
                                   request: AddUserToDepartment,
-                                  token: Annotated[str, Depends(oauth2_scheme)]):
-    try:
-        token = jwt.decode(token, os.getenv('SECRET_KEY'),
-                           algorithms=["HS256"])
+                                  token: Annotated[dict, Depends(get_token)]):
+    if token.get('role') != 'admin':
+        raise HTTPException(status_code=400,
+                            detail='You are not allowed to add user to department')
 
-        if token.get('role') != 'admin':
-            raise HTTPException(status_code=400,
-                                detail='You are not allowed to add user to department')
-
-        with engine.begin() as connection:
-            department = connection.execute(
-                text('SELECT id FROM departments WHERE id = :id;'),
-                {"id": department_id}).mappings().one_or_none()
-
-            if not department:
-                raise HTTPException(status_code=404,
-                                    detail='Department not found')
-
-            query = text(f'''
-                INSERT INTO user_department (user_id, department_id)
-                VALUES (:user_id, :department_id)
-                ON CONFLICT (user_id, department_id) DO NOTHING
-                RETURNING user_id;
-            ''')
-
-            new_users = []
-
-            for user_id in request.user_ids:
-                result = connection.execute(
-                    query, {"user_id": user_id,
-                            "department_id": department_id
-                            }).mappings().one_or_none()
-                if result:
-                    new_users.append(result)
-
-            query = text(f'''
-                SELECT id, email, firstname, lastname
-                FROM users
-                WHERE id = :id;
-            ''')
-
-            output = []
-
-            for user in new_users:
-                result = connection.execute(query, {
-                    "id": user['user_id']}).mappings().one_or_none()
-                if result:
-                    output.append(result)
-
-            return output
+    user_ids = list(dict.fromkeys(request.user_ids))
+    if len(user_ids) > MAX_DEPARTMENT_USERS:
+        raise HTTPException(status_code=400,
+                            detail='Too many user ids')
 
-    except jwt.ExpiredSignatureError as exception:
-        raise HTTPException(status_code=401,
-                            detail='Expired token') from exception
-    except jwt.DecodeError as exception:
-        raise HTTPException(status_code=401,
-                            detail='Invalid token') from exception
+    await get_department_or_404(department_id)
+
+    async with engine.begin() as connection:
+        return await change_department_users(
+            connection, ADD_DEPARTMENT_USERS, department_id, user_ids)
 
 
 # Endpoint : /departements/{department_id}/users/remove
 # Type : POST
 # This endpoint remove a list of users from a department
 @app.post('/departements/{department_id}/users/remove')
-async def remove_users_from_department(department_id: int,
+async def remove_users_from_department(department_id: Id,
                                        request: RemoveUserFromDepartment,
-                                       token: Annotated[str, Depends(oauth2_scheme)]):
-    try:
-        token = jwt.decode(token, os.getenv('SECRET_KEY'),
-                           algorithms=["HS256"])
-
-        if token.get('role') != 'admin':
-            raise HTTPException(status_code=400,
-                                detail='You are not allowed to add user to department')
+                                       token: Annotated[dict, Depends(get_token)]):
+    if token.get('role') != 'admin':
+        raise HTTPException(status_code=400,
+                            detail='You are not allowed to add user to department')
 
-        with engine.begin() as connection:
-            department = connection.execute(
-                text('SELECT id FROM departments WHERE id = :id;'),
-                {"id": department_id}).mappings().one_or_none()
+    user_ids = list(dict.fromkeys(request.user_ids))
+    if len(user_ids) > MAX_DEPARTMENT_USERS:
+        raise HTTPException(status_code=400,
+                            detail='Too many user ids')
 
-            if not department:
-                raise HTTPException(status_code=404,
-                                    detail='Department not found')
+    await get_department_or_404(department_id)
 
-            query = text(f'''
-                DELETE FROM user_department
-                WHERE department_id = :department_id AND user_id = :user_id;
-            ''')
+    async with engine.begin() as connection:
+        return await change_department_users(
+            connection, REMOVE_DEPARTMENT_USERS, department_id, user_ids)
 
-            deleted_users = []
 
-            for user_id in request.user_ids:
-                result = connection.execute(
-                    query, {"department_id": department_id,
-                            "user_id": user_id}).rowcount
-                if result > 0:
-                    deleted_users.append(user_id)
+# Endpoint : /departements/{department_id}/users
+# Type : GET
+# This endpoint returns the users of a department
+@app.get('/departements/{department_id}/users',
+         response_model=list[AdminUser])
+async def get_users_from_department(department_id: Id,
+                                    token: Annotated[dict, Depends(get_token)],
+                                    export_format: Annotated[
+                                        Literal['ndjson', 'csv'],
+                                        Query(alias='format')] = None):
+    if token.get('role') != 'admin':
+        raise HTTPException(status_code=400,
+                            detail='You are not allowed to remove user from department')
 
-            query = text(f'''
-                SELECT id, email, firstname, lastname
-                FROM users
-                WHERE id = :id;
-            ''')
+    await get_department_or_404(department_id)
 
-            output = []
+    columns = select_columns(AdminUser, 'users')
+    query = text(f'''
+        SELECT {columns}
+        FROM users
+        JOIN user_department ON users.id = user_department.user_id
+        WHERE user_department.department_id = :department_id;
+    ''')
 
-            for user in deleted_users:
-                result = connection.execute(query,
-                                            {"id": user}).mappings().one_or_none()
-                if result:
-                    output.append(result)
+    if export_format:
+        return stream_export(engine, query,
+                             {"department_id": department_id},
+                             export_format,
+                             f'department_{department_id}_users')
 
-            return output
+    async with read_engine.connect() as connection:
+        result = await connection.execute(query,
+                                          {"department_id": department_id})
 
-    except jwt.ExpiredSignatureError as exception:
-        raise HTTPException(status_code=401,
-                            detail='Expired token') from exception
-    except jwt.DecodeError as exception:
-        raise HTTPException(status_code=401,
-                            detail='Invalid token') from exception
+        return result.mappings().all()
 
 
-# Endpoint : /departements/{department_id}/users
+# Endpoint : /user/{user_id}/departements
 # Type : GET
-# This endpoint returns the users of a department
-@app.get('/departements/{department_id}/users')
-async def get_users_from_department(department_id: int,
-                                    token: Annotated[str, Depends(oauth2_scheme)]):
-    try:
-        token = jwt.decode(token, os.getenv('SECRET_KEY'),
-                           algorithms=["HS256"])
+# This endpoint returns the departments of a user
+@app.get('/user/{user_id}/departements', response_model=list[DepartmentItem])
+async def get_departments_of_user(user_id: Id,
+                                  token: Annotated[dict, Depends(get_token)]):
+    if token.get('role') != 'admin' and token.get('id') != user_id:
+        raise HTTPException(status_code=400,
+                            detail='You are not allowed to see the departments of this user')
+
+    query = text(f'''
+        SELECT {select_columns(DepartmentItem, 'departments')}
+        FROM user_department
+        JOIN departments ON departments.id = user_department.department_id
+        WHERE user_department.user_id = :user_id
+        ORDER BY departments.id;
+    ''')
 
-        if token.get('role') != 'admin':
-            raise HTTPException(status_code=400,
-                                detail='You are not allowed to remove user from department')
-
-        with engine.begin() as connection:
-            department = connection.execute(
-                text('SELECT id FROM departments WHERE id = :id;'),
-                {"id": department_id}).mappings().one_or_none()
-
-            if not department:
-                raise HTTPException(status_code=404,
-                                    detail='Department not found')
-
-            query = text('''
-                SELECT * FROM users
-                JOIN user_department ON users.id = user_department.user_id
-                WHERE user_department.department_id = :department_id;
-            ''')
-
-            result = connection.execute(query,
-                                        {"department_id": department_id})
-
-            output = []
-
-            if token.get('role') == 'admin':
-                for row in result:
-                    values = {
-                        'email': row.email,
-                        'firstname': row.firstname,
-                        'lastname': row.lastname,
-                        'birthday_date': row.birthday_date,
-                        'adress': row.adress,
-                        'postal_code': row.postal_code,
-                        'age': row.age,
-                        'meta': row.meta,
-                        'registration_date': row.registration_date,
-                        'token': row.token,
-                        'role': row.role
-                    }
-                    output.append(values)
-            else:
-                for row in result:
-                    values = {
-                        'email': row.email,
-                        'firstname': row.firstname,
-                        'lastname': row.lastname,
-                        'age': row.age,
-                        'registration_date': row.registration_date,
-                        'role': row.role
-                    }
-                    output.append(values)
-
-            return output
+    async with read_engine.connect() as connection:
+        result = await connection.execute(query, {"user_id": user_id})
 
-    except jwt.ExpiredSignatureError as exception:
-        raise HTTPException(status_code=401,
-                            detail='Expired token') from exception
-    except jwt.DecodeError as exception:
-        raise HTTPException(status_code=401,
-                            detail='Invalid token') from exception
+        return result.mappings().all()
 
 
 # Endpoint : /rh/msg/add
@@ -657,42 +1553,35 @@ async def get_users_from_department(department_id: int,
 # This endpoint add a request rh to the database
 @app.post('/rh/msg/add')
 async def add_request_rh(request: CreateRequestRH,
-                         token: Annotated[str, Depends(oauth2_scheme)]):
-    try:
-        token = jwt.decode(token, os.getenv('SECRET_KEY'),
-                           algorithms=["HS256"])
-
-        if token.get('role') != 'manager' and token.get('role') != 'admin':
-            raise HTTPException(status_code=400,
-                                detail='You are not allowed to add request rh')
+                         token: Annotated[dict, Depends(get_token)]):
+    if token.get('role') != 'manager' and token.get('role') != 'admin':
+        raise HTTPException(status_code=400,
+                            detail='You are not allowed to add request rh')
 
-        query = text('''
+    query = text('''
+        WITH request_rh AS (
             INSERT INTO requests_rh (user_id, content, registration_date,
-                visibility, close, last_action, content_history)
-            VALUES (:user_id, :content, :registration_date, :visibility, :close,
-                :last_action, :content_history)
-        ''')
-
-        values = {
-            'user_id': request.user_id,
-            'content': request.content,
-            'registration_date': date.today(),
-            'visibility': True,
-            'close': False,
-            'last_action': date.today(),
-            'content_history': json.dumps([{'author': request.user_id, 'content': request.content, 'date': date.today().isoformat()}])
-        }
+                visibility, close, last_action)
+            VALUES (:user_id, :content, :registration_date, :visibility,
+                :close, :last_action)
+            RETURNING id, user_id, content, last_action
+        )
+        INSERT INTO requests_rh_history (request_id, author, content, date)
+        SELECT id, user_id, content, last_action FROM request_rh
+    ''')
 
-        with engine.begin() as connection:
-            connection.execute(query, values)
-            return {'Request RH created with success'}
+    values = {
+        'user_id': request.user_id,
+        'content': request.content,
+        'registration_date': date.today(),
+        'visibility': True,
+        'close': False,
+        'last_action': date.today()
+    }
 
-    except jwt.ExpiredSignatureError as exception:
-        raise HTTPException(status_code=401,
-                            detail='Expired token') from exception
-    except jwt.DecodeError as exception:
-        raise HTTPException(status_code=401,
-                            detail='Invalid token') from exception
+    async with engine.begin() as connection:
+        await connection.execute(query, values)
+        return {'Request RH created with success'}
 
 
 # Endpoint : /rh/msg/remove
@@ -700,146 +1589,178 @@ async def add_request_rh(request: CreateRequestRH,
 # This endpoint close a request rh but don't remove it from the database
 @app.post('/rh/msg/remove')
 async def remove_request_rh(request: RemoveRequestRH,
-                            token: Annotated[str, Depends(oauth2_scheme)]):
-    try:
-        token = jwt.decode(token, os.getenv('SECRET_KEY'),
-                           algorithms=["HS256"])
-
-        with engine.begin() as connection:
-            request_rh = connection.execute(
-                    text('SELECT id FROM requests_rh WHERE id = :id;'),
-                    {"id": request.id}).mappings().one_or_none()
-
-            if not request_rh:
-                raise HTTPException(status_code=404,
-                                    detail='Request RH not found')
-
-            query = text('''
-                UPDATE requests_rh
-                SET visibility = :visibility, close = :close, last_action = :last_action, delete_date = :delete_date
-                WHERE id = :id
-            ''')
-
-            values = {
-                'id': request.id,
-                'visibility': False,
-                'close': True,
-                'last_action': date.today(),
-                'delete_date': date.today()
-            }
-
-            connection.execute(query, values)
-            return {'Request RH removed with success'}
+                            token: Annotated[dict, Depends(get_token)]):
+    query = text('''
+        UPDATE requests_rh
+        SET visibility = :visibility, close = :close, last_action = :last_action, delete_date = :delete_date
+        WHERE id = :id
+        RETURNING id
+    ''')
 
-    except jwt.ExpiredSignatureError as exception:
-        raise HTTPException(status_code=401,
-                            detail='Expired token') from exception
-    except jwt.DecodeError as exception:
-        raise HTTPException(status_code=401,
-                            detail='Invalid token') from exception
+    values = {
+        'id': request.id,
+        'visibility': False,
+        'close': True,
+        'last_action': date.today(),
+        'delete_date': date.today()
+    }
+
+    async with engine.begin() as connection:
+        request_rh = (await connection.execute(query, values)).one_or_none()
+
+    if not request_rh:
+        raise HTTPException(status_code=404, detail='Request RH not found')
+
+    return {'Request RH removed with success'}
 
 
 @app.post('/rh/msg/update')
 async def update_request_rh(request: UpdateRequestRH,
-                            token: Annotated[str, Depends(oauth2_scheme)]):
-    try:
-        token = jwt.decode(token, os.getenv('SECRET_KEY'),
-                           algorithms=["HS256"])
-
-        with engine.begin() as connection:
-            request_rh = connection.execute(
-                text('SELECT id, content_history FROM requests_rh WHERE id = :id;'),
-                {"id": request.id}).mappings().one_or_none()
-
-            if not request_rh:
-                raise HTTPException(status_code=404,
-                                    detail='Request RH not found')
-
-            query = text('''
-                UPDATE requests_rh
-                SET content = :content, last_action = :last_action, content_history = :content_history
-                WHERE id = :id
-            ''')
-
-            request_rh['content_history'].append({'author': request.id,
-                                                  'content': request.content,
-                                                  'date': date.today().isoformat()})
-
-            values = {
-                'id': request.id,
-                'content': request.content,
-                'content_history': json.dumps(request_rh['content_history']),
-                'last_action': date.today(),
-            }
-
-            connection.execute(query, values)
-            return {'Request RH removed with success'}
+                            token: Annotated[dict, Depends(get_token)]):
+    # The history is appended in the same statement, without reading it
+    query = text('''
+        WITH request_rh AS (
+            UPDATE requests_rh
+            SET content = :content, last_action = :last_action
+            WHERE id = :id
+            RETURNING id
+        )
+        INSERT INTO requests_rh_history (request_id, author, content, date)
+        SELECT id, :author, :content, :last_action FROM request_rh
+        RETURNING id
+    ''')
 
-    except jwt.ExpiredSignatureError as exception:
-        raise HTTPException(status_code=401,
-                            detail='Expired token') from exception
-    except jwt.DecodeError as exception:
-        raise HTTPException(status_code=401,
-                            detail='Invalid token') from exception
+    values = {
+        'id': request.id,
+        'author': token.get('id'),
+        'content': request.content,
+        'last_action': date.today(),
+    }
 
+    async with engine.begin() as connection:
+        history = (await connection.execute(query, values)).one_or_none()
 
-@app.get('/rh/msg/')
-async def get_request_rh(token: Annotated[str, Depends(oauth2_scheme)]):
-    try:
-        token = jwt.decode(token, os.getenv('SECRET_KEY'),
-                           algorithms=["HS256"])
-
-        with engine.begin() as connection:
-            requests_rh = connection.execute(text('SELECT * FROM requests_rh;'))
-
-            output = []
-
-            for row in requests_rh:
-                if token.get('role') == 'admin':
-                    values = {
-                        'id': row.id,
-                        'user_id': row.user_id,
-                        'content': row.content,
-                        'registration_date': row.registration_date,
-                        'visibility': row.visibility,
-                        'close': row.close,
-                        'last_action': row.last_action,
-                        'content_history': row.content_history,
-                        'delete_date': row.delete_date
-                    }
-                    output.append(values)
-                elif token.get('role') == 'manager' and not row.close:
-                    values = {
-                        'id': row.id,
-                        'user_id': row.user_id,
-                        'content': row.content,
-                        'registration_date': row.registration_date,
-                        'visibility': row.visibility,
-                        'close': row.close,
-                        'last_action': row.last_action,
-                        'content_history': row.content_history,
-                        'delete_date': row.delete_date
-                    }
-                    output.append(values)
-                elif token.get('id') == row.user_id and not row.close:
-                    values = {
-                        'id': row.id,
-                        'user_id': row.user_id,
-                        'content': row.content,
-                        'registration_date': row.registration_date,
-                        'visibility': row.visibility,
-                        'close': row.close,
-                        'last_action': row.last_action,
-                        'content_history': row.content_history,
-                        'delete_date': row.delete_date
-                    }
-                    output.append(values)
-
-            return output
+    if not history:
+        raise HTTPException(status_code=404, detail='Request RH not found')
 
-    except jwt.ExpiredSignatureError as exception:
-        raise HTTPException(status_code=401,
-                            detail='Expired token') from exception
-    except jwt.DecodeError as exception:
-        raise HTTPException(status_code=401,
-                            detail='Invalid token') from exception
+    return {'Request RH updated with success'}
+
+
+# Endpoint : /rh/msg/{request_id}/history
+# Type : GET
+# This endpoint return the content history of a request rh, page by page
+@app.get('/rh/msg/{request_id}/history', response_model=RequestRHHistoryPage)
+async def get_request_rh_history(request_id: Id,
+                                 token: Annotated[dict, Depends(get_token)],
+                                 cursor: str = None,
+                                 limit: Annotated[int, Query(ge=1, le=1000)] = 100):
+    conditions, values = request_rh_filters(token)
+    conditions.append('id = :request_id')
+    values['request_id'] = request_id
+
+    request_query = text(f'''
+        SELECT id FROM requests_rh WHERE {' AND '.join(conditions)};
+    ''')
+
+    history_values = {'request_id': request_id, 'limit': limit + 1}
+    history_conditions = ['request_id = :request_id']
+
+    if cursor:
+        try:
+            history_values['cursor_date'], history_values['cursor_id'] = \
+                decode_cursor(cursor)
+        except ValueError as exception:
+            raise HTTPException(status_code=400,
+                                detail='Invalid cursor') from exception
+        history_conditions.append(
+            '(date, id) > (CAST(:cursor_date AS date), :cursor_id)')
+
+    # Ordered by date first, so entries moved by backfill-rh-history come
+    # before the edits made since the upgrade
+    history_query = text(f'''
+        SELECT {select_columns(RequestRHHistoryItem)}
+        FROM requests_rh_history
+        WHERE {' AND '.join(history_conditions)}
+        ORDER BY date, id
+        LIMIT :limit;
+    ''')
+
+    async with read_engine.connect() as connection:
+        request_rh = (await connection.execute(
+            request_query, values)).one_or_none()
+
+        if not request_rh:
+            raise HTTPException(status_code=404,
+                                detail='Request RH not found')
+
+        history = (await connection.execute(
+            history_query, history_values)).mappings().all()
+
+    next_cursor = None
+    if len(history) > limit:
+        history = history[:limit]
+        next_cursor = encode_cursor(history[-1]['date'], history[-1]['id'])
+
+    return {'items': history, 'next_cursor': next_cursor}
+
+
+@app.get('/rh/msg/', response_model=RequestRHPage)
+async def get_request_rh(token: Annotated[dict, Depends(get_token)],
+                         cursor: str = None,
+                         limit: Annotated[int, Query(ge=1, le=1000)] = 100,
+                         close: bool = None,
+                         user_id: Id = None,
+                         date_from: date = None,
+                         date_to: date = None,
+                         department_id: Id = None,
+                         export_format: Annotated[
+                             Literal['ndjson', 'csv'],
+                             Query(alias='format')] = None):
+    conditions, values = request_rh_filters(token, close, user_id,
+                                            date_from, date_to,
+                                            department_id)
+
+    if cursor:
+        try:
+            last_action, last_id = decode_cursor(cursor)
+        except ValueError as exception:
+            raise HTTPException(status_code=400,
+                                detail='Invalid cursor') from exception
+        conditions.append(
+            '(last_action, id) > '
+            '(CAST(:cursor_last_action AS date), :cursor_id)')
+        values['cursor_last_action'] = last_action
+        values['cursor_id'] = last_id
+
+    where = ' AND '.join(conditions) if conditions else 'TRUE'
+    columns = select_columns(RequestRHItem)
+
+    if export_format:
+        query = text(f'''
+            SELECT {columns}
+            FROM requests_rh
+            WHERE {where}
+            ORDER BY last_action, id;
+        ''')
+        return stream_export(engine, query, values, export_format,
+                             'requests_rh')
+
+    query = text(f'''
+        SELECT {columns}
+        FROM requests_rh
+        WHERE {where}
+        ORDER BY last_action, id
+        LIMIT :limit;
+    ''')
+    values['limit'] = limit + 1
+
+    async with read_engine.connect() as connection:
+        requests_rh = (await connection.execute(query, values)).mappings().all()
+
+    next_cursor = None
+    if len(requests_rh) > limit:
+        requests_rh = requests_rh[:limit]
+        next_cursor = encode_cursor(requests_rh[-1]['last_action'],
+                                    requests_rh[-1]['id'])
+
+    return {'items': requests_rh, 'next_cursor': next_cursor}
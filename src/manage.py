@@ -0,0 +1,429 @@
+'''
+Maintenance commands for ProtoRH.
+
+Usage:
+    python src/manage.py migrate
+    python src/manage.py rekey-tokens [--chunk-size 10000]
+    python src/manage.py import-users FILE [--format jsonl|csv] [--workers N]
+    python src/manage.py convert-pictures
+    python src/manage.py backfill-rh-history [--chunk-size 1000]
+    python src/manage.py check-department-counts [--repair]
+    python src/manage.py run-job NAME
+    python src/manage.py cache-server [--host localhost] [--port 11211]
+'''
+import os
+import re
+import sys
+import argparse
+import asyncio
+from dotenv import load_dotenv
+from sqlalchemy import text
+
+src_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(src_dir)
+
+from base_controller import get_base
+from database_controller import (get_engine, migrate_schema,
+                                 retry_with_backoff, MigrationError)
+# Declare the tables on Base
+import classes.user
+import classes.department
+import classes.request_rh
+import classes.job
+from token_controller import gen_tokens
+from cache_controller import serve_memcached
+from image_controller import (PICTURES_DIR, RENDITION_SIZES, process_picture,
+                              picture_version, store_renditions,
+                              remove_renditions)
+
+load_dotenv('protorh.env')
+
+
+async def migrate() -> int:
+    '''
+    Create the database, the tables, and the columns and indexes missing
+    from existing tables, and migrate the existing rows (e.g. lower-case
+    the emails).
+    Returns:
+        int: Exit status, 1 if rows have to be fixed by hand first.
+    '''
+
+    try:
+        await retry_with_backoff(
+            lambda: asyncio.to_thread(migrate_schema, get_base().metadata))
+    except MigrationError as exception:
+        print(exception)
+        print('Migration failed, no row was changed')
+        return 1
+
+    print('Schema up to date')
+
+    return 0
+
+
+async def rekey_tokens(chunk_size: int):
+    '''
+    Recompute the token of every user, chunk by chunk, and rename the
+    profile pictures named after tokens that changed.
+    Args:
+        chunk_size (int): Number of users handled per transaction.
+    '''
+
+    engine = get_engine()
+    salt = os.getenv('salt')
+
+    pictures = {}
+    if os.path.exists(PICTURES_DIR):
+        for file_name in os.listdir(PICTURES_DIR):
+            pictures.setdefault(re.split('[._]', file_name)[0],
+                                []).append(file_name)
+
+    select_query = text('''
+        SELECT id, email, firstname, lastname, token
+        FROM users
+        WHERE id > :last_id
+        ORDER BY id
+        LIMIT :chunk_size;
+    ''')
+
+    update_query = text('''
+        UPDATE users
+        SET token = data.token
+        FROM unnest(CAST(:ids AS integer[]), CAST(:tokens AS varchar[]))
+            AS data(id, token)
+        WHERE users.id = data.id;
+    ''')
+
+    last_id = 0
+    updated = 0
+
+    while True:
+        async with engine.begin() as connection:
+            users = (await connection.execute(
+                select_query, {'last_id': last_id,
+                               'chunk_size': chunk_size})).mappings().all()
+
+            if not users:
+                break
+
+            tokens = [str(token) for token in gen_tokens(
+                [(user['email'] or '', user['firstname'] or '',
+                  user['lastname'] or '') for user in users], salt)]
+
+            changed = [(user, token) for user, token in zip(users, tokens)
+                       if user['token'] != token]
+
+            if changed:
+                await connection.execute(update_query, {
+                    'ids': [user['id'] for user, _ in changed],
+                    'tokens': [token for _, token in changed]})
+
+        for user, token in changed:
+            for file_name in pictures.get(user['token'], []):
+                os.replace(os.path.join(PICTURES_DIR, file_name),
+                           os.path.join(PICTURES_DIR, file_name.replace(
+                               user['token'], token, 1)))
+
+        updated += len(changed)
+        last_id = users[-1]['id']
+        print(f'{last_id}: {updated} tokens updated')
+
+    await engine.dispose()
+
+
+async def import_users(path: str, content_format: str, workers: int):
+    '''
+    Create the users listed in a JSON lines or CSV file, in batches of the
+    size accepted by /user/bulk_create, and print the rows in error.
+    Args:
+        path (str): File to import.
+        content_format (str): jsonl or csv.
+        workers (int): Threads hashing the passwords. Unlike in the API,
+            where they are taken from the logins, every CPU can be used.
+    '''
+
+    os.environ['PASSWORD_BULK_WORKERS'] = str(workers)
+
+    from main import (parse_bulk_users, bulk_create_users, chunks, engine,
+                      MAX_BULK_USERS)
+
+    with open(path, encoding='utf-8') as file:
+        rows = parse_bulk_users(file.read(), content_format)
+
+    created = 0
+    errors = 0
+
+    for chunk in chunks(rows, MAX_BULK_USERS):
+        result = await bulk_create_users(chunk)
+        created += result['created']
+        errors += result['errors']
+        for row in result['rows']:
+            if row['detail']:
+                print(f"line {row['line']}: {row['email']}: {row['detail']}")
+
+    print(f'{created} users created, {errors} errors')
+
+    await engine.dispose()
+
+
+async def convert_pictures():
+    '''
+    Replace the profile pictures stored before pictures were versioned,
+    named {token}.{extension} or {token}_{size}.webp, by versioned
+    renditions and record their version in users.picture.
+    '''
+
+    engine = get_engine()
+    largest = max(RENDITION_SIZES)
+
+    update_query = text('''
+        UPDATE users
+        SET picture = :picture
+        FROM (SELECT id, picture FROM users WHERE token = :token FOR UPDATE)
+            AS previous
+        WHERE users.id = previous.id
+        RETURNING previous.picture;
+    ''')
+    converted = 0
+
+    for file_name in sorted(os.listdir(PICTURES_DIR)):
+        match = re.fullmatch(
+            rf'(\d+)(\.(gif|png|jpg|jpeg)|_{largest}\.webp)', file_name)
+        if not match:
+            continue
+
+        token = match.group(1)
+        with open(os.path.join(PICTURES_DIR, file_name), 'rb') as file:
+            content = file.read()
+
+        try:
+            renditions = await process_picture(content)
+        except (OSError, ValueError) as exception:
+            print(f'{file_name}: {exception}')
+            continue
+
+        version = picture_version(renditions)
+        store_renditions(token, version, renditions)
+
+        async with engine.begin() as connection:
+            previous = (await connection.execute(update_query, {
+                'picture': version, 'token': token})).scalars().all()
+
+        remove_renditions(token)
+        for previous_version in set(previous) - {None, version}:
+            remove_renditions(token, previous_version)
+        converted += 1
+
+    print(f'{converted} pictures converted')
+
+    await engine.dispose()
+
+
+async def backfill_rh_history(chunk_size: int):
+    '''
+    Move the content_history JSON of existing requests rh to the
+    requests_rh_history table, chunk by chunk.
+    Args:
+        chunk_size (int): Number of requests handled per transaction.
+    '''
+
+    engine = get_engine()
+
+    query = text('''
+        WITH chunk AS (
+            SELECT id, content_history
+            FROM requests_rh
+            WHERE id > :last_id AND content_history IS NOT NULL
+            ORDER BY id
+            LIMIT :chunk_size
+            FOR UPDATE
+        ), history AS (
+            INSERT INTO requests_rh_history (request_id, author, content, date)
+            SELECT chunk.id, CAST(entry->>'author' AS integer),
+                entry->>'content', CAST(entry->>'date' AS date)
+            FROM chunk, json_array_elements(chunk.content_history)
+                WITH ORDINALITY AS entries(entry, position)
+            ORDER BY chunk.id, entries.position
+        ), cleared AS (
+            UPDATE requests_rh
+            SET content_history = NULL
+            FROM chunk
+            WHERE requests_rh.id = chunk.id
+        )
+        SELECT max(id) AS last_id, count(*) AS moved FROM chunk;
+    ''')
+
+    last_id = 0
+    moved = 0
+
+    while True:
+        async with engine.begin() as connection:
+            chunk = (await connection.execute(query, {
+                'last_id': last_id,
+                'chunk_size': chunk_size})).mappings().one()
+
+        if not chunk['moved']:
+            break
+
+        moved += chunk['moved']
+        last_id = chunk['last_id']
+        print(f'{last_id}: {moved} requests rh moved')
+
+    await engine.dispose()
+
+
+async def check_department_counts(repair: bool) -> int:
+    '''
+    Compare the member_count of every department with its memberships,
+    and set the counts that drifted when repair is true. The memberships
+    can't change during the repair.
+    Args:
+        repair (bool): Whether to fix the drifted counts.
+    Returns:
+        int: Exit status, 1 if drifted counts were left as they are.
+    '''
+
+    engine = get_engine()
+
+    async with engine.begin() as connection:
+        if repair:
+            await connection.execute(text(
+                'LOCK TABLE user_department IN SHARE MODE;'))
+
+        drifted = (await connection.execute(text('''
+            SELECT departments.id, departments.member_count,
+                count(user_department.user_id) AS actual_count
+            FROM departments
+            LEFT JOIN user_department
+                ON user_department.department_id = departments.id
+            GROUP BY departments.id
+            HAVING departments.member_count <> count(user_department.user_id)
+            ORDER BY departments.id;
+        '''))).mappings().all()
+
+        for department in drifted:
+            print(f"department {department['id']}: member_count "
+                  f"{department['member_count']}, "
+                  f"{department['actual_count']} members")
+
+        if repair and drifted:
+            await connection.execute(text('''
+                UPDATE departments
+                SET member_count = drifted.actual_count
+                FROM unnest(CAST(:ids AS integer[]),
+                            CAST(:counts AS integer[]))
+                    AS drifted(id, actual_count)
+                WHERE departments.id = drifted.id;
+            '''), {'ids': [department['id'] for department in drifted],
+                   'counts': [department['actual_count']
+                              for department in drifted]})
+
+    await engine.dispose()
+
+    if repair:
+        print(f'{len(drifted)} department counts repaired')
+        return 0
+
+    print(f'{len(drifted)} department counts drifted')
+
+    return 1 if drifted else 0
+
+
+async def run_job_command(name: str) -> int:
+    '''
+    Run a background job of the API once, e.g. from cron with
+    SCHEDULER_ENABLED=false, even if it ran less than its interval ago.
+    It is skipped if a worker is running it.
+    Args:
+        name (str): Name of the job.
+    Returns:
+        int: Exit status, 1 if the job was running elsewhere.
+    '''
+
+    from main import jobs, engine
+    from scheduler_controller import run_job
+
+    job = next(job for job in jobs if job.name == name)
+    rows = await run_job(engine, job, force=True)
+
+    await engine.dispose()
+
+    if rows is None:
+        print(f'{name} is already running')
+        return 1
+
+    print(f'{name}: {rows} rows changed')
+
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description='ProtoRH maintenance commands')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    migrate_parser = subparsers.add_parser(
+        'migrate', help='Create or update the database schema')
+    migrate_parser.set_defaults(func=lambda args: migrate())
+
+    rekey = subparsers.add_parser(
+        'rekey-tokens', help='Recompute the token of every user')
+    rekey.add_argument('--chunk-size', type=int, default=10000)
+    rekey.set_defaults(func=lambda args: rekey_tokens(args.chunk_size))
+
+    import_parser = subparsers.add_parser(
+        'import-users', help='Create users from a JSON lines or CSV file')
+    import_parser.add_argument('path')
+    import_parser.add_argument('--format', choices=['jsonl', 'csv'],
+                               default=None,
+                               help='Defaults to csv for .csv files')
+    import_parser.add_argument('--workers', type=int,
+                               default=os.cpu_count(),
+                               help='Threads hashing the passwords, '
+                                    'defaults to the number of CPUs')
+    import_parser.set_defaults(func=lambda args: import_users(
+        args.path, args.format or (
+            'csv' if args.path.endswith('.csv') else 'jsonl'),
+        args.workers))
+
+    convert = subparsers.add_parser(
+        'convert-pictures',
+        help='Generate the renditions of previously uploaded pictures')
+    convert.set_defaults(func=lambda args: convert_pictures())
+
+    backfill = subparsers.add_parser(
+        'backfill-rh-history',
+        help='Move the content history of requests rh to their own table')
+    backfill.add_argument('--chunk-size', type=int, default=1000)
+    backfill.set_defaults(func=lambda args: backfill_rh_history(
+        args.chunk_size))
+
+    check_counts = subparsers.add_parser(
+        'check-department-counts',
+        help='Check the member counts of the departments')
+    check_counts.add_argument('--repair', action='store_true',
+                              help='Fix the counts that drifted')
+    check_counts.set_defaults(func=lambda args: check_department_counts(
+        args.repair))
+
+    run_job_parser = subparsers.add_parser(
+        'run-job', help='Run a background job once')
+    run_job_parser.add_argument('name',
+                                choices=['recompute-ages', 'rh-retention'])
+    run_job_parser.set_defaults(func=lambda args: run_job_command(args.name))
+
+    cache_server = subparsers.add_parser(
+        'cache-server',
+        help='Run a memcached stand-in for CACHE_BACKEND=memcached '
+             'and RATE_LIMIT_BACKEND=memcached')
+    cache_server.add_argument('--host', default='localhost')
+    cache_server.add_argument('--port', type=int, default=11211)
+    cache_server.set_defaults(func=lambda args: serve_memcached(
+        args.host, args.port))
+
+    args = parser.parse_args()
+    # Commands may return an exit status
+    sys.exit(asyncio.run(args.func(args)))
+
+
+if __name__ == '__main__':
+    main()
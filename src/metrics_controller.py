@@ -0,0 +1,357 @@
+'''
+Allows for collecting metrics and exposing them in the Prometheus text
+exposition format.
+'''
+import time
+from contextlib import contextmanager
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+
+from query_guard_controller import QueryGuard, query_log
+
+# Every metric created, in creation order
+registry = []
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+JOB_BUCKETS = (0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0, 900.0, 3600.0)
+
+
+def format_labels(labels: dict) -> str:
+    '''
+    Format labels as in the text exposition format.
+    Args:
+        labels (dict): Label names and values.
+    Returns:
+        str: Formatted labels, empty if there is none.
+    '''
+
+    if not labels:
+        return ''
+
+    escaped = [
+        name + '="' + str(value).replace('\\', '\\\\').replace(
+            '"', '\\"').replace('\n', '\\n') + '"'
+        for name, value in labels.items()]
+
+    return '{' + ','.join(escaped) + '}'
+
+
+def format_value(value: float) -> str:
+    '''
+    Format a sample value as in the text exposition format.
+    '''
+
+    if value == float('inf'):
+        return '+Inf'
+
+    return repr(float(value))
+
+
+class Metric:
+    '''
+    Base of the metrics: a value for each combination of label values.
+    '''
+
+    type = 'untyped'
+
+    def __init__(self, name: str, documentation: str, function=None):
+        '''
+        Args:
+            name (str): Name of the metric.
+            documentation (str): Help text of the metric.
+            function (callable): Returns the value at collection time,
+                instead of the values recorded by the metric.
+        '''
+
+        self.name = name
+        self.documentation = documentation
+        self.function = function
+        self.values = {}
+        registry.append(self)
+
+    def key(self, labels: dict) -> tuple:
+        '''
+        Return the key of the value recorded for these labels.
+        '''
+
+        return tuple(sorted(labels.items()))
+
+    def samples(self) -> list:
+        '''
+        Return the samples of the metric as (suffix, labels, value).
+        '''
+
+        if self.function is not None:
+            return [('', {}, self.function())]
+
+        return [('', dict(key), value) for key, value in self.values.items()]
+
+    def render(self) -> str:
+        '''
+        Return the metric in the text exposition format.
+        '''
+
+        lines = [f'# HELP {self.name} {self.documentation}',
+                 f'# TYPE {self.name} {self.type}']
+        for suffix, labels, value in self.samples():
+            lines.append(f'{self.name}{suffix}{format_labels(labels)} '
+                         f'{format_value(value)}')
+
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    '''
+    Value that only goes up.
+    '''
+
+    type = 'counter'
+
+    def inc(self, amount: float = 1, **labels):
+        '''
+        Add amount to the value of these labels.
+        '''
+
+        key = self.key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    '''
+    Value that goes up and down.
+    '''
+
+    type = 'gauge'
+
+    def inc(self, amount: float = 1, **labels):
+        '''
+        Add amount to the value of these labels.
+        '''
+
+        key = self.key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        '''
+        Subtract amount from the value of these labels.
+        '''
+
+        self.inc(-amount, **labels)
+
+    def set(self, value: float, **labels):
+        '''
+        Set the value of these labels.
+        '''
+
+        self.values[self.key(labels)] = value
+
+
+class Histogram(Metric):
+    '''
+    Distribution of observed values in cumulative buckets.
+    '''
+
+    type = 'histogram'
+
+    def __init__(self, name: str, documentation: str,
+                 buckets: tuple = LATENCY_BUCKETS):
+        '''
+        Args:
+            name (str): Name of the metric.
+            documentation (str): Help text of the metric.
+            buckets (tuple): Upper bounds of the buckets, increasing.
+        '''
+
+        super().__init__(name, documentation)
+        self.buckets = tuple(buckets) + (float('inf'),)
+
+    def observe(self, value: float, **labels):
+        '''
+        Record a value for these labels.
+        '''
+
+        key = self.key(labels)
+        state = self.values.get(key)
+        if state is None:
+            state = self.values[key] = [[0] * len(self.buckets), 0.0, 0]
+
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                state[0][index] += 1
+                break
+        state[1] += value
+        state[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        '''
+        Observe the time spent in the with block.
+        '''
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self) -> list:
+        '''
+        Return the buckets, sum and count of each combination of labels.
+        '''
+
+        samples = []
+        for key, (counts, total, count) in self.values.items():
+            labels = dict(key)
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                samples.append(('_bucket', {**labels, 'le': format_value(
+                    bound)}, cumulative))
+            samples.append(('_sum', labels, total))
+            samples.append(('_count', labels, count))
+
+        return samples
+
+
+def render_metrics() -> str:
+    '''
+    Return every metric in the text exposition format.
+    '''
+
+    return '\n'.join(metric.render() for metric in registry) + '\n'
+
+
+http_requests = Counter(
+    'http_requests_total', 'HTTP requests handled, by route and status.')
+http_request_duration = Histogram(
+    'http_request_duration_seconds', 'Time spent handling HTTP requests.')
+http_requests_in_flight = Gauge(
+    'http_requests_in_flight', 'HTTP requests being handled.')
+http_request_queries = Histogram(
+    'http_request_queries', 'SQL statements run per HTTP request.',
+    buckets=COUNT_BUCKETS)
+http_request_query_duration = Histogram(
+    'http_request_query_duration_seconds',
+    'Time spent running SQL statements per HTTP request.')
+db_queries = Counter(
+    'db_queries_total', 'SQL statements run.')
+db_pool_checkout = Histogram(
+    'db_pool_checkout_seconds',
+    'Time spent waiting for a connection from the pool.')
+jwt_decode = Histogram(
+    'jwt_decode_seconds', 'Time spent decoding and verifying JWTs.')
+picture_decode = Histogram(
+    'picture_decode_seconds',
+    'Time spent decoding and encoding profile pictures in the process pool.')
+picture_process = Histogram(
+    'picture_process_seconds',
+    'Time spent processing profile pictures, waiting for a worker included.')
+password_hash = Histogram(
+    'password_hash_seconds',
+    'Time spent hashing and verifying passwords, by thread pool.')
+password_process = Histogram(
+    'password_process_seconds',
+    'Time spent hashing and verifying passwords, waiting for a thread '
+    'included, by thread pool.')
+
+cache_lookups = Counter(
+    'cache_lookups_total', 'Cache lookups, by cached data and result.')
+cache_invalidations = Counter(
+    'cache_invalidations_total', 'Cache invalidations, by cached data.')
+
+rate_limit_requests = Counter(
+    'rate_limit_requests_total',
+    'Requests checked by the rate limiters, by limiter and result.')
+requests_shed = Counter(
+    'requests_shed_total',
+    'Requests rejected because their route group was at capacity.')
+route_group_in_flight = Gauge(
+    'route_group_in_flight', 'Requests being handled, by route group.')
+
+job_runs = Counter(
+    'job_runs_total', 'Background job runs, by job and result.')
+job_duration = Histogram(
+    'job_duration_seconds', 'Time spent running background jobs.',
+    buckets=JOB_BUCKETS)
+job_rows = Counter(
+    'job_rows_total', 'Rows changed by background jobs.')
+job_last_success = Gauge(
+    'job_last_success_timestamp_seconds',
+    'Unix time of the last successful run of each background job.')
+
+
+def count_query(connection, cursor, statement, parameters, context,
+                executemany):
+    '''
+    before_cursor_execute listener counting the statements run.
+    '''
+
+    db_queries.inc()
+
+
+class TimedQueuePool(AsyncAdaptedQueuePool):
+    '''
+    Connection pool of the asynchronous engine recording how long each
+    checkout waits for a connection.
+    '''
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            db_pool_checkout.observe(time.perf_counter() - start)
+
+
+class MetricsMiddleware:
+    '''
+    ASGI middleware recording the latency, the status and the number and
+    time of the SQL statements of each HTTP request, labelled by route
+    template. When the query guard is enabled, the statements are checked
+    against its limits and reported in the X-Query-Count and
+    X-Query-Duration-Ms headers.
+    '''
+
+    def __init__(self, app, guard: QueryGuard = None):
+        self.app = app
+        self.guard = guard or QueryGuard()
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        status = 500
+        log = self.guard.new_log()
+        token = query_log.set(log)
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+                if self.guard.enabled:
+                    message = {**message, 'headers': [
+                        *message.get('headers', []),
+                        (b'x-query-count', str(log.count).encode()),
+                        (b'x-query-duration-ms',
+                         f'{log.duration * 1000:.3f}'.encode())]}
+            await send(message)
+
+        http_requests_in_flight.inc()
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            elapsed = time.perf_counter() - start
+            http_requests_in_flight.dec()
+            query_log.reset(token)
+
+            route = scope.get('route')
+            labels = {'method': scope['method'],
+                      'route': route.path if route else 'unmatched'}
+            http_requests.inc(status=status, **labels)
+            http_request_duration.observe(elapsed, **labels)
+            http_request_queries.observe(log.count, **labels)
+            http_request_query_duration.observe(log.duration, **labels)
+            self.guard.report(log, f"{labels['method']} {labels['route']}")
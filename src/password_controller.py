@@ -0,0 +1,231 @@
+'''
+Allows for hashing and verifying passwords with scrypt in a thread pool,
+and for recognizing the legacy salted MD5 hashes to replace them.
+'''
+import os
+import hmac
+import time
+import base64
+import hashlib
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics_controller import password_hash, password_process
+
+# Cost parameters of the new hashes, n being read by get_scrypt_cost.
+# Hashes made with other parameters are still verified, and replaced on
+# the next successful login.
+SCRYPT_R = 8
+SCRYPT_P = 1
+SALT_BYTES = 16
+KEY_BYTES = 32
+
+# Thread pools created on first use, one for logins and password changes
+# and one for bulk imports, which would otherwise queue thousands of
+# hashes ahead of the logins. hashlib releases the GIL while scrypt runs,
+# so the event loop keeps serving.
+executor = None
+bulk_executor = None
+# Hash verified when the email is unknown, so that the response time
+# doesn't tell whether an account exists
+dummy_hash = None
+
+
+def get_scrypt_cost() -> tuple:
+    '''
+    Return the cost parameters n, r and p of the new hashes, n being
+    PASSWORD_SCRYPT_N (2 ** 14 by default). Read on each call, as the
+    settings are loaded after this module is imported.
+    '''
+
+    return (int(os.getenv('PASSWORD_SCRYPT_N', str(2 ** 14))), SCRYPT_R,
+            SCRYPT_P)
+
+
+def get_password_executor() -> ThreadPoolExecutor:
+    '''
+    Return the thread pool running scrypt. Its size, PASSWORD_WORKERS
+    (by default the number of CPUs), bounds the concurrent hashes and
+    their memory (128 * n * r bytes each, see get_scrypt_cost).
+    '''
+
+    global executor
+
+    if executor is None:
+        workers = os.getenv('PASSWORD_WORKERS')
+        executor = ThreadPoolExecutor(
+            max_workers=int(workers) if workers else os.cpu_count(),
+            thread_name_prefix='password')
+
+    return executor
+
+
+def get_bulk_password_executor() -> ThreadPoolExecutor:
+    '''
+    Return the thread pool hashing the passwords of bulk imports. Its size,
+    PASSWORD_BULK_WORKERS (1 by default), bounds the CPU an import takes
+    from the logins.
+    '''
+
+    global bulk_executor
+
+    if bulk_executor is None:
+        bulk_executor = ThreadPoolExecutor(
+            max_workers=int(os.getenv('PASSWORD_BULK_WORKERS', '1')),
+            thread_name_prefix='password-bulk')
+
+    return bulk_executor
+
+
+def shutdown_password_executor():
+    '''
+    Stop the thread pools, if they were created, without waiting for
+    pending hashes.
+    '''
+
+    global executor, bulk_executor
+
+    for pool in (executor, bulk_executor):
+        if pool is not None:
+            pool.shutdown(wait=False, cancel_futures=True)
+    executor = None
+    bulk_executor = None
+
+
+def legacy_hash(password: str) -> str:
+    '''
+    Return the former hash of a password, an MD5 of the password and the
+    salt setting.
+    '''
+
+    string = password + os.getenv('salt')
+
+    return hashlib.md5(string.encode('utf-8')).hexdigest()
+
+
+def scrypt(password: str, salt: bytes, n: int, r: int, p: int) -> bytes:
+    '''
+    Derive the key of a password with scrypt.
+    '''
+
+    return hashlib.scrypt(password.encode('utf-8'), salt=salt, n=n, r=r,
+                          p=p, maxmem=256 * n * r * p, dklen=KEY_BYTES)
+
+
+def make_hash(password: str) -> str:
+    '''
+    Hash a password with a new random salt.
+    Args:
+        password (str): Password to hash.
+    Returns:
+        str: scrypt$n$r$p$salt$key, salt and key in base64.
+    '''
+
+    n, r, p = get_scrypt_cost()
+    salt = os.urandom(SALT_BYTES)
+    key = scrypt(password, salt, n, r, p)
+
+    return '$'.join(['scrypt', str(n), str(r), str(p),
+                     base64.b64encode(salt).decode(),
+                     base64.b64encode(key).decode()])
+
+
+def check_hash(password: str, stored: str) -> tuple:
+    '''
+    Verify a password against a stored scrypt or legacy hash.
+    Args:
+        password (str): Password to verify.
+        stored (str): Stored hash.
+    Returns:
+        tuple: Whether the password matches, and whether the stored hash
+            should be replaced by a new one (legacy hash or former cost
+            parameters).
+    '''
+
+    if not stored:
+        return False, False
+
+    if not stored.startswith('scrypt$'):
+        matches = hmac.compare_digest(legacy_hash(password).encode(),
+                                      stored.encode())
+        return matches, matches
+
+    try:
+        _, n, r, p, salt, key = stored.split('$')
+        n, r, p = int(n), int(r), int(p)
+        salt, key = base64.b64decode(salt), base64.b64decode(key)
+    except ValueError:
+        return False, False
+
+    matches = hmac.compare_digest(scrypt(password, salt, n, r, p), key)
+
+    return matches, matches and (n, r, p) != get_scrypt_cost()
+
+
+def timed(function, *args) -> tuple:
+    '''
+    Run function and measure it, in the pool thread.
+    '''
+
+    start = time.perf_counter()
+    result = function(*args)
+
+    return result, time.perf_counter() - start
+
+
+async def run_in_pool(function, *args, bulk: bool = False):
+    '''
+    Run function in the login or bulk import thread pool, recording the
+    time spent hashing and the time spent waiting for a thread.
+    '''
+
+    loop = asyncio.get_running_loop()
+    if bulk:
+        pool, name = get_bulk_password_executor(), 'bulk'
+    else:
+        pool, name = get_password_executor(), 'login'
+
+    with password_process.time(pool=name):
+        result, elapsed = await loop.run_in_executor(pool, timed, function,
+                                                     *args)
+    password_hash.observe(elapsed, pool=name)
+
+    return result
+
+
+async def hash_password(password: str) -> str:
+    '''
+    Run make_hash in the thread pool.
+    '''
+
+    return await run_in_pool(make_hash, password)
+
+
+async def hash_passwords(passwords: list) -> list:
+    '''
+    Run make_hash on each password in the bulk import thread pool, leaving
+    the threads of the login pool to the logins.
+    '''
+
+    return await asyncio.gather(*(run_in_pool(make_hash, password, bulk=True)
+                                  for password in passwords))
+
+
+async def verify_password(password: str, stored: str) -> tuple:
+    '''
+    Run check_hash in the thread pool. When stored is None (unknown user),
+    a dummy hash is verified instead and the password never matches.
+    Returns:
+        tuple: Whether the password matches, and whether the stored hash
+            should be replaced.
+    '''
+
+    global dummy_hash
+
+    if stored is None:
+        if dummy_hash is None:
+            dummy_hash = await run_in_pool(make_hash, os.urandom(16).hex())
+        await run_in_pool(check_hash, password, dummy_hash)
+        return False, False
+
+    return await run_in_pool(check_hash, password, stored)
@@ -0,0 +1,241 @@
+'''
+Allows for recording the SQL statements run while handling a request or
+a block of code, and for detecting those running too many statements or
+the same statement repeatedly (N+1 queries).
+'''
+import os
+import re
+import time
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+GUARD_MODES = ('off', 'log', 'raise')
+
+# Statements of the current request or guarded block, None elsewhere
+query_log = ContextVar('query_log', default=None)
+
+# Literals inlined in a statement, so that statements differing only by
+# their values have the same shape
+LITERALS = re.compile(r"'(?:[^']|'')*'|(?<![\w$])\d+(?:\.\d+)?\b")
+
+
+class QueryBudgetExceeded(Exception):
+    '''
+    Raised by a strict query log when a statement goes over its limits.
+    '''
+
+
+def statement_shape(statement: str) -> str:
+    '''
+    Return a statement with its literals replaced and its whitespace
+    collapsed. Bound parameters are already placeholders.
+    Args:
+        statement (str): SQL statement.
+    Returns:
+        str: Shape of the statement.
+    '''
+
+    return ' '.join(LITERALS.sub('?', statement).split())
+
+
+class QueryLog:
+    '''
+    Number, total time and shapes of the statements run, checked against a
+    budget of statements and a limit of runs of a same shape.
+    '''
+
+    def __init__(self, budget: int = None, repeat: int = None,
+                 strict: bool = False):
+        '''
+        Args:
+            budget (int): Maximum number of statements, None for no limit.
+            repeat (int): Maximum number of runs of a same shape, None for
+                no limit.
+            strict (bool): Whether to raise QueryBudgetExceeded from the
+                statement going over a limit, instead of only reporting it
+                in violations().
+        '''
+
+        self.budget = budget
+        self.repeat = repeat
+        self.strict = strict
+        self.count = 0
+        self.duration = 0.0
+        self.shapes = Counter()
+
+    def allow(self, count: int):
+        '''
+        Let count more statements run, possibly all of the same shape.
+        '''
+
+        if self.budget is not None:
+            self.budget += count
+        if self.repeat is not None:
+            self.repeat = max(self.repeat, count)
+
+    def record(self, statement: str):
+        '''
+        Record a statement about to run.
+        Raises:
+            QueryBudgetExceeded: If the log is strict and the statement goes
+                over a limit.
+        '''
+
+        shape = statement_shape(statement)
+        self.count += 1
+        self.shapes[shape] += 1
+
+        if not self.strict:
+            return
+        if self.budget is not None and self.count > self.budget:
+            raise QueryBudgetExceeded(
+                f'{self.count} statements, budget of {self.budget}')
+        if self.repeat is not None and self.shapes[shape] > self.repeat:
+            raise QueryBudgetExceeded(
+                f'Statement run {self.shapes[shape]} times, limit of '
+                f'{self.repeat}: {shape[:200]}')
+
+    def violations(self) -> list:
+        '''
+        Return a description of each limit gone over.
+        '''
+
+        violations = []
+        if self.budget is not None and self.count > self.budget:
+            violations.append(f'{self.count} statements, budget of '
+                              f'{self.budget}')
+        if self.repeat is not None:
+            for shape, count in self.shapes.items():
+                if count > self.repeat:
+                    violations.append(f'Statement run {count} times, limit '
+                                      f'of {self.repeat}: {shape[:200]}')
+
+        return violations
+
+
+def before_query(connection, cursor, statement, parameters, context,
+                 executemany):
+    '''
+    before_cursor_execute listener recording the statement in the current
+    query log.
+    '''
+
+    log = query_log.get()
+    if log is None:
+        return
+
+    if context is not None:
+        context._query_start = time.perf_counter()
+    log.record(statement)
+
+
+def after_query(connection, cursor, statement, parameters, context,
+                executemany):
+    '''
+    after_cursor_execute listener adding the time of the statement to the
+    current query log.
+    '''
+
+    log = query_log.get()
+    start = getattr(context, '_query_start', None)
+    if log is not None and start is not None:
+        log.duration += time.perf_counter() - start
+
+
+def allow_queries(count: int):
+    '''
+    Let the current request or guarded block run count more statements,
+    possibly all of the same shape: for statements intentionally run once
+    per chunk of a large input.
+    '''
+
+    log = query_log.get()
+    if log is not None:
+        log.allow(count)
+
+
+@contextmanager
+def guard_queries(budget: int = None, repeat: int = None):
+    '''
+    Record the statements run by the engines in the with block, as a
+    fixture of the benchmarks and tests.
+    Args:
+        budget (int): Maximum number of statements, None for no limit.
+        repeat (int): Maximum number of runs of a same shape, None for no
+            limit.
+    Yields:
+        QueryLog: Log of the block.
+    Raises:
+        QueryBudgetExceeded: From the statement going over a limit.
+    '''
+
+    log = QueryLog(budget, repeat, strict=True)
+    token = query_log.set(log)
+    try:
+        yield log
+    finally:
+        query_log.reset(token)
+
+
+class QueryGuard:
+    '''
+    Limits applied to the query log of each HTTP request.
+    - off: statements are counted, without limits
+    - log: the requests going over a limit are printed
+    - raise: the statement going over a limit raises QueryBudgetExceeded,
+      failing the request
+    '''
+
+    def __init__(self, mode: str = 'off', budget: int = 10, repeat: int = 3):
+        '''
+        Args:
+            mode (str): One of GUARD_MODES.
+            budget (int): Statements allowed per request.
+            repeat (int): Runs of a same shape allowed per request.
+        Raises:
+            ValueError: If mode is unknown.
+        '''
+
+        if mode not in GUARD_MODES:
+            raise ValueError(f'Unknown query guard mode {mode}')
+
+        self.mode = mode
+        self.budget = budget
+        self.repeat = repeat
+
+    @property
+    def enabled(self) -> bool:
+        return self.mode != 'off'
+
+    def new_log(self) -> QueryLog:
+        '''
+        Return the query log of a new request.
+        '''
+
+        if not self.enabled:
+            return QueryLog()
+
+        return QueryLog(self.budget, self.repeat, strict=self.mode == 'raise')
+
+    def report(self, log: QueryLog, name: str):
+        '''
+        Print the limits a request went over, in log mode.
+        '''
+
+        if self.mode != 'log':
+            return
+
+        for violation in log.violations():
+            print(f'Query guard: {name}: {violation}')
+
+
+def get_query_guard() -> QueryGuard:
+    '''
+    Build the query guard from QUERY_GUARD (off, log or raise),
+    QUERY_BUDGET and QUERY_REPEAT_LIMIT.
+    '''
+
+    return QueryGuard(os.getenv('QUERY_GUARD', 'off').strip().lower(),
+                      int(os.getenv('QUERY_BUDGET', '10')),
+                      int(os.getenv('QUERY_REPEAT_LIMIT', '3')))
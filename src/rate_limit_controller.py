@@ -0,0 +1,274 @@
+'''
+Allows for limiting the rate of requests per client with token buckets,
+stored in process or in a shared memcached server, and for capping the
+number of requests of a route group handled at once.
+'''
+import os
+import json
+import math
+import time
+import hashlib
+from collections import OrderedDict
+from fastapi import HTTPException
+
+from cache_controller import MemcachedCache
+from metrics_controller import (rate_limit_requests, requests_shed,
+                                route_group_in_flight)
+
+# Store of the buckets shared by every request, created on first use
+store = None
+
+# Attempts to update a bucket changed concurrently by another worker
+CAS_ATTEMPTS = 3
+
+
+class MemoryBucketStore:
+    '''
+    In-process store of bucket states, evicting the least recently used
+    beyond max_size and the states older than their TTL.
+    '''
+
+    def __init__(self, max_size: int = 100000):
+        '''
+        Args:
+            max_size (int): Maximum number of states.
+        '''
+
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.versions = 0
+
+    async def get(self, key: str) -> tuple:
+        '''
+        Return the state of a key and its version, (None, None) if it is
+        missing or expired.
+        '''
+
+        entry = self.entries.get(key)
+
+        if entry is None:
+            return None, None
+
+        value, version, expiration = entry
+        if time.monotonic() >= expiration:
+            del self.entries[key]
+            return None, None
+
+        return value, version
+
+    async def compare_and_set(self, key: str, value, version,
+                              ttl: float) -> bool:
+        '''
+        Store the state of a key unless its version changed since get.
+        Returns:
+            bool: Whether the state was stored.
+        '''
+
+        current, current_version = await self.get(key)
+        if current_version != version:
+            return False
+
+        self.versions += 1
+        self.entries[key] = (value, self.versions, time.monotonic() + ttl)
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+        return True
+
+
+class MemcachedBucketStore:
+    '''
+    Store of bucket states shared between workers, in a memcached server
+    (or the stand-in of serve_memcached), updated with gets and cas. A
+    server that can't be reached lets every request through.
+    '''
+
+    def __init__(self, host: str, port: int):
+        '''
+        Args:
+            host (str): Host of the server.
+            port (int): Port of the server.
+        '''
+
+        self.client = MemcachedCache(host, port)
+
+    async def get(self, key: str) -> tuple:
+        '''
+        Return the state of a key and its version, (None, None) if it is
+        missing, None if the server can't be reached.
+        '''
+
+        async def read_response(reader):
+            header = await reader.readuntil(b'\r\n')
+            if header == b'END\r\n':
+                return None, None
+            _, _, _, length, version = header.split()
+            data = await reader.readexactly(int(length) + 2)
+            await reader.readuntil(b'END\r\n')
+            return json.loads(data[:-2]), int(version)
+
+        return await self.client.command(f'gets {key}\r\n'.encode(),
+                                         read_response)
+
+    async def compare_and_set(self, key: str, value, version,
+                              ttl: float) -> bool:
+        '''
+        Store the state of a key unless its version changed since get.
+        Returns:
+            bool: Whether the state was stored, True if the server can't be
+                reached.
+        '''
+
+        data = json.dumps(value).encode()
+        if version is None:
+            command = f'add {key} 0 {math.ceil(ttl)} {len(data)}'
+        else:
+            command = f'cas {key} 0 {math.ceil(ttl)} {len(data)} {version}'
+
+        async def read_response(reader):
+            return await reader.readuntil(b'\r\n') == b'STORED\r\n'
+
+        stored = await self.client.command(
+            command.encode() + b'\r\n' + data + b'\r\n', read_response)
+
+        return stored is None or stored
+
+
+def get_bucket_store():
+    '''
+    Return the store of the buckets, creating it on first call from the
+    environment: RATE_LIMIT_BACKEND (memory or memcached, at CACHE_URL) and
+    RATE_LIMIT_MAX_KEYS.
+    '''
+
+    global store
+
+    if store is None:
+        if os.getenv('RATE_LIMIT_BACKEND', 'memory') == 'memcached':
+            host, port = os.getenv('CACHE_URL', 'localhost:11211').split(':')
+            store = MemcachedBucketStore(host, int(port))
+        else:
+            store = MemoryBucketStore(int(os.getenv('RATE_LIMIT_MAX_KEYS',
+                                                    '100000')))
+
+    return store
+
+
+def parse_rate(value: str) -> tuple:
+    '''
+    Parse a rate setting.
+    Args:
+        value (str): capacity/seconds, or off.
+    Returns:
+        tuple: Capacity and period in seconds, None if off.
+    Raises:
+        ValueError: If value is malformed.
+    '''
+
+    if value.strip().lower() in ('', 'off'):
+        return None
+
+    capacity, period = value.split('/')
+
+    return int(capacity), float(period)
+
+
+class TokenBucket:
+    '''
+    Rate limit of each key (client IP, email...): a bucket of capacity
+    tokens, refilled by capacity tokens every period seconds, from which
+    each request takes one.
+    '''
+
+    def __init__(self, name: str, rate: tuple):
+        '''
+        Args:
+            name (str): Name of the limiter, used in the keys and the
+                metrics.
+            rate (tuple): Capacity and period returned by parse_rate, None
+                to let every request through.
+        '''
+
+        self.name = name
+        self.rate = rate
+
+    async def take(self, key: str) -> float:
+        '''
+        Take a token from the bucket of a key.
+        Args:
+            key (str): Key of the bucket.
+        Returns:
+            float: 0 if the request is allowed, else the seconds to wait
+                for a token.
+        '''
+
+        if self.rate is None:
+            return 0
+
+        capacity, period = self.rate
+        refill = capacity / period
+        # Memcached keys are short and without spaces
+        key = (f'ratelimit:{self.name}:'
+               + hashlib.sha1(key.encode()).hexdigest())
+
+        for _ in range(CAS_ATTEMPTS):
+            state = await get_bucket_store().get(key)
+            if state is None:
+                # Shared store unavailable
+                rate_limit_requests.inc(limiter=self.name, result='allowed')
+                return 0
+
+            value, version = state
+            now = time.time()
+            tokens, updated = value or (capacity, now)
+            tokens = min(capacity, tokens + (now - updated) * refill)
+
+            if tokens < 1:
+                rate_limit_requests.inc(limiter=self.name, result='limited')
+                return (1 - tokens) / refill
+
+            # The bucket is full again after period seconds
+            if await get_bucket_store().compare_and_set(
+                    key, (tokens - 1, now), version, period):
+                rate_limit_requests.inc(limiter=self.name, result='allowed')
+                return 0
+
+        # Contended by concurrent requests of the same key
+        rate_limit_requests.inc(limiter=self.name, result='limited')
+        return 1 / refill
+
+
+class ConcurrencyLimiter:
+    '''
+    FastAPI dependency capping the requests of a route group handled at
+    once. The others are rejected with a 503 before reaching the database,
+    instead of queueing for its connections.
+    '''
+
+    def __init__(self, group: str, limit: int):
+        '''
+        Args:
+            group (str): Name of the route group, used in the metrics.
+            limit (int): Maximum number of requests handled at once, 0 for
+                no limit.
+        '''
+
+        self.group = group
+        self.limit = limit
+        self.in_flight = 0
+
+    async def __call__(self):
+        if self.limit and self.in_flight >= self.limit:
+            requests_shed.inc(group=self.group)
+            raise HTTPException(status_code=503,
+                                detail='Too many requests in progress',
+                                headers={'Retry-After': '1'})
+
+        self.in_flight += 1
+        route_group_in_flight.inc(group=self.group)
+        try:
+            yield
+        finally:
+            self.in_flight -= 1
+            route_group_in_flight.dec(group=self.group)
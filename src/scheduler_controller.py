@@ -0,0 +1,215 @@
+'''
+Allows for running background jobs periodically in the API process, one
+process at a time, and for running them in small rate-limited chunks.
+'''
+import zlib
+import time
+import asyncio
+import traceback
+from sqlalchemy import text
+
+from metrics_controller import job_runs, job_duration, job_rows, job_last_success
+
+
+class Job:
+    '''
+    Coroutine function run every interval seconds, returning the number of
+    rows it changed.
+    '''
+
+    def __init__(self, name: str, function, interval: float):
+        '''
+        Args:
+            name (str): Name of the job, used in the metrics and by
+                manage.py run-job.
+            function (callable): Coroutine function running the job.
+            interval (float): Seconds between the end of a run and the
+                start of the next one.
+        '''
+
+        self.name = name
+        self.function = function
+        self.interval = interval
+        # Advisory lock key, the same in every process (unlike hash)
+        self.lock_key = zlib.crc32(name.encode())
+
+
+async def seconds_until_due(connection, job: Job) -> float:
+    '''
+    Return the seconds left before a job is due, interval seconds after
+    its last successful run in any process, 0 or less if it is due.
+    Args:
+        connection (AsyncConnection): Connection reading job_runs.
+        job (Job): Job to check.
+    '''
+
+    remaining = (await connection.execute(text('''
+        SELECT extract(epoch FROM last_success - now()) + :interval
+        FROM job_runs
+        WHERE name = :name;
+    '''), {'name': job.name, 'interval': job.interval})).scalar_one_or_none()
+    await connection.commit()
+
+    return 0 if remaining is None else float(remaining)
+
+
+async def run_job(engine, job: Job, force: bool = False) -> int:
+    '''
+    Run a job unless another process is running it or, unless force is
+    true, it ran less than its interval ago. A session advisory lock is
+    held on a dedicated connection while checking the last run and
+    running, and is released by the database if the process dies. The
+    end of a successful run is recorded in job_runs.
+    Args:
+        engine (AsyncEngine): Engine of the lock connection.
+        job (Job): Job to run.
+        force (bool): Whether to run the job even if it isn't due.
+    Returns:
+        int: Rows changed by the job, None if it was running elsewhere or
+            wasn't due.
+    '''
+
+    async with engine.connect() as connection:
+        locked = (await connection.execute(
+            text('SELECT pg_try_advisory_lock(:key);'),
+            {'key': job.lock_key})).scalar_one()
+        await connection.commit()
+
+        if not locked:
+            job_runs.inc(job=job.name, result='skipped')
+            return None
+
+        start = time.perf_counter()
+        try:
+            if not force and await seconds_until_due(connection, job) > 0:
+                job_runs.inc(job=job.name, result='not_due')
+                return None
+
+            try:
+                rows = await job.function()
+            except Exception:
+                job_runs.inc(job=job.name, result='failure')
+                raise
+
+            await connection.execute(text('''
+                INSERT INTO job_runs (name, last_success)
+                VALUES (:name, now())
+                ON CONFLICT (name)
+                DO UPDATE SET last_success = excluded.last_success;
+            '''), {'name': job.name})
+            await connection.commit()
+        finally:
+            await connection.execute(text('SELECT pg_advisory_unlock(:key);'),
+                                     {'key': job.lock_key})
+            await connection.commit()
+
+    job_duration.observe(time.perf_counter() - start, job=job.name)
+    job_rows.inc(rows, job=job.name)
+    job_runs.inc(job=job.name, result='success')
+    job_last_success.set(time.time(), job=job.name)
+
+    return rows
+
+
+async def run_in_chunks(engine, query, values: dict, chunk_size: int,
+                        delay: float, on_changed=None) -> int:
+    '''
+    Run a statement chunk by chunk, each chunk in its own transaction,
+    until a chunk scans no row. Pausing between chunks leaves connections
+    and IO to the API while a job runs.
+    Args:
+        engine (AsyncEngine): Engine running the statement.
+        query (TextClause): Statement taking :last_id and :chunk_size
+            besides values, and returning one row with the last id
+            scanned (last_id), the number of rows scanned (scanned) and
+            the ids of the rows changed (changed).
+        values (dict): Other values of the statement.
+        chunk_size (int): Rows scanned per chunk.
+        delay (float): Seconds to wait between chunks.
+        on_changed (callable): Coroutine function called with the ids
+            changed by each chunk.
+    Returns:
+        int: Number of rows changed.
+    '''
+
+    last_id = 0
+    changed = 0
+
+    while True:
+        async with engine.begin() as connection:
+            chunk = (await connection.execute(query, {
+                **values, 'last_id': last_id,
+                'chunk_size': chunk_size})).mappings().one()
+
+        if not chunk['scanned']:
+            return changed
+
+        last_id = chunk['last_id']
+        changed += len(chunk['changed'])
+        if on_changed is not None and chunk['changed']:
+            await on_changed(chunk['changed'])
+
+        await asyncio.sleep(delay)
+
+
+class Scheduler:
+    '''
+    Runs jobs in asyncio tasks: each job runs when it is due, interval
+    seconds after its last successful run in any process (at start if it
+    never ran). A failed run is printed and retried after interval
+    seconds, a run skipped because another process holds the job after
+    RETRY_DELAY seconds.
+    '''
+
+    # Seconds before checking again a job running in another process
+    RETRY_DELAY = 60
+
+    def __init__(self, engine, jobs: list):
+        '''
+        Args:
+            engine (AsyncEngine): Engine of the job locks.
+            jobs (list): Jobs to run.
+        '''
+
+        self.engine = engine
+        self.jobs = jobs
+        self.tasks = []
+
+    async def loop(self, job: Job):
+        '''
+        Run a job forever.
+        '''
+
+        while True:
+            try:
+                async with self.engine.connect() as connection:
+                    delay = await seconds_until_due(connection, job)
+                if delay <= 0:
+                    await run_job(self.engine, job)
+                    async with self.engine.connect() as connection:
+                        delay = max(await seconds_until_due(connection, job),
+                                    self.RETRY_DELAY)
+            except Exception:
+                print(f'Job {job.name} failed')
+                traceback.print_exc()
+                delay = job.interval
+
+            await asyncio.sleep(delay)
+
+    def start(self):
+        '''
+        Start running the jobs.
+        '''
+
+        self.tasks = [asyncio.create_task(self.loop(job)) for job in self.jobs]
+
+    async def stop(self):
+        '''
+        Cancel the jobs and wait for them to stop.
+        '''
+
+        for task in self.tasks:
+            task.cancel()
+
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
@@ -0,0 +1,92 @@
+'''
+Allows for building the SQL conditions of the user search.
+'''
+import re
+
+SEARCH_MODES = ('prefix', 'fulltext', 'fuzzy')
+
+# Columns matched by the search, postal_code being restricted to admins
+SEARCH_COLUMNS = ('firstname', 'lastname', 'email', 'postal_code')
+PUBLIC_SEARCH_COLUMNS = ('firstname', 'lastname', 'email')
+
+
+def search_document(columns: tuple) -> str:
+    '''
+    Return the document of the full-text and fuzzy searches over columns.
+    '''
+
+    return " || ' ' || ".join(f"coalesce({column}, '')" for column in columns)
+
+
+# Documents of the full-text and fuzzy searches, by whether postal codes
+# are searched. The index expressions of the users table are built from
+# the same strings, which Postgres needs to use them.
+SEARCH_VECTOR = f"to_tsvector('simple', {search_document(SEARCH_COLUMNS)})"
+SEARCH_TEXT = f'lower({search_document(SEARCH_COLUMNS)})'
+PUBLIC_SEARCH_VECTOR = ("to_tsvector('simple', "
+                        f"{search_document(PUBLIC_SEARCH_COLUMNS)})")
+PUBLIC_SEARCH_TEXT = f'lower({search_document(PUBLIC_SEARCH_COLUMNS)})'
+
+
+def prefix_bounds(prefix: str) -> tuple:
+    '''
+    Return the range of the strings starting with prefix, in the byte
+    order of the text_pattern_ops indexes. Unlike LIKE 'prefix%', the
+    range can use the indexes when the prefix is a bound parameter of a
+    cached (generic) plan.
+    Args:
+        prefix (str): Non-empty prefix.
+    Returns:
+        tuple: Lower bound and strict upper bound, None if unbounded.
+    '''
+
+    last = ord(prefix[-1])
+    if last == 0x10FFFF:
+        return prefix, None
+
+    return prefix, prefix[:-1] + chr(last + 1)
+
+
+def user_search_condition(mode: str, query: str, admin: bool) -> tuple:
+    '''
+    Build the condition selecting the users matching a search.
+    - prefix: a column starts with query (case-insensitive)
+    - fulltext: every word of query starts a word of the user
+    - fuzzy: query is similar to a part of the user, typos included
+      (needs the pg_trgm extension)
+    Args:
+        mode (str): One of SEARCH_MODES.
+        query (str): Searched text.
+        admin (bool): Whether postal codes can be searched.
+    Returns:
+        tuple: SQL condition and its bound values.
+    Raises:
+        ValueError: If query has nothing to search for.
+    '''
+
+    query = query.strip().lower()
+    if not query:
+        raise ValueError('Empty search')
+
+    if mode == 'prefix':
+        columns = SEARCH_COLUMNS if admin else PUBLIC_SEARCH_COLUMNS
+        search_from, search_to = prefix_bounds(query)
+        conditions = []
+        for column in columns:
+            condition = f'lower({column}) ~>=~ :search_from'
+            if search_to is not None:
+                condition += f' AND lower({column}) ~<~ :search_to'
+            conditions.append(f'({condition})')
+        return (f"({' OR '.join(conditions)})",
+                {'search_from': search_from, 'search_to': search_to})
+
+    if mode == 'fulltext':
+        words = re.findall(r'\w+', query)
+        if not words:
+            raise ValueError('Empty search')
+        vector = SEARCH_VECTOR if admin else PUBLIC_SEARCH_VECTOR
+        return (f"{vector} @@ to_tsquery('simple', :search_query)",
+                {'search_query': ' & '.join(f'{word}:*' for word in words)})
+
+    search_text = SEARCH_TEXT if admin else PUBLIC_SEARCH_TEXT
+    return f':search_text <% {search_text}', {'search_text': query}